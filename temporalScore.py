@@ -7,18 +7,49 @@ from __future__ import print_function
 
 import argparse
 import collections
+import contextlib
+import csv
+import datetime
+import functools
 import getpass
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
 import logging
+import multiprocessing
+import multiprocessing.pool
 import os
 import re
 import shutil
 import socket
+import sqlite3
 import string
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 import traceback
 
+try:
+    import BaseHTTPServer as httpServer
+    import urlparse
+except ImportError:
+    import http.server as httpServer
+    import urllib.parse as urlparse
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+# NumPy is only needed for the local counting engine
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 defaultParameters = collections.OrderedDict((
         ('dbConnectionName', 'lsomop'),
         ('dbUser', None), # Prompt if None
@@ -26,34 +57,131 @@ defaultParameters = collections.OrderedDict((
         ('dbSchemaName', None), # Default to dbUser
         ('drugEraTableName', 'drug_era'),
         ('condEraTableName', 'condition_era'),
+        ('personTableName', 'person'), # For stratifying by age or a person column
         ('conditionWindowStart', -100000), # in days
         ('conditionWindowEnd', 100000), # in days
         ('drugOccurrenceOffset', 0), # in days
         ('pseudocount', 1),
         ('countsScoresTableName', 'counts_scores'),
+        ('drugMarginalsTableName', None), # Default to counts table + '_drugs'
+        ('condMarginalsTableName', None), # Default to counts table + '_conds'
         ('reportFileName', None), # Default to stdout
-        ('condIdsTuple', None), # Generated
-        ('drugIdsTuple', None), # Generated
+        ('reportFormat', 'spool'), # 'spool', 'csv', 'csv.gz', or 'npy'
+        ('normalized', False), # Report only pair columns, marginals apart
+        ('summaryFileName', None), # Run summary of normalized reports
+        ('sparse', False), # Only report pairs that occur together
+        ('topK', None), # Only report the pairs with the highest scores
+        ('minScore', None), # Only report pairs with at least this score
+        ('minCtDC', None), # Only report pairs with at least this ct_d_c
+        ('incremental', False), # Only process IDs new since last run
+        ('drugMarginalsFileName', None), # Not written if None
+        ('condMarginalsFileName', None), # Not written if None
+        ('sweepReportFileName', None), # One report per configuration if given
+        ('sweepConfigsFileName', None), # Not written if None
+        ('engine', 'oracle'), # 'oracle', 'sqlite', 'numpy', or 'bitmap'
+        ('drugEraFileName', None), # CSV extract for local engines
+        ('condEraFileName', None), # CSV extract for local engines
+        ('sqliteDbFileName', None), # Default to in-memory DB
+        ('explainQueryPlans', False), # Log SQLite query plans
+        ('metricsFileName', None), # Metrics not written if None
+        ('processes', 1), # Number of processes for the numpy engine
+        ('firstOccurrenceStore', None), # Directory of first occurrences for the numpy engine
+        ('streaming', False), # Read person-sorted extracts in one pass
+        ('streamChunkSize', 1000000), # Era records per streamed chunk
+        ('stratifyBy', None), # 'period', 'age', or a person column
+        ('stratumWidth', 10), # Years per period or age band
+        ('personFileName', None), # CSV extract of the person table
+        ('shards', 1), # Number of concurrent Oracle sessions
+        ('shardWorkers', None), # Default to shards
+        ('firstOccurrenceCache', False), # Reuse first occurrences across runs
+        ('firstOccurrenceCacheTableName', 'first_occ_cache'),
+        ('firstOccurrenceCacheSize', 10), # Number of cached ID sets
+        ('runId', None), # Checkpoint the Oracle run under this name
+        ('resume', False), # Skip the phases the run has done
+        ('checkpointDirectory', None), # Directory of run manifests, default current
+        ('phaseRetries', 2), # Times to retry a failed phase
+        ('phaseRetryDelay', 60), # Seconds to wait before retrying a phase
+        ('condIdsInserts', None), # Generated
+        ('drugIdsInserts', None), # Generated
+        ('cacheTablesDdl', None), # Generated
+        ('firstDrugsCacheLookup', None), # Generated
+        ('firstCondsCacheLookup', None), # Generated
+        ('firstDrugsQuery', None), # Generated
+        ('firstCondsQuery', None), # Generated
+        ('firstDrugsConds', None), # Generated
+        ('drugIdsTableName', None), # Generated
+        ('condIdsTableName', None), # Generated
+        ('firstDrugsTableName', None), # Generated
+        ('firstCondsTableName', None), # Generated
+        ('firstDrugsCondsTableName', None), # Generated
+        ('checkpointTablesDrops', None), # Generated
+        ('pairCountsJoin', None), # Generated
+        ('pairCountsWhere', None), # Generated
+        ('pairCountsHaving', None), # Generated
+        ('shardCondPersonsTableName', None), # Generated
+        ('shardPersonsTableName', None), # Generated
+        ('firstShardCondMarginalsTableName', None), # Generated
+        ('shardDrugMarginalsUnion', None), # Generated
+        ('shardCountsUnion', None), # Generated
+        ('shardTablesDrops', None), # Generated
+        ('marginalsSpools', None), # Generated
+        ('reportCommands', None), # Generated
+        ('reportRowMarker', None), # Generated
         ))
 
-sqlScriptTemplate = '''
+# The Oracle script in parts so that sweeps can repeat the counting
+# and reporting parts for each configuration and so that shards can run
+# the parts in separate sessions.  The setup part sets up the session,
+# creates the tables, loads the IDs, and joins the first occurrences.
+oracleHeaderScriptTemplate = '''
 -- Script that collects counts of drugs and conditions in their temporal
 -- orders and uses them to compute adverse drug event likelihood scores.
 
--- Session parameters
+-- Session parameters.  Feedback reports the rows of each statement and
+-- server output reports the start of each phase for the metrics.
 whenever sqlerror exit sql.sqlcode;
 set autocommit off
 set echo off
-set feedback off
+set feedback on
+set serveroutput on
 set trimout on
 set trimspool on
 
 -- Switch to the specified schema
 alter session set current_schema = ${dbSchemaName};
+alter session set nls_timestamp_tz_format = 'YYYY-MM-DD HH24:MI:SS.FF6';
+exec dbms_output.put_line('metric,setup,' || systimestamp);
+'''
 
+# Working tables.  Their rows are private to each session.
+oracleWorkTablesScriptTemplate = '''
 -- Create temporary tables.  Use PLSQL to emulate "create or replace
 -- table"
 
+-- Staging tables for the drug and condition IDs.  The primary keys
+-- index them for joining with the era tables.
+begin
+  execute immediate 'drop table drug_ids';
+exception
+  when others then if sqlcode != -0942 then raise; end if;
+end;
+/
+create global temporary table drug_ids (
+    id number(15) not null,
+    constraint drug_ids_pk primary key (id)
+);
+
+begin
+  execute immediate 'drop table cond_ids';
+exception
+  when others then if sqlcode != -0942 then raise; end if;
+end;
+/
+create global temporary table cond_ids (
+    id number(15) not null,
+    constraint cond_ids_pk primary key (id)
+);
+
 begin
   execute immediate 'drop table first_drugs';
 exception
@@ -92,6 +220,45 @@ create global temporary table first_drugs_conds (
     cond_date date not null
 );
 
+-- Create a type for column literals so that lists of drug and condition
+-- IDs can be loaded in chunks
+create or replace type number15_table as table of number(15);
+/
+'''
+
+oracleMarginalsTablesScriptTemplate = '''
+-- Create tables to hold the counts of people for each drug and for
+-- each condition
+begin
+  execute immediate 'drop table ${drugMarginalsTableName}';
+exception
+  when others then if sqlcode != -0942 then raise; end if;
+end;
+/
+create table ${drugMarginalsTableName} (
+    drug number(15) not null, -- Drug ID
+    ct_d_bef_anyc number(9), -- Count people having drug before any condition
+    ct_d_anyc number(9), -- Count people having drug and any condition
+    ct_d number(9), -- Count people having drug
+    ct_ppl number(9) -- Count people
+);
+
+begin
+  execute immediate 'drop table ${condMarginalsTableName}';
+exception
+  when others then if sqlcode != -0942 then raise; end if;
+end;
+/
+create table ${condMarginalsTableName} (
+    cond number(15) not null, -- Condition ID
+    ct_anyd_bef_c number(9), -- Count people having any drug before condition
+    ct_anyd_c number(9), -- Count people having any drug and condition
+    ct_c number(9), -- Count people having condition
+    ct_ppl number(9) -- Count people
+);
+'''
+
+oracleCountsTableScriptTemplate = '''
 -- Create table to hold counts and scores
 begin
   execute immediate 'drop table ${countsScoresTableName}';
@@ -117,220 +284,5169 @@ create table ${countsScoresTableName} (
     -- Scores based on above counts
     temporal_score real
 );
+'''
 
--- Create a type for column literals so that lists of drug and condition
--- IDs can be used directly as tables
-create or replace type number15_table as table of number(15);
-/
+oracleResultsTablesScriptTemplate = (
+    oracleMarginalsTablesScriptTemplate
+    + oracleCountsTableScriptTemplate
+    + '\n${cacheTablesDdl}'
+    )
 
--- Find all the first drug occurrences
-insert into first_drugs
-select de.person_id as person,
-       de.drug_concept_id as drug,
-       (min(de.drug_era_start_date) + ${drugOccurrenceOffset}) as drug_date
-from ${drugEraTableName} de
-where de.drug_concept_id in ${drugIdsTuple}
-group by person_id, drug_concept_id;
+# The loading part in parts so that checkpointed runs can run each in
+# its own session.  The working tables are named by parameters because
+# checkpointed runs keep them in tables of their own.
+oracleLoadIdsScriptTemplate = '''
+-- Load the drug and condition IDs into the staging tables
+exec dbms_output.put_line('metric,load_ids,' || systimestamp);
+${drugIdsInserts}
+${condIdsInserts}
+'''
+
+oracleFirstDrugsScriptTemplate = '''
+-- Find all the first drug occurrences (from the era table or the cache)
+exec dbms_output.put_line('metric,first_drugs,' || systimestamp);
+${firstDrugsCacheLookup}
+insert into ${firstDrugsTableName}
+${firstDrugsQuery};
+'''
 
+oracleFirstCondsScriptTemplate = '''
 -- Find all the first condition occurrences
-insert into first_conds
-select ce.person_id as person,
-       ce.condition_concept_id as cond,
-       min(ce.condition_era_start_date) as cond_date
-from ${condEraTableName} ce
-where ce.condition_concept_id in ${condIdsTuple}
-group by person_id, condition_concept_id;
+exec dbms_output.put_line('metric,first_conds,' || systimestamp);
+${firstCondsCacheLookup}
+insert into ${firstCondsTableName}
+${firstCondsQuery};
+'''
 
+oracleJoinScriptTemplate = '''
 -- Put the first drug occurrences and first condition occurrences together
-insert into first_drugs_conds
+exec dbms_output.put_line('metric,first_drugs_conds,' || systimestamp);
+insert into ${firstDrugsCondsTableName}
 select fd.person, fd.drug, fc.cond, fd.drug_date, fc.cond_date
-from first_drugs fd,
-     first_conds fc
+from ${firstDrugsTableName} fd,
+     ${firstCondsTableName} fc
 where fd.person = fc.person
   and fc.cond_date >= (fd.drug_date + ${conditionWindowStart})
   and fc.cond_date <= (fd.drug_date + ${conditionWindowEnd});
+'''
+
+oracleLoadScriptTemplate = (
+    oracleLoadIdsScriptTemplate
+    + oracleFirstDrugsScriptTemplate
+    + oracleFirstCondsScriptTemplate
+    + oracleJoinScriptTemplate
+    )
+
+oracleSetupScriptTemplate = (
+    oracleHeaderScriptTemplate
+    + oracleWorkTablesScriptTemplate
+    + oracleResultsTablesScriptTemplate
+    + oracleLoadScriptTemplate
+    )
+
+# The counting part counts people for the drugs, conditions, and pairs
+# from the join of first occurrences named by ${firstDrugsConds}, first
+# the marginals and then the pairs
+oracleMarginalsScriptTemplate = '''
+-- Count people for each drug.  Each kind of count is aggregated in a
+-- single pass and then joined to the drugs.
+exec dbms_output.put_line('metric,drug_marginals,' || systimestamp);
+insert into ${drugMarginalsTableName}
+    (drug, ct_d_bef_anyc, ct_d_anyc, ct_d, ct_ppl)
+select drugs.id as drug,
+       nvl(drug_any_cts.ct_d_bef_anyc, 0),
+       nvl(drug_any_cts.ct_d_anyc, 0),
+       nvl(drug_cts.ct_d, 0),
+       ppl_cts.ct_ppl
+from ${drugIdsTableName} drugs
+-- Patients
+cross join
+    (select count(*) as ct_ppl
+     from (select person from ${firstDrugsTableName}
+           union
+           select person from ${firstCondsTableName})) ppl_cts
+-- Drug before any condition, drug and any condition
+left join
+    (select drug,
+            count(distinct case when drug_date < cond_date then person end) as ct_d_bef_anyc,
+            count(distinct person) as ct_d_anyc
+     from ${firstDrugsConds}
+     group by drug) drug_any_cts
+  on drug_any_cts.drug = drugs.id
+-- Drugs
+left join
+    (select drug, count(*) as ct_d
+     from ${firstDrugsTableName}
+     group by drug) drug_cts
+  on drug_cts.drug = drugs.id;
+
+-- Count people for each condition
+exec dbms_output.put_line('metric,cond_marginals,' || systimestamp);
+insert into ${condMarginalsTableName}
+    (cond, ct_anyd_bef_c, ct_anyd_c, ct_c, ct_ppl)
+select conds.id as cond,
+       nvl(cond_any_cts.ct_anyd_bef_c, 0),
+       nvl(cond_any_cts.ct_anyd_c, 0),
+       nvl(cond_cts.ct_c, 0),
+       ppl_cts.ct_ppl
+from ${condIdsTableName} conds
+-- Patients
+cross join
+    (select count(*) as ct_ppl
+     from (select person from ${firstDrugsTableName}
+           union
+           select person from ${firstCondsTableName})) ppl_cts
+-- Any drug before condition, any drug and condition
+left join
+    (select cond,
+            count(distinct case when drug_date < cond_date then person end) as ct_anyd_bef_c,
+            count(distinct person) as ct_anyd_c
+     from ${firstDrugsConds}
+     group by cond) cond_any_cts
+  on cond_any_cts.cond = conds.id
+-- Conditions
+left join
+    (select cond, count(*) as ct_c
+     from ${firstCondsTableName}
+     group by cond) cond_cts
+  on cond_cts.cond = conds.id;
+'''
 
--- Insert all drug-condition pairs into the temporal scores
+oraclePairCountsScriptTemplate = '''
+-- Insert the drug-condition pairs into the temporal scores with all
+-- their counts of people.  The pair counts are aggregated in a single
+-- pass and joined to the drug and condition counts.  A (person, drug,
+-- cond) triple occurs at most once in the first occurrences, so pair
+-- counts do not need to be distinct.  In sparse mode the join is inner
+-- so that only pairs that occur together in some person are inserted.
+exec dbms_output.put_line('metric,pair_counts,' || systimestamp);
 insert into ${countsScoresTableName}
     (drug, cond,
      ct_d_bef_c, ct_c_bef_d, ct_d_c,
      ct_d_bef_anyc, ct_d_anyc, ct_anyd_bef_c, ct_anyd_c,
      ct_d, ct_c, ct_ppl,
      temporal_score)
-select drugs.column_value as drug, conds.column_value as cond, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0.0
-from table(number15_table${drugIdsTuple}) drugs,
-     table(number15_table${condIdsTuple}) conds;
+select dm.drug,
+       cm.cond,
+       nvl(pair_cts.ct_d_bef_c, 0),
+       nvl(pair_cts.ct_c_bef_d, 0),
+       nvl(pair_cts.ct_d_c, 0),
+       dm.ct_d_bef_anyc,
+       dm.ct_d_anyc,
+       cm.ct_anyd_bef_c,
+       cm.ct_anyd_c,
+       dm.ct_d,
+       cm.ct_c,
+       dm.ct_ppl,
+       0.0
+from ${drugMarginalsTableName} dm
+cross join ${condMarginalsTableName} cm
+-- Drug before condition, condition before drug, drug and condition
+${pairCountsJoin}
+    (select drug, cond,
+            sum(case when drug_date < cond_date then 1 else 0 end) as ct_d_bef_c,
+            sum(case when drug_date >= cond_date then 1 else 0 end) as ct_c_bef_d,
+            count(*) as ct_d_c
+     from ${firstDrugsConds}${pairCountsWhere}
+     group by drug, cond${pairCountsHaving}) pair_cts
+  on pair_cts.drug = dm.drug
+ and pair_cts.cond = cm.cond;
+'''
 
--- Populate all the counts of people
-update ${countsScoresTableName} cst
-set
-  -- Drug before condition
-  ct_d_bef_c =
-    (select count(distinct person)
-     from first_drugs_conds fdc
-     where drug_date < cond_date
-       and cst.drug = fdc.drug
-       and cst.cond = fdc.cond),
-  -- Condition before drug
-  ct_c_bef_d =
-    (select count(distinct person)
-     from first_drugs_conds fdc
-     where drug_date >= cond_date
-       and cst.drug = fdc.drug
-       and cst.cond = fdc.cond),
-  -- Drug and condition
-  ct_d_c =
-    (select count(distinct person)
-     from first_drugs_conds fdc
-     where cst.drug = fdc.drug
-       and cst.cond = fdc.cond),
-  -- Drug before any condition
-  ct_d_bef_anyc =
-    (select count(distinct person)
-     from first_drugs_conds fdc
-     where drug_date < cond_date
-       and cst.drug = fdc.drug),
-  -- Drug and any condition
-  ct_d_anyc =
-    (select count(distinct person)
-     from first_drugs_conds fdc
-     where cst.drug = fdc.drug),
-  -- Any drug before condition
-  ct_anyd_bef_c =
-    (select count(distinct person)
-     from first_drugs_conds fdc
-     where drug_date < cond_date
-       and cst.cond = fdc.cond),
-  -- Any drug and condition
-  ct_anyd_c =
-    (select count(distinct person)
-     from first_drugs_conds fdc
-     where cst.cond = fdc.cond),
-  -- Drugs
-  ct_d =
-    (select count(distinct person)
-     from first_drugs fd
-     where cst.drug = fd.drug),
-  -- Conditions
-  ct_c =
-    (select count(distinct person)
-     from first_conds fc
-     where cst.cond = fc.cond),
-  -- Patients
-  ct_ppl =
-    (select count(distinct person)
-     from (select person from first_drugs
-           union
-           select person from first_conds));
+oracleCountsScriptTemplate = (
+    oracleMarginalsScriptTemplate
+    + oraclePairCountsScriptTemplate
+    )
 
+# The scoring part computes the scores from the counts
+oracleScoresScriptTemplate = '''
 -- Compute temporal scores
+exec dbms_output.put_line('metric,scores,' || systimestamp);
 update ${countsScoresTableName} cst
 set temporal_score =
     (((ct_d_bef_c + ${pseudocount}) / (ct_d_c + ${pseudocount} + ${pseudocount}))
      / ((ct_d_bef_anyc + ${pseudocount}) / (ct_d_anyc + ${pseudocount} + ${pseudocount})
       * (ct_anyd_bef_c + ${pseudocount}) / (ct_anyd_c + ${pseudocount} + ${pseudocount}))
     );
+'''
 
+oracleCommitScript = '''
 -- End transaction
 commit;
+'''
 
--- Set parameters for CSV-like output
+oracleReportScriptTemplate = '''
+-- Set parameters for CSV-like output (without feedback)
+exec dbms_output.put_line('metric,report,' || systimestamp);
+set feedback off
 set pagesize 0
 set linesize 1000
 set numwidth 15
 set null ''
 set colsep ,
-set termout off
 
--- Write counts and scores to a file
+${reportCommands}
+set feedback on
+'''
+
+oracleCleanupScriptTemplate = '''
+-- Clean up: drop all things except results tables
+exec dbms_output.put_line('metric,cleanup,' || systimestamp);
+drop table drug_ids;
+drop table cond_ids;
+drop table first_drugs;
+drop table first_conds;
+drop table first_drugs_conds;
+drop type number15_table;
+
+exec dbms_output.put_line('metric,end,' || systimestamp);
+exit
+'''
+
+sqlScriptTemplate = (
+    oracleSetupScriptTemplate
+    + oracleCountsScriptTemplate
+    + oracleScoresScriptTemplate
+    + oracleCommitScript
+    + oracleReportScriptTemplate
+    + oracleCleanupScriptTemplate
+    )
+
+# Oracle script that creates the tables shared by the shards of a
+# sharded run: the working tables (whose rows are private to each shard's
+# session) and the tables where the shards record their people
+oracleShardsSetupScriptTemplate = (
+    oracleHeaderScriptTemplate
+    + oracleWorkTablesScriptTemplate
+    + '''
+-- Create tables to hold the people of each condition that have any drug
+-- of some shard (and whether some drug is before the condition) and the
+-- people of each shard
+begin
+  execute immediate 'drop table ${shardCondPersonsTableName}';
+exception
+  when others then if sqlcode != -0942 then raise; end if;
+end;
+/
+create table ${shardCondPersonsTableName} (
+    cond number(15) not null,
+    person number(15) not null,
+    bef number(1) not null
+);
+
+begin
+  execute immediate 'drop table ${shardPersonsTableName}';
+exception
+  when others then if sqlcode != -0942 then raise; end if;
+end;
+/
+create table ${shardPersonsTableName} (
+    person number(15) not null
+);
+
+exec dbms_output.put_line('metric,end,' || systimestamp);
+exit
+''')
+
+# Oracle script that counts a shard of the drugs into its own results
+# tables.  The counts of any drug and of people are only for the drugs
+# of the shard, so the people behind them are recorded for the merge.
+oracleShardScriptTemplate = (
+    oracleHeaderScriptTemplate
+    + oracleResultsTablesScriptTemplate
+    + oracleLoadScriptTemplate
+    + oracleCountsScriptTemplate
+    + '''
+-- Record the people of each condition that have any drug of this shard
+-- and the people of this shard
+exec dbms_output.put_line('metric,shard_people,' || systimestamp);
+insert into ${shardCondPersonsTableName} (cond, person, bef)
+select cond, person, max(case when drug_date < cond_date then 1 else 0 end)
+from first_drugs_conds
+group by cond, person;
+
+insert into ${shardPersonsTableName} (person)
+select person from first_drugs
+union
+select person from first_conds;
+'''
+    + oracleCommitScript
+    + '''
+exec dbms_output.put_line('metric,end,' || systimestamp);
+exit
+''')
+
+# Oracle script that merges the results of the shards and reports them.
+# The counts of the pairs and of the drugs are complete in the shard of
+# the drug.  The counts of any drug for each condition and the count of
+# people are recounted from the people recorded by the shards.
+oracleShardsMergeScriptTemplate = (
+    oracleHeaderScriptTemplate
+    + oracleResultsTablesScriptTemplate
+    + '''
+-- Count people for each condition over all the shards
+exec dbms_output.put_line('metric,merge,' || systimestamp);
+insert into ${condMarginalsTableName}
+    (cond, ct_anyd_bef_c, ct_anyd_c, ct_c, ct_ppl)
+select cm.cond,
+       nvl(cond_any_cts.ct_anyd_bef_c, 0),
+       nvl(cond_any_cts.ct_anyd_c, 0),
+       cm.ct_c,
+       ppl_cts.ct_ppl
+from ${firstShardCondMarginalsTableName} cm
+-- Patients
+cross join
+    (select count(distinct person) as ct_ppl
+     from ${shardPersonsTableName}) ppl_cts
+-- Any drug before condition, any drug and condition
+left join
+    (select cond,
+            count(distinct case when bef = 1 then person end) as ct_anyd_bef_c,
+            count(distinct person) as ct_anyd_c
+     from ${shardCondPersonsTableName}
+     group by cond) cond_any_cts
+  on cond_any_cts.cond = cm.cond;
+
+-- Collect the counts of the drugs from their shards
+insert into ${drugMarginalsTableName}
+    (drug, ct_d_bef_anyc, ct_d_anyc, ct_d, ct_ppl)
+select dm.drug, dm.ct_d_bef_anyc, dm.ct_d_anyc, dm.ct_d, ppl_cts.ct_ppl
+from (${shardDrugMarginalsUnion}) dm
+cross join
+    (select count(distinct person) as ct_ppl
+     from ${shardPersonsTableName}) ppl_cts;
+
+-- Collect the counts of the pairs from their shards with the counts of
+-- the conditions over all the shards
+insert into ${countsScoresTableName}
+    (drug, cond,
+     ct_d_bef_c, ct_c_bef_d, ct_d_c,
+     ct_d_bef_anyc, ct_d_anyc, ct_anyd_bef_c, ct_anyd_c,
+     ct_d, ct_c, ct_ppl,
+     temporal_score)
+select cs.drug,
+       cs.cond,
+       cs.ct_d_bef_c,
+       cs.ct_c_bef_d,
+       cs.ct_d_c,
+       cs.ct_d_bef_anyc,
+       cs.ct_d_anyc,
+       cm.ct_anyd_bef_c,
+       cm.ct_anyd_c,
+       cs.ct_d,
+       cs.ct_c,
+       cm.ct_ppl,
+       0.0
+from (${shardCountsUnion}) cs
+join ${condMarginalsTableName} cm
+  on cm.cond = cs.cond;
+'''
+    + oracleScoresScriptTemplate
+    + oracleCommitScript
+    + oracleReportScriptTemplate
+    + '''
+-- Drop the tables of the shards
+${shardTablesDrops}
+'''
+    + oracleCleanupScriptTemplate)
+
+# Oracle script that drops the tables of a failed sharded run (ignoring
+# the tables that do not exist)
+oracleShardsCleanupScriptTemplate = (
+    oracleHeaderScriptTemplate
+    + '''
+${shardTablesDrops}
+
+exit
+''')
+
+# Oracle script that creates the tables of a checkpointed run.  They are
+# permanent tables (unlike the working tables of other runs) so that
+# each phase of the run can run in its own session and a failed run can
+# resume from the phase that failed.
+oracleCheckpointTablesScriptTemplate = '''
+-- Create the tables of the run
+exec dbms_output.put_line('metric,create_tables,' || systimestamp);
+${checkpointTablesDrops}
+create table ${drugIdsTableName} (
+    id number(15) not null,
+    constraint ${drugIdsTableName}_pk primary key (id)
+);
+
+create table ${condIdsTableName} (
+    id number(15) not null,
+    constraint ${condIdsTableName}_pk primary key (id)
+);
+
+create table ${firstDrugsTableName} (
+    person number(15) not null,
+    drug number(15) not null,
+    drug_date date not null
+);
+
+create table ${firstCondsTableName} (
+    person number(15) not null,
+    cond number(15) not null,
+    cond_date date not null
+);
+
+create table ${firstDrugsCondsTableName} (
+    person number(15) not null,
+    drug number(15) not null,
+    cond number(15) not null,
+    drug_date date not null,
+    cond_date date not null
+);
+
+-- Create a type for column literals so that lists of drug and condition
+-- IDs can be loaded in chunks
+create or replace type number15_table as table of number(15);
+/
+'''
+
+# The phases of a checkpointed run in order.  Each phase first empties
+# the tables it fills so that it can be retried after a failure.
+oracleCheckpointPhaseTemplates = collections.OrderedDict((
+    ('setup', (oracleCheckpointTablesScriptTemplate
+               + oracleResultsTablesScriptTemplate
+               + oracleLoadIdsScriptTemplate)),
+    ('first_drugs', ('\ntruncate table ${firstDrugsTableName};\n'
+                     + oracleFirstDrugsScriptTemplate)),
+    ('first_conds', ('\ntruncate table ${firstCondsTableName};\n'
+                     + oracleFirstCondsScriptTemplate)),
+    ('first_drugs_conds', ('\ntruncate table ${firstDrugsCondsTableName};\n'
+                           + oracleJoinScriptTemplate)),
+    ('marginals', ('\ntruncate table ${drugMarginalsTableName};\n'
+                   'truncate table ${condMarginalsTableName};\n'
+                   + oracleMarginalsScriptTemplate)),
+    ('pair_counts', ('\ntruncate table ${countsScoresTableName};\n'
+                     + oraclePairCountsScriptTemplate)),
+    ('scores', oracleScoresScriptTemplate),
+    ))
+
+# Ends each phase of a checkpointed run
+oracleCheckpointPhaseEndScript = (
+    oracleCommitScript
+    + '''
+exec dbms_output.put_line('metric,end,' || systimestamp);
+exit
+''')
+
+# Oracle script that reports the results of a checkpointed run and then
+# drops its tables
+oracleCheckpointReportScriptTemplate = (
+    oracleHeaderScriptTemplate
+    + oracleReportScriptTemplate
+    + '''
+-- Clean up: drop the tables of the run except the results tables
+exec dbms_output.put_line('metric,cleanup,' || systimestamp);
+${checkpointTablesDrops}
+drop type number15_table;
+
+exec dbms_output.put_line('metric,end,' || systimestamp);
+exit
+''')
+
+# Report commands of the Oracle script that write the report to a file
+oracleSpoolReportTemplate = '''-- Write counts and scores to a file
+set termout off
 spool ${reportFileName}
 select *
-from ${countsScoresTableName}
+from ${reportRowsSource}
 order by drug, cond;
 spool off
+${marginalsSpools}
 -- See errors again
+set termout on'''
+
+# Report commands of the Oracle script that write the report to
+# standard output.  Each row starts with a marker to tell it apart from
+# any other output.
+oracleStreamReportTemplate = '''-- Write marginals to files
+set termout off
+${marginalsSpools}
+set termout on
+
+-- Write counts and scores to standard output
+select '${reportRowMarker}' as marker, cs.*
+from ${reportRowsSource} cs
+order by drug, cond;'''
+
+oracleReportRowMarker = 'row'
+
+# Report commands of the Oracle sweep script that write the report of a
+# configuration to standard output with the configuration in each row
+oracleSweepReportTemplate = '''-- Write marginals to files
+set termout off
+${marginalsSpools}
 set termout on
 
--- Clean up: drop all things except results table
-drop table first_drugs;
-drop table first_conds;
-drop table first_drugs_conds;
-drop type number15_table;
+-- Write counts and scores to standard output
+select '${reportRowMarker}' as marker, ${config} as config, cs.*
+from ${countsScoresTableName} cs
+order by drug, cond;'''
+
+# Statements that empty the results tables before counting another
+# configuration of a sweep
+sweepClearScriptTemplate = '''
+-- Clear the results of the previous configuration
+delete from ${drugMarginalsTableName};
+delete from ${condMarginalsTableName};
+delete from ${countsScoresTableName};
+'''
+
+# The join of first occurrences for a configuration of a sweep.  The
+# shared join has unshifted drug dates and the widest window of all the
+# configurations, so the drug dates are shifted by the configuration's
+# offset and the rows outside its window are left out.
+sweepDrugsCondsTemplate = '''(select person, drug, cond,
+                  (drug_date + ${drugOccurrenceOffset}) as drug_date,
+                  cond_date
+           from first_drugs_conds
+           where cond_date >= (drug_date + ${joinWindowStart})
+             and cond_date <= (drug_date + ${joinWindowEnd}))'''
+
+# The SQLite script in parts like the Oracle script
+sqliteWorkTablesScriptTemplate = '''
+-- Script that collects counts of drugs and conditions in their temporal
+-- orders and uses them to compute adverse drug event likelihood scores.
+-- SQLite version of the Oracle script.  Expects the temporary tables
+-- drug_ids and cond_ids to contain the drug and condition IDs.  Dates
+-- are compared as Julian day numbers.
+
+-- Create temporary tables
+drop table if exists temp.first_drugs;
+create temporary table first_drugs (
+    person integer not null,
+    drug integer not null,
+    drug_date real not null
+);
+
+drop table if exists temp.first_conds;
+create temporary table first_conds (
+    person integer not null,
+    cond integer not null,
+    cond_date real not null
+);
+
+drop table if exists temp.first_drugs_conds;
+create temporary table first_drugs_conds (
+    person integer not null,
+    drug integer not null,
+    cond integer not null,
+    drug_date real not null,
+    cond_date real not null
+);
+'''
+
+sqliteMarginalsTablesScriptTemplate = '''
+-- Create tables to hold the counts of people for each drug and for
+-- each condition
+drop table if exists ${drugMarginalsTableName};
+create table ${drugMarginalsTableName} (
+    drug integer not null, -- Drug ID
+    ct_d_bef_anyc integer, -- Count people having drug before any condition
+    ct_d_anyc integer, -- Count people having drug and any condition
+    ct_d integer, -- Count people having drug
+    ct_ppl integer -- Count people
+);
+
+drop table if exists ${condMarginalsTableName};
+create table ${condMarginalsTableName} (
+    cond integer not null, -- Condition ID
+    ct_anyd_bef_c integer, -- Count people having any drug before condition
+    ct_anyd_c integer, -- Count people having any drug and condition
+    ct_c integer, -- Count people having condition
+    ct_ppl integer -- Count people
+);
+'''
+
+sqliteCountsTableScriptTemplate = '''
+-- Create table to hold counts and scores
+drop table if exists ${countsScoresTableName};
+create table ${countsScoresTableName} (
+    drug integer not null, -- Drug ID
+    cond integer not null, -- Condition ID
+    -- Temporal score fields
+    ct_d_bef_c integer, -- Count people having drug before condition
+    ct_c_bef_d integer, -- Count people having condition before drug
+    ct_d_c integer, -- Count people having drug and condition
+    ct_d_bef_anyc integer, -- Count people having drug before any condition
+    ct_d_anyc integer, -- Count people having drug and any condition
+    ct_anyd_bef_c integer, -- Count people having any drug before condition
+    ct_anyd_c integer, -- Count people having any drug and condition
+    -- Totals fields that can be used to construct a 2x2 table (with ct_d_c above)
+    ct_d integer, -- Count people having drug
+    ct_c integer, -- Count people having condition
+    ct_ppl integer, -- Count people
+    -- Scores based on above counts
+    temporal_score real
+);
+'''
+
+sqliteLoadScriptTemplate = '''
+-- Find all the first drug occurrences (from the era table or the cache)
+insert into first_drugs
+${firstDrugsQuery};
+
+create index temp.first_drugs_person_idx on first_drugs (person);
+
+-- Find all the first condition occurrences
+insert into first_conds
+${firstCondsQuery};
+
+create index temp.first_conds_person_idx on first_conds (person);
+
+-- Put the first drug occurrences and first condition occurrences together
+insert into first_drugs_conds
+select fd.person, fd.drug, fc.cond, fd.drug_date, fc.cond_date
+from first_drugs fd
+join first_conds fc
+  on fd.person = fc.person
+ and fc.cond_date >= (fd.drug_date + ${conditionWindowStart})
+ and fc.cond_date <= (fd.drug_date + ${conditionWindowEnd});
+'''
+
+sqliteMarginalsScriptTemplate = '''
+-- Count people for each drug and each condition (as in the Oracle
+-- script)
+insert into ${drugMarginalsTableName}
+    (drug, ct_d_bef_anyc, ct_d_anyc, ct_d, ct_ppl)
+select drugs.id as drug,
+       ifnull(drug_any_cts.ct_d_bef_anyc, 0),
+       ifnull(drug_any_cts.ct_d_anyc, 0),
+       ifnull(drug_cts.ct_d, 0),
+       ppl_cts.ct_ppl
+from drug_ids drugs
+-- Patients
+cross join
+    (select count(*) as ct_ppl
+     from (select person from first_drugs
+           union
+           select person from first_conds)) ppl_cts
+-- Drug before any condition, drug and any condition
+left join
+    (select drug,
+            count(distinct case when drug_date < cond_date then person end) as ct_d_bef_anyc,
+            count(distinct person) as ct_d_anyc
+     from ${firstDrugsConds}
+     group by drug) drug_any_cts
+  on drug_any_cts.drug = drugs.id
+-- Drugs
+left join
+    (select drug, count(*) as ct_d
+     from first_drugs
+     group by drug) drug_cts
+  on drug_cts.drug = drugs.id;
+
+insert into ${condMarginalsTableName}
+    (cond, ct_anyd_bef_c, ct_anyd_c, ct_c, ct_ppl)
+select conds.id as cond,
+       ifnull(cond_any_cts.ct_anyd_bef_c, 0),
+       ifnull(cond_any_cts.ct_anyd_c, 0),
+       ifnull(cond_cts.ct_c, 0),
+       ppl_cts.ct_ppl
+from cond_ids conds
+-- Patients
+cross join
+    (select count(*) as ct_ppl
+     from (select person from first_drugs
+           union
+           select person from first_conds)) ppl_cts
+-- Any drug before condition, any drug and condition
+left join
+    (select cond,
+            count(distinct case when drug_date < cond_date then person end) as ct_anyd_bef_c,
+            count(distinct person) as ct_anyd_c
+     from ${firstDrugsConds}
+     group by cond) cond_any_cts
+  on cond_any_cts.cond = conds.id
+-- Conditions
+left join
+    (select cond, count(*) as ct_c
+     from first_conds
+     group by cond) cond_cts
+  on cond_cts.cond = conds.id;
+'''
+
+sqlitePairCountsScriptTemplate = '''
+-- Count people for each pair (as in the Oracle script)
+insert into ${countsScoresTableName}
+    (drug, cond,
+     ct_d_bef_c, ct_c_bef_d, ct_d_c,
+     ct_d_bef_anyc, ct_d_anyc, ct_anyd_bef_c, ct_anyd_c,
+     ct_d, ct_c, ct_ppl,
+     temporal_score)
+select dm.drug,
+       cm.cond,
+       ifnull(pair_cts.ct_d_bef_c, 0),
+       ifnull(pair_cts.ct_c_bef_d, 0),
+       ifnull(pair_cts.ct_d_c, 0),
+       dm.ct_d_bef_anyc,
+       dm.ct_d_anyc,
+       cm.ct_anyd_bef_c,
+       cm.ct_anyd_c,
+       dm.ct_d,
+       cm.ct_c,
+       dm.ct_ppl,
+       0.0
+from ${drugMarginalsTableName} dm,
+     ${condMarginalsTableName} cm
+-- Drug before condition, condition before drug, drug and condition
+${pairCountsJoin}
+    (select drug, cond,
+            sum(case when drug_date < cond_date then 1 else 0 end) as ct_d_bef_c,
+            sum(case when drug_date >= cond_date then 1 else 0 end) as ct_c_bef_d,
+            count(*) as ct_d_c
+     from ${firstDrugsConds}${pairCountsWhere}
+     group by drug, cond${pairCountsHaving}) pair_cts
+  on pair_cts.drug = dm.drug
+ and pair_cts.cond = cm.cond;
+'''
+
+sqliteSetupScriptTemplate = (
+    sqliteWorkTablesScriptTemplate
+    + sqliteMarginalsTablesScriptTemplate
+    + sqliteCountsTableScriptTemplate
+    + sqliteLoadScriptTemplate
+    )
+
+sqliteCountsScriptTemplate = (
+    sqliteMarginalsScriptTemplate
+    + sqlitePairCountsScriptTemplate
+    )
+
+sqliteScoresScriptTemplate = '''
+-- Compute temporal scores.  The pseudocount is a real to avoid integer
+-- division.
+update ${countsScoresTableName}
+set temporal_score =
+    (((ct_d_bef_c + ${pseudocount}) / (ct_d_c + ${pseudocount} + ${pseudocount}))
+     / ((ct_d_bef_anyc + ${pseudocount}) / (ct_d_anyc + ${pseudocount} + ${pseudocount})
+      * (ct_anyd_bef_c + ${pseudocount}) / (ct_anyd_c + ${pseudocount} + ${pseudocount}))
+    );
+'''
+
+sqliteScriptTemplate = (
+    sqliteSetupScriptTemplate
+    + sqliteCountsScriptTemplate
+    + sqliteScoresScriptTemplate
+    )
+
+# SQLite script that adds new drug and condition IDs to the results of
+# previous runs (incremental mode).  Expects the temporary tables new_drug_ids and
+# new_cond_ids to contain the given IDs.  The scored IDs, first
+# occurrences, and their join are kept in tables named after the counts
+# table so that later runs only have to process the new IDs.  A first
+# run starts from empty state and so computes everything.  The state is
+# checked against the settings and era data of the run beforehand (see
+# sqliteCheckIncrementalState).
+sqliteIncrementalScriptTemplate = '''
+-- Create the tables that keep state between runs (if they do not exist)
+create table if not exists ${countsScoresTableName}_drug_ids (
+    id integer primary key
+);
+
+create table if not exists ${countsScoresTableName}_cond_ids (
+    id integer primary key
+);
+
+create table if not exists ${countsScoresTableName}_fd (
+    person integer not null,
+    drug integer not null,
+    drug_date real not null
+);
+create index if not exists ${countsScoresTableName}_fd_person_idx
+    on ${countsScoresTableName}_fd (person);
+create index if not exists ${countsScoresTableName}_fd_drug_idx
+    on ${countsScoresTableName}_fd (drug);
+
+create table if not exists ${countsScoresTableName}_fc (
+    person integer not null,
+    cond integer not null,
+    cond_date real not null
+);
+create index if not exists ${countsScoresTableName}_fc_person_idx
+    on ${countsScoresTableName}_fc (person);
+create index if not exists ${countsScoresTableName}_fc_cond_idx
+    on ${countsScoresTableName}_fc (cond);
+
+create table if not exists ${countsScoresTableName}_fdc (
+    person integer not null,
+    drug integer not null,
+    cond integer not null,
+    drug_date real not null,
+    cond_date real not null
+);
+create index if not exists ${countsScoresTableName}_fdc_drug_idx
+    on ${countsScoresTableName}_fdc (drug);
+create index if not exists ${countsScoresTableName}_fdc_cond_idx
+    on ${countsScoresTableName}_fdc (cond);
+
+create table if not exists ${drugMarginalsTableName} (
+    drug integer not null, -- Drug ID
+    ct_d_bef_anyc integer, -- Count people having drug before any condition
+    ct_d_anyc integer, -- Count people having drug and any condition
+    ct_d integer, -- Count people having drug
+    ct_ppl integer -- Count people
+);
+
+create table if not exists ${condMarginalsTableName} (
+    cond integer not null, -- Condition ID
+    ct_anyd_bef_c integer, -- Count people having any drug before condition
+    ct_anyd_c integer, -- Count people having any drug and condition
+    ct_c integer, -- Count people having condition
+    ct_ppl integer -- Count people
+);
+
+-- Same columns as in the full script
+create table if not exists ${countsScoresTableName} (
+    drug integer not null, -- Drug ID
+    cond integer not null, -- Condition ID
+    ct_d_bef_c integer,
+    ct_c_bef_d integer,
+    ct_d_c integer,
+    ct_d_bef_anyc integer,
+    ct_d_anyc integer,
+    ct_anyd_bef_c integer,
+    ct_anyd_c integer,
+    ct_d integer,
+    ct_c integer,
+    ct_ppl integer,
+    temporal_score real
+);
+
+-- Only keep the IDs that have not been scored before
+delete from new_drug_ids
+where id in (select id from ${countsScoresTableName}_drug_ids);
+
+delete from new_cond_ids
+where id in (select id from ${countsScoresTableName}_cond_ids);
+
+insert into ${countsScoresTableName}_drug_ids (id)
+select id from new_drug_ids;
+
+insert into ${countsScoresTableName}_cond_ids (id)
+select id from new_cond_ids;
+
+-- Find the first occurrences of the new drugs and new conditions
+insert into ${countsScoresTableName}_fd
+select de.person_id as person,
+       de.drug_concept_id as drug,
+       (julianday(min(de.drug_era_start_date)) + ${drugOccurrenceOffset}) as drug_date
+from ${drugEraTableName} de
+join new_drug_ids ids on ids.id = de.drug_concept_id
+group by de.person_id, de.drug_concept_id;
+
+insert into ${countsScoresTableName}_fc
+select ce.person_id as person,
+       ce.condition_concept_id as cond,
+       julianday(min(ce.condition_era_start_date)) as cond_date
+from ${condEraTableName} ce
+join new_cond_ids ids on ids.id = ce.condition_concept_id
+group by ce.person_id, ce.condition_concept_id;
+
+-- Join the first occurrences of the new drugs with those of all the
+-- conditions and those of the new conditions with those of the old
+-- drugs
+insert into ${countsScoresTableName}_fdc
+select fd.person, fd.drug, fc.cond, fd.drug_date, fc.cond_date
+from new_drug_ids nd
+join ${countsScoresTableName}_fd fd
+  on fd.drug = nd.id
+join ${countsScoresTableName}_fc fc
+  on fc.person = fd.person
+ and fc.cond_date >= (fd.drug_date + ${conditionWindowStart})
+ and fc.cond_date <= (fd.drug_date + ${conditionWindowEnd})
+union all
+select fd.person, fd.drug, fc.cond, fd.drug_date, fc.cond_date
+from new_cond_ids nc
+join ${countsScoresTableName}_fc fc
+  on fc.cond = nc.id
+join ${countsScoresTableName}_fd fd
+  on fd.person = fc.person
+ and fc.cond_date >= (fd.drug_date + ${conditionWindowStart})
+ and fc.cond_date <= (fd.drug_date + ${conditionWindowEnd})
+where fd.drug not in (select id from new_drug_ids);
+
+-- Recount the people for each drug and each condition.  New drugs
+-- change the counts of any drug and new conditions change the counts
+-- of any condition.  Both can change the count of people.
+delete from ${drugMarginalsTableName};
+
+insert into ${drugMarginalsTableName}
+    (drug, ct_d_bef_anyc, ct_d_anyc, ct_d, ct_ppl)
+select drugs.id as drug,
+       ifnull(drug_any_cts.ct_d_bef_anyc, 0),
+       ifnull(drug_any_cts.ct_d_anyc, 0),
+       ifnull(drug_cts.ct_d, 0),
+       ppl_cts.ct_ppl
+from ${countsScoresTableName}_drug_ids drugs
+cross join
+    (select count(*) as ct_ppl
+     from (select person from ${countsScoresTableName}_fd
+           union
+           select person from ${countsScoresTableName}_fc)) ppl_cts
+left join
+    (select drug,
+            count(distinct case when drug_date < cond_date then person end) as ct_d_bef_anyc,
+            count(distinct person) as ct_d_anyc
+     from ${countsScoresTableName}_fdc
+     group by drug) drug_any_cts
+  on drug_any_cts.drug = drugs.id
+left join
+    (select drug, count(*) as ct_d
+     from ${countsScoresTableName}_fd
+     group by drug) drug_cts
+  on drug_cts.drug = drugs.id;
+
+delete from ${condMarginalsTableName};
+
+insert into ${condMarginalsTableName}
+    (cond, ct_anyd_bef_c, ct_anyd_c, ct_c, ct_ppl)
+select conds.id as cond,
+       ifnull(cond_any_cts.ct_anyd_bef_c, 0),
+       ifnull(cond_any_cts.ct_anyd_c, 0),
+       ifnull(cond_cts.ct_c, 0),
+       ppl_cts.ct_ppl
+from ${countsScoresTableName}_cond_ids conds
+cross join
+    (select count(*) as ct_ppl
+     from (select person from ${countsScoresTableName}_fd
+           union
+           select person from ${countsScoresTableName}_fc)) ppl_cts
+left join
+    (select cond,
+            count(distinct case when drug_date < cond_date then person end) as ct_anyd_bef_c,
+            count(distinct person) as ct_anyd_c
+     from ${countsScoresTableName}_fdc
+     group by cond) cond_any_cts
+  on cond_any_cts.cond = conds.id
+left join
+    (select cond, count(*) as ct_c
+     from ${countsScoresTableName}_fc
+     group by cond) cond_cts
+  on cond_cts.cond = conds.id;
+
+-- Refresh the marginals of the existing pairs
+update ${countsScoresTableName}
+set (ct_d_bef_anyc, ct_d_anyc, ct_d, ct_ppl) =
+    (select dm.ct_d_bef_anyc, dm.ct_d_anyc, dm.ct_d, dm.ct_ppl
+     from ${drugMarginalsTableName} dm
+     where dm.drug = ${countsScoresTableName}.drug),
+    (ct_anyd_bef_c, ct_anyd_c, ct_c) =
+    (select cm.ct_anyd_bef_c, cm.ct_anyd_c, cm.ct_c
+     from ${condMarginalsTableName} cm
+     where cm.cond = ${countsScoresTableName}.cond);
+
+-- Insert the pairs that have a new drug or a new condition
+insert into ${countsScoresTableName}
+    (drug, cond,
+     ct_d_bef_c, ct_c_bef_d, ct_d_c,
+     ct_d_bef_anyc, ct_d_anyc, ct_anyd_bef_c, ct_anyd_c,
+     ct_d, ct_c, ct_ppl,
+     temporal_score)
+select dm.drug,
+       cm.cond,
+       ifnull(pair_cts.ct_d_bef_c, 0),
+       ifnull(pair_cts.ct_c_bef_d, 0),
+       ifnull(pair_cts.ct_d_c, 0),
+       dm.ct_d_bef_anyc,
+       dm.ct_d_anyc,
+       cm.ct_anyd_bef_c,
+       cm.ct_anyd_c,
+       dm.ct_d,
+       cm.ct_c,
+       dm.ct_ppl,
+       0.0
+from ${drugMarginalsTableName} dm,
+     ${condMarginalsTableName} cm
+${pairCountsJoin}
+    (select drug, cond,
+            sum(case when drug_date < cond_date then 1 else 0 end) as ct_d_bef_c,
+            sum(case when drug_date >= cond_date then 1 else 0 end) as ct_c_bef_d,
+            count(*) as ct_d_c
+     from ${countsScoresTableName}_fdc
+     where drug in (select id from new_drug_ids)
+        or cond in (select id from new_cond_ids)
+     group by drug, cond) pair_cts
+  on pair_cts.drug = dm.drug
+ and pair_cts.cond = cm.cond
+where dm.drug in (select id from new_drug_ids)
+   or cm.cond in (select id from new_cond_ids);
+
+-- Compute temporal scores (of all pairs because the marginals changed)
+update ${countsScoresTableName}
+set temporal_score =
+    (((ct_d_bef_c + ${pseudocount}) / (ct_d_c + ${pseudocount} + ${pseudocount}))
+     / ((ct_d_bef_anyc + ${pseudocount}) / (ct_d_anyc + ${pseudocount} + ${pseudocount})
+      * (ct_anyd_bef_c + ${pseudocount}) / (ct_anyd_c + ${pseudocount} + ${pseudocount}))
+    );
+'''
+
+# Oracle version of the incremental script.  Expects the IDs inserts
+# to load the given IDs into new_drug_ids and new_cond_ids.
+oracleIncrementalScriptTemplate = '''
+-- Script that adds new drug and condition IDs to the results of
+-- previous runs (Oracle version of the SQLite incremental script)
+
+-- Session parameters
+whenever sqlerror exit sql.sqlcode;
+set autocommit off
+set echo off
+set feedback off
+set trimout on
+set trimspool on
+
+-- Switch to the specified schema
+alter session set current_schema = ${dbSchemaName};
+
+-- Create the staging tables for the given IDs
+begin
+  execute immediate 'drop table new_drug_ids';
+exception
+  when others then if sqlcode != -0942 then raise; end if;
+end;
+/
+create global temporary table new_drug_ids (
+    id number(15) not null,
+    constraint new_drug_ids_pk primary key (id)
+);
+
+begin
+  execute immediate 'drop table new_cond_ids';
+exception
+  when others then if sqlcode != -0942 then raise; end if;
+end;
+/
+create global temporary table new_cond_ids (
+    id number(15) not null,
+    constraint new_cond_ids_pk primary key (id)
+);
+
+-- Create the tables that keep state between runs (if they do not
+-- exist).  Use PLSQL to emulate "create table if not exists".  All DDL
+-- comes before loading the staging tables because DDL commits, which
+-- empties temporary tables.
+begin
+  execute immediate 'create table ${countsScoresTableName}_drug_ids (id number(15) not null, constraint ${countsScoresTableName}_drug_ids_pk primary key (id))';
+exception
+  when others then if sqlcode != -0955 then raise; end if;
+end;
+/
+
+begin
+  execute immediate 'create table ${countsScoresTableName}_cond_ids (id number(15) not null, constraint ${countsScoresTableName}_cond_ids_pk primary key (id))';
+exception
+  when others then if sqlcode != -0955 then raise; end if;
+end;
+/
+
+begin
+  execute immediate 'create table ${countsScoresTableName}_fd (person number(15) not null, drug number(15) not null, drug_date date not null)';
+exception
+  when others then if sqlcode != -0955 then raise; end if;
+end;
+/
+
+begin
+  execute immediate 'create index ${countsScoresTableName}_fd_person_idx on ${countsScoresTableName}_fd (person)';
+exception
+  when others then if sqlcode != -0955 then raise; end if;
+end;
+/
+
+begin
+  execute immediate 'create index ${countsScoresTableName}_fd_drug_idx on ${countsScoresTableName}_fd (drug)';
+exception
+  when others then if sqlcode != -0955 then raise; end if;
+end;
+/
+
+begin
+  execute immediate 'create table ${countsScoresTableName}_fc (person number(15) not null, cond number(15) not null, cond_date date not null)';
+exception
+  when others then if sqlcode != -0955 then raise; end if;
+end;
+/
+
+begin
+  execute immediate 'create index ${countsScoresTableName}_fc_person_idx on ${countsScoresTableName}_fc (person)';
+exception
+  when others then if sqlcode != -0955 then raise; end if;
+end;
+/
+
+begin
+  execute immediate 'create index ${countsScoresTableName}_fc_cond_idx on ${countsScoresTableName}_fc (cond)';
+exception
+  when others then if sqlcode != -0955 then raise; end if;
+end;
+/
+
+begin
+  execute immediate 'create table ${countsScoresTableName}_fdc (person number(15) not null, drug number(15) not null, cond number(15) not null, drug_date date not null, cond_date date not null)';
+exception
+  when others then if sqlcode != -0955 then raise; end if;
+end;
+/
+
+begin
+  execute immediate 'create index ${countsScoresTableName}_fdc_drug_idx on ${countsScoresTableName}_fdc (drug)';
+exception
+  when others then if sqlcode != -0955 then raise; end if;
+end;
+/
+
+begin
+  execute immediate 'create index ${countsScoresTableName}_fdc_cond_idx on ${countsScoresTableName}_fdc (cond)';
+exception
+  when others then if sqlcode != -0955 then raise; end if;
+end;
+/
+
+begin
+  execute immediate 'create table ${drugMarginalsTableName} (drug number(15) not null, ct_d_bef_anyc number(9), ct_d_anyc number(9), ct_d number(9), ct_ppl number(9))';
+exception
+  when others then if sqlcode != -0955 then raise; end if;
+end;
+/
+
+begin
+  execute immediate 'create table ${condMarginalsTableName} (cond number(15) not null, ct_anyd_bef_c number(9), ct_anyd_c number(9), ct_c number(9), ct_ppl number(9))';
+exception
+  when others then if sqlcode != -0955 then raise; end if;
+end;
+/
+
+begin
+  execute immediate 'create table ${countsScoresTableName} (drug number(15) not null, cond number(15) not null, ct_d_bef_c number(9), ct_c_bef_d number(9), ct_d_c number(9), ct_d_bef_anyc number(9), ct_d_anyc number(9), ct_anyd_bef_c number(9), ct_anyd_c number(9), ct_d number(9), ct_c number(9), ct_ppl number(9), temporal_score real)';
+exception
+  when others then if sqlcode != -0955 then raise; end if;
+end;
+/
+
+begin
+  execute immediate 'create table ${countsScoresTableName}_state (window_start number(9), window_end number(9), occ_offset number(9), drug_eras varchar2(100), cond_eras varchar2(100))';
+exception
+  when others then if sqlcode != -0955 then raise; end if;
+end;
+/
+
+-- Create a type for column literals so that lists of drug and condition
+-- IDs can be loaded in chunks
+create or replace type number15_table as table of number(15);
+/
+
+-- Load the given drug and condition IDs into the staging tables
+${drugIdsInserts}
+${condIdsInserts}
+
+-- Check that the state was built with the same window, offset, and era
+-- data (row count and maximum start date of each era table) as this
+-- run.  If not, discard it and stage the IDs scored so far with the
+-- given ones so that this run rebuilds everything.
+declare
+  v_drug_eras varchar2(100);
+  v_cond_eras varchar2(100);
+  v_matches number;
+begin
+  select count(*) || ':' || to_char(max(drug_era_start_date), 'YYYY-MM-DD')
+  into v_drug_eras
+  from ${drugEraTableName};
+  select count(*) || ':' || to_char(max(condition_era_start_date), 'YYYY-MM-DD')
+  into v_cond_eras
+  from ${condEraTableName};
+  select count(*) into v_matches
+  from ${countsScoresTableName}_state
+  where window_start = ${conditionWindowStart}
+    and window_end = ${conditionWindowEnd}
+    and occ_offset = ${drugOccurrenceOffset}
+    and drug_eras = v_drug_eras
+    and cond_eras = v_cond_eras;
+  if v_matches = 0 then
+    insert into new_drug_ids (id)
+    select id from ${countsScoresTableName}_drug_ids
+    where id not in (select id from new_drug_ids);
+    insert into new_cond_ids (id)
+    select id from ${countsScoresTableName}_cond_ids
+    where id not in (select id from new_cond_ids);
+    delete from ${countsScoresTableName}_drug_ids;
+    delete from ${countsScoresTableName}_cond_ids;
+    delete from ${countsScoresTableName}_fd;
+    delete from ${countsScoresTableName}_fc;
+    delete from ${countsScoresTableName}_fdc;
+    delete from ${countsScoresTableName};
+    delete from ${countsScoresTableName}_state;
+    insert into ${countsScoresTableName}_state
+        (window_start, window_end, occ_offset, drug_eras, cond_eras)
+    values (${conditionWindowStart}, ${conditionWindowEnd},
+            ${drugOccurrenceOffset}, v_drug_eras, v_cond_eras);
+  end if;
+end;
+/
+
+-- Only keep the IDs that have not been scored before
+delete from new_drug_ids
+where id in (select id from ${countsScoresTableName}_drug_ids);
+
+delete from new_cond_ids
+where id in (select id from ${countsScoresTableName}_cond_ids);
+
+insert into ${countsScoresTableName}_drug_ids (id)
+select id from new_drug_ids;
+
+insert into ${countsScoresTableName}_cond_ids (id)
+select id from new_cond_ids;
+
+-- Find the first occurrences of the new drugs and new conditions
+insert into ${countsScoresTableName}_fd
+select de.person_id as person,
+       de.drug_concept_id as drug,
+       (min(de.drug_era_start_date) + ${drugOccurrenceOffset}) as drug_date
+from ${drugEraTableName} de
+join new_drug_ids ids on ids.id = de.drug_concept_id
+group by de.person_id, de.drug_concept_id;
+
+insert into ${countsScoresTableName}_fc
+select ce.person_id as person,
+       ce.condition_concept_id as cond,
+       min(ce.condition_era_start_date) as cond_date
+from ${condEraTableName} ce
+join new_cond_ids ids on ids.id = ce.condition_concept_id
+group by ce.person_id, ce.condition_concept_id;
+
+-- Join the first occurrences of the new drugs with those of all the
+-- conditions and those of the new conditions with those of the old
+-- drugs
+insert into ${countsScoresTableName}_fdc
+select fd.person, fd.drug, fc.cond, fd.drug_date, fc.cond_date
+from new_drug_ids nd
+join ${countsScoresTableName}_fd fd
+  on fd.drug = nd.id
+join ${countsScoresTableName}_fc fc
+  on fc.person = fd.person
+ and fc.cond_date >= (fd.drug_date + ${conditionWindowStart})
+ and fc.cond_date <= (fd.drug_date + ${conditionWindowEnd})
+union all
+select fd.person, fd.drug, fc.cond, fd.drug_date, fc.cond_date
+from new_cond_ids nc
+join ${countsScoresTableName}_fc fc
+  on fc.cond = nc.id
+join ${countsScoresTableName}_fd fd
+  on fd.person = fc.person
+ and fc.cond_date >= (fd.drug_date + ${conditionWindowStart})
+ and fc.cond_date <= (fd.drug_date + ${conditionWindowEnd})
+where fd.drug not in (select id from new_drug_ids);
+
+-- Recount the people for each drug and each condition.  New drugs
+-- change the counts of any drug and new conditions change the counts
+-- of any condition.  Both can change the count of people.
+delete from ${drugMarginalsTableName};
+
+insert into ${drugMarginalsTableName}
+    (drug, ct_d_bef_anyc, ct_d_anyc, ct_d, ct_ppl)
+select drugs.id as drug,
+       nvl(drug_any_cts.ct_d_bef_anyc, 0),
+       nvl(drug_any_cts.ct_d_anyc, 0),
+       nvl(drug_cts.ct_d, 0),
+       ppl_cts.ct_ppl
+from ${countsScoresTableName}_drug_ids drugs
+cross join
+    (select count(*) as ct_ppl
+     from (select person from ${countsScoresTableName}_fd
+           union
+           select person from ${countsScoresTableName}_fc)) ppl_cts
+left join
+    (select drug,
+            count(distinct case when drug_date < cond_date then person end) as ct_d_bef_anyc,
+            count(distinct person) as ct_d_anyc
+     from ${countsScoresTableName}_fdc
+     group by drug) drug_any_cts
+  on drug_any_cts.drug = drugs.id
+left join
+    (select drug, count(*) as ct_d
+     from ${countsScoresTableName}_fd
+     group by drug) drug_cts
+  on drug_cts.drug = drugs.id;
+
+delete from ${condMarginalsTableName};
+
+insert into ${condMarginalsTableName}
+    (cond, ct_anyd_bef_c, ct_anyd_c, ct_c, ct_ppl)
+select conds.id as cond,
+       nvl(cond_any_cts.ct_anyd_bef_c, 0),
+       nvl(cond_any_cts.ct_anyd_c, 0),
+       nvl(cond_cts.ct_c, 0),
+       ppl_cts.ct_ppl
+from ${countsScoresTableName}_cond_ids conds
+cross join
+    (select count(*) as ct_ppl
+     from (select person from ${countsScoresTableName}_fd
+           union
+           select person from ${countsScoresTableName}_fc)) ppl_cts
+left join
+    (select cond,
+            count(distinct case when drug_date < cond_date then person end) as ct_anyd_bef_c,
+            count(distinct person) as ct_anyd_c
+     from ${countsScoresTableName}_fdc
+     group by cond) cond_any_cts
+  on cond_any_cts.cond = conds.id
+left join
+    (select cond, count(*) as ct_c
+     from ${countsScoresTableName}_fc
+     group by cond) cond_cts
+  on cond_cts.cond = conds.id;
+
+-- Refresh the marginals of the existing pairs
+update ${countsScoresTableName} cst
+set (ct_d_bef_anyc, ct_d_anyc, ct_d, ct_ppl) =
+    (select dm.ct_d_bef_anyc, dm.ct_d_anyc, dm.ct_d, dm.ct_ppl
+     from ${drugMarginalsTableName} dm
+     where dm.drug = cst.drug),
+    (ct_anyd_bef_c, ct_anyd_c, ct_c) =
+    (select cm.ct_anyd_bef_c, cm.ct_anyd_c, cm.ct_c
+     from ${condMarginalsTableName} cm
+     where cm.cond = cst.cond);
+
+-- Insert the pairs that have a new drug or a new condition
+insert into ${countsScoresTableName}
+    (drug, cond,
+     ct_d_bef_c, ct_c_bef_d, ct_d_c,
+     ct_d_bef_anyc, ct_d_anyc, ct_anyd_bef_c, ct_anyd_c,
+     ct_d, ct_c, ct_ppl,
+     temporal_score)
+select dm.drug,
+       cm.cond,
+       nvl(pair_cts.ct_d_bef_c, 0),
+       nvl(pair_cts.ct_c_bef_d, 0),
+       nvl(pair_cts.ct_d_c, 0),
+       dm.ct_d_bef_anyc,
+       dm.ct_d_anyc,
+       cm.ct_anyd_bef_c,
+       cm.ct_anyd_c,
+       dm.ct_d,
+       cm.ct_c,
+       dm.ct_ppl,
+       0.0
+from ${drugMarginalsTableName} dm
+cross join ${condMarginalsTableName} cm
+${pairCountsJoin}
+    (select drug, cond,
+            sum(case when drug_date < cond_date then 1 else 0 end) as ct_d_bef_c,
+            sum(case when drug_date >= cond_date then 1 else 0 end) as ct_c_bef_d,
+            count(*) as ct_d_c
+     from ${countsScoresTableName}_fdc
+     where drug in (select id from new_drug_ids)
+        or cond in (select id from new_cond_ids)
+     group by drug, cond) pair_cts
+  on pair_cts.drug = dm.drug
+ and pair_cts.cond = cm.cond
+where dm.drug in (select id from new_drug_ids)
+   or cm.cond in (select id from new_cond_ids);
+
+-- Compute temporal scores (of all pairs because the marginals changed)
+update ${countsScoresTableName} cst
+set temporal_score =
+    (((ct_d_bef_c + ${pseudocount}) / (ct_d_c + ${pseudocount} + ${pseudocount}))
+     / ((ct_d_bef_anyc + ${pseudocount}) / (ct_d_anyc + ${pseudocount} + ${pseudocount})
+      * (ct_anyd_bef_c + ${pseudocount}) / (ct_anyd_c + ${pseudocount} + ${pseudocount}))
+    );
+
+-- End transaction
+commit;
+
+-- Set parameters for CSV-like output
+set pagesize 0
+set linesize 1000
+set numwidth 15
+set null ''
+set colsep ,
+
+${reportCommands}
+
+-- Clean up: drop the staging tables and the type
+drop table new_drug_ids;
+drop table new_cond_ids;
+drop type number15_table;
+
+exit
+'''
+
+# Scripts of normalized runs.  The results table only has the columns
+# of the pairs, whose scores are computed as they are inserted from
+# their counts and the marginals tables they are joined with.  The
+# report joins the other columns back from the marginals tables (see
+# normalizedReportRowsTemplate).  The insert is common SQL.
+oracleNormalizedCountsTableScriptTemplate = '''
+-- Create table to hold the pair counts and scores
+begin
+  execute immediate 'drop table ${countsScoresTableName}';
+exception
+  when others then if sqlcode != -0942 then raise; end if;
+end;
+/
+create table ${countsScoresTableName} (
+    drug number(15) not null, -- Drug ID
+    cond number(15) not null, -- Condition ID
+    ct_d_bef_c number(9), -- Count people having drug before condition
+    ct_c_bef_d number(9), -- Count people having condition before drug
+    ct_d_c number(9), -- Count people having drug and condition
+    temporal_score real
+);
+'''
+
+sqliteNormalizedCountsTableScriptTemplate = '''
+-- Create table to hold the pair counts and scores
+drop table if exists ${countsScoresTableName};
+create table ${countsScoresTableName} (
+    drug integer not null, -- Drug ID
+    cond integer not null, -- Condition ID
+    ct_d_bef_c integer, -- Count people having drug before condition
+    ct_c_bef_d integer, -- Count people having condition before drug
+    ct_d_c integer, -- Count people having drug and condition
+    temporal_score real
+);
+'''
+
+normalizedPairCountsScriptTemplate = '''
+-- Insert the drug-condition pairs with their counts of people and
+-- their scores, which use the marginals of their drug and condition
+insert into ${countsScoresTableName}
+    (drug, cond, ct_d_bef_c, ct_c_bef_d, ct_d_c, temporal_score)
+select drug, cond, ct_d_bef_c, ct_c_bef_d, ct_d_c,
+       (((ct_d_bef_c + ${pseudocount}) / (ct_d_c + ${pseudocount} + ${pseudocount}))
+        / ((ct_d_bef_anyc + ${pseudocount}) / (ct_d_anyc + ${pseudocount} + ${pseudocount})
+         * (ct_anyd_bef_c + ${pseudocount}) / (ct_anyd_c + ${pseudocount} + ${pseudocount}))
+       )
+from
+    (select dm.drug,
+            cm.cond,
+            coalesce(pair_cts.ct_d_bef_c, 0) as ct_d_bef_c,
+            coalesce(pair_cts.ct_c_bef_d, 0) as ct_c_bef_d,
+            coalesce(pair_cts.ct_d_c, 0) as ct_d_c,
+            dm.ct_d_bef_anyc,
+            dm.ct_d_anyc,
+            cm.ct_anyd_bef_c,
+            cm.ct_anyd_c
+     from ${drugMarginalsTableName} dm
+     cross join ${condMarginalsTableName} cm
+     -- Drug before condition, condition before drug, drug and condition
+     ${pairCountsJoin}
+         (select drug, cond,
+                 sum(case when drug_date < cond_date then 1 else 0 end) as ct_d_bef_c,
+                 sum(case when drug_date >= cond_date then 1 else 0 end) as ct_c_bef_d,
+                 count(*) as ct_d_c
+          from ${firstDrugsConds}${pairCountsWhere}
+          group by drug, cond${pairCountsHaving}) pair_cts
+       on pair_cts.drug = dm.drug
+      and pair_cts.cond = cm.cond) pairs;
+'''
+
+oracleNormalizedScriptTemplate = (
+    oracleHeaderScriptTemplate
+    + oracleWorkTablesScriptTemplate
+    + oracleMarginalsTablesScriptTemplate
+    + oracleNormalizedCountsTableScriptTemplate
+    + '\n${cacheTablesDdl}'
+    + oracleLoadScriptTemplate
+    + oracleMarginalsScriptTemplate
+    + "\nexec dbms_output.put_line('metric,pair_counts,' || systimestamp);"
+    + normalizedPairCountsScriptTemplate
+    + oracleCommitScript
+    + oracleReportScriptTemplate
+    + oracleCleanupScriptTemplate
+    )
+
+sqliteNormalizedScriptTemplate = (
+    sqliteWorkTablesScriptTemplate
+    + sqliteMarginalsTablesScriptTemplate
+    + sqliteNormalizedCountsTableScriptTemplate
+    + sqliteLoadScriptTemplate
+    + sqliteMarginalsScriptTemplate
+    + normalizedPairCountsScriptTemplate
+    )
+
+# The rows of the report of a normalized run, with the columns of the
+# drug and the condition joined back
+normalizedReportRowsTemplate = '''(select p.drug, p.cond,
+        p.ct_d_bef_c, p.ct_c_bef_d, p.ct_d_c,
+        dm.ct_d_bef_anyc, dm.ct_d_anyc, cm.ct_anyd_bef_c, cm.ct_anyd_c,
+        dm.ct_d, cm.ct_c, dm.ct_ppl,
+        p.temporal_score
+ from ${countsScoresTableName} p
+ join ${drugMarginalsTableName} dm on dm.drug = p.drug
+ join ${condMarginalsTableName} cm on cm.cond = p.cond)'''
+
+# Scripts of stratified runs.  The first occurrences, their join, the
+# marginals, and the counts and scores have the stratum of their records
+# as their first column, and every aggregate is grouped by it, so the
+# counts of each stratum are those of its records alone (as in
+# eraStrata).  The tables are created by dialect and the rest is common
+# SQL.  Strata have the type ${stratumType}.
+oracleStratifiedTablesScriptTemplate = '''
+-- Create temporary tables (as in the unstratified script)
+begin
+  execute immediate 'drop table drug_ids';
+exception
+  when others then if sqlcode != -0942 then raise; end if;
+end;
+/
+create global temporary table drug_ids (
+    id number(15) not null,
+    constraint drug_ids_pk primary key (id)
+);
+
+begin
+  execute immediate 'drop table cond_ids';
+exception
+  when others then if sqlcode != -0942 then raise; end if;
+end;
+/
+create global temporary table cond_ids (
+    id number(15) not null,
+    constraint cond_ids_pk primary key (id)
+);
+
+begin
+  execute immediate 'drop table first_drugs';
+exception
+  when others then if sqlcode != -0942 then raise; end if;
+end;
+/
+create global temporary table first_drugs (
+    stratum ${stratumType} not null,
+    person number(15) not null,
+    drug number(15) not null,
+    drug_date date not null
+);
+
+begin
+  execute immediate 'drop table first_conds';
+exception
+  when others then if sqlcode != -0942 then raise; end if;
+end;
+/
+create global temporary table first_conds (
+    stratum ${stratumType} not null,
+    person number(15) not null,
+    cond number(15) not null,
+    cond_date date not null
+);
+
+begin
+  execute immediate 'drop table first_drugs_conds';
+exception
+  when others then if sqlcode != -0942 then raise; end if;
+end;
+/
+create global temporary table first_drugs_conds (
+    stratum ${stratumType} not null,
+    person number(15) not null,
+    drug number(15) not null,
+    cond number(15) not null,
+    drug_date date not null,
+    cond_date date not null
+);
+
+create or replace type number15_table as table of number(15);
+/
+
+-- Create tables to hold the counts of people for each drug and for
+-- each condition in each stratum
+begin
+  execute immediate 'drop table ${drugMarginalsTableName}';
+exception
+  when others then if sqlcode != -0942 then raise; end if;
+end;
+/
+create table ${drugMarginalsTableName} (
+    stratum ${stratumType} not null, -- Stratum
+    drug number(15) not null, -- Drug ID
+    ct_d_bef_anyc number(9), -- Count people having drug before any condition
+    ct_d_anyc number(9), -- Count people having drug and any condition
+    ct_d number(9), -- Count people having drug
+    ct_ppl number(9) -- Count people
+);
+
+begin
+  execute immediate 'drop table ${condMarginalsTableName}';
+exception
+  when others then if sqlcode != -0942 then raise; end if;
+end;
+/
+create table ${condMarginalsTableName} (
+    stratum ${stratumType} not null, -- Stratum
+    cond number(15) not null, -- Condition ID
+    ct_anyd_bef_c number(9), -- Count people having any drug before condition
+    ct_anyd_c number(9), -- Count people having any drug and condition
+    ct_c number(9), -- Count people having condition
+    ct_ppl number(9) -- Count people
+);
+
+-- Create table to hold counts and scores
+begin
+  execute immediate 'drop table ${countsScoresTableName}';
+exception
+  when others then if sqlcode != -0942 then raise; end if;
+end;
+/
+create table ${countsScoresTableName} (
+    stratum ${stratumType} not null, -- Stratum
+    drug number(15) not null, -- Drug ID
+    cond number(15) not null, -- Condition ID
+    ct_d_bef_c number(9), -- Count people having drug before condition
+    ct_c_bef_d number(9), -- Count people having condition before drug
+    ct_d_c number(9), -- Count people having drug and condition
+    ct_d_bef_anyc number(9), -- Count people having drug before any condition
+    ct_d_anyc number(9), -- Count people having drug and any condition
+    ct_anyd_bef_c number(9), -- Count people having any drug before condition
+    ct_anyd_c number(9), -- Count people having any drug and condition
+    ct_d number(9), -- Count people having drug
+    ct_c number(9), -- Count people having condition
+    ct_ppl number(9), -- Count people
+    temporal_score real
+);
+'''
+
+sqliteStratifiedTablesScriptTemplate = '''
+-- Create temporary tables (as in the unstratified script)
+drop table if exists temp.first_drugs;
+create temporary table first_drugs (
+    stratum ${stratumType} not null,
+    person integer not null,
+    drug integer not null,
+    drug_date real not null
+);
+
+drop table if exists temp.first_conds;
+create temporary table first_conds (
+    stratum ${stratumType} not null,
+    person integer not null,
+    cond integer not null,
+    cond_date real not null
+);
+
+drop table if exists temp.first_drugs_conds;
+create temporary table first_drugs_conds (
+    stratum ${stratumType} not null,
+    person integer not null,
+    drug integer not null,
+    cond integer not null,
+    drug_date real not null,
+    cond_date real not null
+);
+
+-- Create tables to hold the counts of people for each drug and for
+-- each condition in each stratum
+drop table if exists ${drugMarginalsTableName};
+create table ${drugMarginalsTableName} (
+    stratum ${stratumType} not null, -- Stratum
+    drug integer not null, -- Drug ID
+    ct_d_bef_anyc integer, -- Count people having drug before any condition
+    ct_d_anyc integer, -- Count people having drug and any condition
+    ct_d integer, -- Count people having drug
+    ct_ppl integer -- Count people
+);
+
+drop table if exists ${condMarginalsTableName};
+create table ${condMarginalsTableName} (
+    stratum ${stratumType} not null, -- Stratum
+    cond integer not null, -- Condition ID
+    ct_anyd_bef_c integer, -- Count people having any drug before condition
+    ct_anyd_c integer, -- Count people having any drug and condition
+    ct_c integer, -- Count people having condition
+    ct_ppl integer -- Count people
+);
+
+-- Create table to hold counts and scores
+drop table if exists ${countsScoresTableName};
+create table ${countsScoresTableName} (
+    stratum ${stratumType} not null, -- Stratum
+    drug integer not null, -- Drug ID
+    cond integer not null, -- Condition ID
+    ct_d_bef_c integer, -- Count people having drug before condition
+    ct_c_bef_d integer, -- Count people having condition before drug
+    ct_d_c integer, -- Count people having drug and condition
+    ct_d_bef_anyc integer, -- Count people having drug before any condition
+    ct_d_anyc integer, -- Count people having drug and any condition
+    ct_anyd_bef_c integer, -- Count people having any drug before condition
+    ct_anyd_c integer, -- Count people having any drug and condition
+    ct_d integer, -- Count people having drug
+    ct_c integer, -- Count people having condition
+    ct_ppl integer, -- Count people
+    temporal_score real
+);
+'''
+
+stratifiedCountsScriptTemplate = '''
+-- Find all the first drug and condition occurrences in each stratum
+insert into first_drugs
+${firstDrugsQuery};
+
+insert into first_conds
+${firstCondsQuery};
+
+-- Put the first drug occurrences and first condition occurrences of
+-- each stratum together
+insert into first_drugs_conds
+select fd.stratum, fd.person, fd.drug, fc.cond, fd.drug_date, fc.cond_date
+from first_drugs fd
+join first_conds fc
+  on fc.stratum = fd.stratum
+ and fc.person = fd.person
+ and fc.cond_date >= (fd.drug_date + ${conditionWindowStart})
+ and fc.cond_date <= (fd.drug_date + ${conditionWindowEnd});
+
+-- Count people for each drug and each condition in each stratum (with
+-- any records)
+insert into ${drugMarginalsTableName}
+    (stratum, drug, ct_d_bef_anyc, ct_d_anyc, ct_d, ct_ppl)
+select ppl_cts.stratum,
+       drugs.id as drug,
+       coalesce(drug_any_cts.ct_d_bef_anyc, 0),
+       coalesce(drug_any_cts.ct_d_anyc, 0),
+       coalesce(drug_cts.ct_d, 0),
+       ppl_cts.ct_ppl
+from drug_ids drugs
+-- Patients
+cross join
+    (select stratum, count(*) as ct_ppl
+     from (select stratum, person from first_drugs
+           union
+           select stratum, person from first_conds) ppl
+     group by stratum) ppl_cts
+-- Drug before any condition, drug and any condition
+left join
+    (select stratum, drug,
+            count(distinct case when drug_date < cond_date then person end) as ct_d_bef_anyc,
+            count(distinct person) as ct_d_anyc
+     from first_drugs_conds
+     group by stratum, drug) drug_any_cts
+  on drug_any_cts.stratum = ppl_cts.stratum
+ and drug_any_cts.drug = drugs.id
+-- Drugs
+left join
+    (select stratum, drug, count(*) as ct_d
+     from first_drugs
+     group by stratum, drug) drug_cts
+  on drug_cts.stratum = ppl_cts.stratum
+ and drug_cts.drug = drugs.id;
+
+insert into ${condMarginalsTableName}
+    (stratum, cond, ct_anyd_bef_c, ct_anyd_c, ct_c, ct_ppl)
+select ppl_cts.stratum,
+       conds.id as cond,
+       coalesce(cond_any_cts.ct_anyd_bef_c, 0),
+       coalesce(cond_any_cts.ct_anyd_c, 0),
+       coalesce(cond_cts.ct_c, 0),
+       ppl_cts.ct_ppl
+from cond_ids conds
+-- Patients
+cross join
+    (select stratum, count(*) as ct_ppl
+     from (select stratum, person from first_drugs
+           union
+           select stratum, person from first_conds) ppl
+     group by stratum) ppl_cts
+-- Any drug before condition, any drug and condition
+left join
+    (select stratum, cond,
+            count(distinct case when drug_date < cond_date then person end) as ct_anyd_bef_c,
+            count(distinct person) as ct_anyd_c
+     from first_drugs_conds
+     group by stratum, cond) cond_any_cts
+  on cond_any_cts.stratum = ppl_cts.stratum
+ and cond_any_cts.cond = conds.id
+-- Conditions
+left join
+    (select stratum, cond, count(*) as ct_c
+     from first_conds
+     group by stratum, cond) cond_cts
+  on cond_cts.stratum = ppl_cts.stratum
+ and cond_cts.cond = conds.id;
+
+-- Insert the pairs of each stratum with their counts (pruned by
+-- minCtDC with the having clause only)
+insert into ${countsScoresTableName}
+    (stratum, drug, cond,
+     ct_d_bef_c, ct_c_bef_d, ct_d_c,
+     ct_d_bef_anyc, ct_d_anyc, ct_anyd_bef_c, ct_anyd_c,
+     ct_d, ct_c, ct_ppl,
+     temporal_score)
+select dm.stratum,
+       dm.drug,
+       cm.cond,
+       coalesce(pair_cts.ct_d_bef_c, 0),
+       coalesce(pair_cts.ct_c_bef_d, 0),
+       coalesce(pair_cts.ct_d_c, 0),
+       dm.ct_d_bef_anyc,
+       dm.ct_d_anyc,
+       cm.ct_anyd_bef_c,
+       cm.ct_anyd_c,
+       dm.ct_d,
+       cm.ct_c,
+       dm.ct_ppl,
+       0.0
+from ${drugMarginalsTableName} dm
+join ${condMarginalsTableName} cm
+  on cm.stratum = dm.stratum
+-- Drug before condition, condition before drug, drug and condition
+${pairCountsJoin}
+    (select stratum, drug, cond,
+            sum(case when drug_date < cond_date then 1 else 0 end) as ct_d_bef_c,
+            sum(case when drug_date >= cond_date then 1 else 0 end) as ct_c_bef_d,
+            count(*) as ct_d_c
+     from first_drugs_conds
+     group by stratum, drug, cond${pairCountsHaving}) pair_cts
+  on pair_cts.stratum = dm.stratum
+ and pair_cts.drug = dm.drug
+ and pair_cts.cond = cm.cond;
+'''
+
+oracleStratifiedScriptTemplate = (
+    oracleHeaderScriptTemplate
+    + oracleStratifiedTablesScriptTemplate
+    + oracleLoadIdsScriptTemplate
+    + "exec dbms_output.put_line('metric,stratified_counts,' || systimestamp);"
+    + stratifiedCountsScriptTemplate
+    + oracleScoresScriptTemplate
+    + oracleCommitScript
+    + oracleReportScriptTemplate
+    + oracleCleanupScriptTemplate
+    )
+
+sqliteStratifiedScriptTemplate = (
+    sqliteStratifiedTablesScriptTemplate
+    + stratifiedCountsScriptTemplate
+    + sqliteScoresScriptTemplate
+    )
+
+# Report commands of the Oracle stratified script that write the report
+# to standard output with the stratum in each row
+oracleStratifiedReportTemplate = '''-- Write marginals to files
+set termout off
+${marginalsSpools}
+set termout on
+
+-- Write counts and scores to standard output
+select '${reportRowMarker}' as marker, cs.*
+from ${countsScoresTableName} cs
+order by stratum, drug, cond;'''
+
+# Queries for the first occurrences of the staged IDs in an era table in
+# each stratum of its records.  ${stratum} is the stratum of a record e
+# (of its person p if ${personJoin} joins the person table) and
+# ${firstDate} the earliest date of a group of records.
+stratifiedFirstOccurrencesQueryTemplate = '''select ${stratum} as stratum,
+       e.person_id as person,
+       e.${conceptColumn} as concept,
+       (${firstDate} + ${offset}) as occ_date
+from ${eraTableName} e
+join ${idsTableName} ids on ids.id = e.${conceptColumn}${personJoin}
+where ${stratum} is not null
+group by ${stratum}, e.person_id, e.${conceptColumn}'''
+
+# Queries for the first occurrences of the staged IDs in an era table
+oracleFirstOccurrencesQueryTemplate = '''select e.person_id as person,
+       e.${conceptColumn} as concept,
+       (min(e.${dateColumn}) + ${offset}) as occ_date
+from ${eraTableName} e
+join ${idsTableName} ids on ids.id = e.${conceptColumn}
+group by e.person_id, e.${conceptColumn}'''
+
+sqliteFirstOccurrencesQueryTemplate = '''select e.person_id as person,
+       e.${conceptColumn} as concept,
+       (julianday(min(e.${dateColumn})) + ${offset}) as occ_date
+from ${eraTableName} e
+join ${idsTableName} ids on ids.id = e.${conceptColumn}
+group by e.person_id, e.${conceptColumn}'''
+
+# Query for the first occurrences in a cache entry
+cachedFirstOccurrencesQueryTemplate = '''select person, concept, occ_date
+from ${cacheTableName}_data
+where cache_id = ${cacheId}'''
+
+# Oracle DDL that creates the first occurrences cache (if it does not
+# exist).  The catalog has an entry for each set of cached first
+# occurrences identified by era table, offset, and hash of the IDs.  The
+# fingerprint of the rows of the IDs in the era table (row count and
+# maximum start date) tells if the entry is still valid.  Entry IDs come
+# from a sequence (that starts after any existing entries) so that
+# concurrent runs do not take the same ID.
+oracleCacheTablesDdlTemplate = '''-- Create the first occurrences cache (if it does not exist)
+begin
+  execute immediate 'create table ${cacheTableName} (cache_id number(15) not null, era_table varchar2(200) not null, occ_offset number(9) not null, ids_hash varchar2(64) not null, fingerprint varchar2(100) not null, last_used timestamp not null, constraint ${cacheTableName}_pk primary key (cache_id))';
+exception
+  when others then if sqlcode != -0955 then raise; end if;
+end;
+/
+begin
+  execute immediate 'create table ${cacheTableName}_data (cache_id number(15) not null, person number(15) not null, concept number(15) not null, occ_date date not null)';
+exception
+  when others then if sqlcode != -0955 then raise; end if;
+end;
+/
+begin
+  execute immediate 'create index ${cacheTableName}_data_idx on ${cacheTableName}_data (cache_id)';
+exception
+  when others then if sqlcode != -0955 then raise; end if;
+end;
+/
+declare
+  v_start number;
+begin
+  select nvl(max(cache_id), 0) + 1 into v_start from ${cacheTableName};
+  execute immediate 'create sequence ${cacheTableName}_seq start with ' || v_start;
+exception
+  when others then if sqlcode != -0955 then raise; end if;
+end;
+/
+'''
+
+# Oracle PL/SQL that finds the valid cache entry for a set of first
+# occurrences or fills a new one, evicts the least recently used entries
+# beyond the cache size, and puts the ID of the entry in a bind variable
+oracleCacheLookupTemplate = '''variable ${bindName} number
+declare
+  v_fingerprint varchar2(100);
+  v_cache_id number;
+begin
+  select count(*) || ':' || to_char(max(e.${dateColumn}), 'YYYY-MM-DD')
+  into v_fingerprint
+  from ${eraTableName} e
+  join ${idsTableName} ids on ids.id = e.${conceptColumn};
+  begin
+    select cache_id into v_cache_id
+    from ${cacheTableName}
+    where era_table = '${eraTableName}'
+      and occ_offset = ${offset}
+      and ids_hash = '${idsHash}'
+      and fingerprint = v_fingerprint;
+  exception
+    when no_data_found then
+      -- Remove any stale entry and fill a new one
+      delete from ${cacheTableName}_data
+      where cache_id in
+          (select cache_id from ${cacheTableName}
+           where era_table = '${eraTableName}'
+             and occ_offset = ${offset}
+             and ids_hash = '${idsHash}');
+      delete from ${cacheTableName}
+      where era_table = '${eraTableName}'
+        and occ_offset = ${offset}
+        and ids_hash = '${idsHash}';
+      select ${cacheTableName}_seq.nextval into v_cache_id from dual;
+      insert into ${cacheTableName}
+          (cache_id, era_table, occ_offset, ids_hash, fingerprint, last_used)
+      values (v_cache_id, '${eraTableName}', ${offset}, '${idsHash}',
+              v_fingerprint, systimestamp);
+      insert into ${cacheTableName}_data (cache_id, person, concept, occ_date)
+      select v_cache_id, fo.person, fo.concept, fo.occ_date
+      from (${firstOccurrencesQuery}) fo;
+  end;
+  update ${cacheTableName} set last_used = systimestamp
+  where cache_id = v_cache_id;
+  -- Evict the least recently used entries
+  delete from ${cacheTableName}_data
+  where cache_id in
+      (select cache_id
+       from (select cache_id,
+                    row_number() over (order by last_used desc) as recency
+             from ${cacheTableName})
+       where recency > ${cacheSize});
+  delete from ${cacheTableName}
+  where cache_id in
+      (select cache_id
+       from (select cache_id,
+                    row_number() over (order by last_used desc) as recency
+             from ${cacheTableName})
+       where recency > ${cacheSize});
+  :${bindName} := v_cache_id;
+end;
+/'''
+
+# Query to read the counts and scores report
+reportQueryTemplate = '''
+select *
+from ${reportRowsSource}
+order by drug, cond
+'''
+
+_settingPattern = re.compile(r'^\s*([\w~!@$%^&*+|;,./?-]+)\s*[:=]\s*(.*?)\s*$')
+
+# Can't use ConfigParser because it case-converts all names
+def parseConfig(fileName):
+    logger = logging.getLogger(__name__)
+    settings = collections.OrderedDict()
+    logger.info('Loading configuration file: %s', fileName)
+    with open(fileName, 'r') as inputFile:
+        for lineNumber, line in enumerate(inputFile, start=1):
+            strippedLine = line.strip()
+            # Skip blank lines and comments
+            if not strippedLine or strippedLine.startswith('#'):
+                continue
+            # Parse settings
+            match = _settingPattern.match(line)
+            if match is None:
+                logger.warning("Skipping non-setting at %s:%s: '%s'", fileName, lineNumber, line.rstrip('\n'))
+            else:
+                name, value = match.group(1, 2)
+                settings[name] = value
+    return settings
+
+def dictToPrettyString(dict_):
+    lines = ['{']
+    for name, value in dict_.viewitems():
+        lines.append(str(name) + ': ' + str(value) + ',')
+    lines.append('}')
+    return '\n'.join(lines)
+
+def parseBoolean(value):
+    # Interpret booleans given as strings in a config file
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+_integerPattern = re.compile(r'\s*\d+\s*')
+
+def parseIds(inputFile):
+    ids = []
+    for lineNumber, line in enumerate(inputFile, start=1):
+        strippedLine = line.strip()
+        # Skip empty lines and comments
+        if not line or strippedLine.startswith('#'):
+            continue
+        # Convert integer IDs to integers
+        id_ = strippedLine
+        match = _integerPattern.match(id_)
+        if match is not None:
+            id_ = int(match.group())
+        ids.append(id_)
+    return ids
+
+class Metrics(object):
+    '''Collects the durations and row counts of the phases of a run.
+    Each phase is a dict with a name, its duration in seconds, and the
+    number of rows it produced or changed (None if unknown), in order
+    of start.  Phases of the database come from the engine.  Phases that
+    stream rows include the time to write them.
+    '''
+
+    def __init__(self):
+        self.start = time.time()
+        self.info = collections.OrderedDict()
+        self.phases = []
+
+    def add(self, name, seconds=None, rows=None):
+        phase = collections.OrderedDict((
+                ('name', name), ('seconds', seconds), ('rows', rows)))
+        self.phases.append(phase)
+        return phase
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        # Times the enclosed code as a phase, which it can give rows
+        phase = self.add(name)
+        start = time.time()
+        try:
+            yield phase
+        finally:
+            phase['seconds'] = time.time() - start
+
+    def log(self):
+        logger = logging.getLogger(__name__)
+        for phase in self.phases:
+            logger.info('Phase %s: %s s, %s rows', phase['name'],
+                        'unknown' if phase['seconds'] is None
+                        else '{:.3f}'.format(phase['seconds']),
+                        'unknown' if phase['rows'] is None else phase['rows'])
+        logger.info('Total: %.3f s', time.time() - self.start)
+
+    def write(self, fileName):
+        # Writes the metrics as a JSON object
+        metrics = collections.OrderedDict(self.info)
+        metrics['start'] = datetime.datetime.fromtimestamp(
+            self.start).isoformat()
+        metrics['seconds'] = time.time() - self.start
+        metrics['phases'] = self.phases
+        with open(fileName, 'w') as metricsFile:
+            json.dump(metrics, metricsFile, indent=2)
+            metricsFile.write('\n')
+
+def temporalScore(drugIds, condIds, parameters=defaultParameters,
+                  metrics=None):
+    '''Computes the counts and scores of all the drug-condition pairs
+    and returns the report as an open file (ready for reading) and the
+    output of the engine's script (or None).  Records the phases of the
+    run in the given Metrics, if any.
+    '''
+    logger = logging.getLogger(__name__)
+    logger.info('Computing temporal scores')
+    requireSingleConfiguration(parameters)
+    return makeBackend(parameters, metrics).temporalScore(drugIds, condIds)
+
+def iterTemporalScores(drugIds, condIds, parameters=defaultParameters,
+                       metrics=None):
+    '''Computes the counts and scores of all the drug-condition pairs
+    and generates the report rows as they are produced.  Rows are
+    ReportRow tuples of ints and a float score in order by drug and
+    condition.  Records the phases of the run in the given Metrics, if
+    any.  If any of the selection parameters (topK, minScore, minCtDC)
+    are given, only the selected rows are generated (see
+    selectReportRows).
+    '''
+    logger = logging.getLogger(__name__)
+    logger.info('Computing temporal scores')
+    requireSingleConfiguration(parameters)
+    return selectReportRows(
+        makeBackend(parameters, metrics).iterRows(drugIds, condIds),
+        *selectionParameters(parameters))
+
+def iterSweepScores(drugIds, condIds, parameters=defaultParameters,
+                    metrics=None):
+    '''Computes the counts and scores of all the drug-condition pairs
+    for each configuration in the grid of sweep parameters (see
+    sweepConfigurations) and generates the report rows as they are
+    produced.  Rows are SweepRow tuples in order by configuration, drug,
+    and condition.  The configurations share the scans of the era
+    tables and the join of first occurrences.  Records the phases of
+    the run in the given Metrics, if any.  Rows are selected for each
+    configuration as in iterTemporalScores.
+    '''
+    logger = logging.getLogger(__name__)
+    configs = sweepConfigurations(parameters)
+    logger.info('Computing temporal scores for %s configurations',
+                len(configs))
+    for index, config in enumerate(configs, start=1):
+        logger.info('Configuration %s: %s', index, config)
+    return selectGroupedRows(
+        makeBackend(parameters, metrics).iterSweepRows(
+            drugIds, condIds, configs),
+        *selectionParameters(parameters))
+
+def iterStratifiedScores(drugIds, condIds, parameters=defaultParameters,
+                         metrics=None):
+    '''Computes the counts and scores of all the drug-condition pairs
+    within each stratum of people or eras given by the stratifyBy
+    parameter and generates the report rows as they are produced.  Rows
+    are StratumRow tuples in order by stratum, drug, and condition.  The
+    era records are read and joined once for all the strata.  Rows are
+    selected for each stratum as in iterTemporalScores.
+    '''
+    logger = logging.getLogger(__name__)
+    logger.info('Computing temporal scores by %s', parameters['stratifyBy'])
+    requireSingleConfiguration(parameters)
+    checkStratifiedRun(parameters)
+    return selectGroupedRows(
+        makeBackend(parameters, metrics).iterStratifiedRows(drugIds, condIds),
+        *selectionParameters(parameters))
+
+def makeBackend(parameters, metrics=None):
+    # Copy the parameters to avoid modifying the original
+    parameters = dict(parameters)
+    # Fill in the derived parameters
+    if not parameters.get('drugMarginalsTableName'):
+        parameters['drugMarginalsTableName'] = (
+            parameters['countsScoresTableName'] + '_drugs')
+    if not parameters.get('condMarginalsTableName'):
+        parameters['condMarginalsTableName'] = (
+            parameters['countsScoresTableName'] + '_conds')
+    parameters['sparse'] = parseBoolean(parameters.get('sparse'))
+    parameters['pairCountsJoin'] = (
+        'join' if parameters['sparse'] else 'left join')
+    parameters['firstDrugsConds'] = 'first_drugs_conds'
+    fillInPairCountsPruning(parameters)
+    # The report reads the results table (or its join with the
+    # marginals in normalized runs, see normalizedReportRowsTemplate)
+    parameters['reportRowsSource'] = parameters['countsScoresTableName']
+    # The working tables of the Oracle script (see
+    # buildCheckpointedScripts for the tables of checkpointed runs)
+    parameters['drugIdsTableName'] = 'drug_ids'
+    parameters['condIdsTableName'] = 'cond_ids'
+    parameters['firstDrugsTableName'] = 'first_drugs'
+    parameters['firstCondsTableName'] = 'first_conds'
+    parameters['firstDrugsCondsTableName'] = 'first_drugs_conds'
+    # Dispatch to the requested engine
+    engine = parameters.get('engine') or 'oracle'
+    if engine not in backends:
+        raise ValueError('Unknown engine: {}'.format(engine))
+    return backends[engine](parameters, metrics)
+
+# Restriction of the pair counts to the drugs and conditions whose pairs
+# can reach minCtDC (as joinCounts prunes)
+pairCountsWhereTemplate = '''
+     where drug in
+         (select drug from ${drugMarginalsTableName}
+          where ct_d_anyc >= ${minCtDC})
+       and cond in
+         (select cond from ${condMarginalsTableName}
+          where ct_anyd_c >= ${minCtDC})'''
+
+def fillInPairCountsPruning(parameters):
+    # Fills in the parameters that make the SQL pair counts skip the
+    # pairs that cannot reach minCtDC: only the pairs of the drugs and
+    # conditions with enough people with any pair are aggregated, and
+    # only the pairs with enough people are inserted (so never those
+    # without people, as in sparse mode).  Incremental runs count all
+    # the pairs because later runs only add to them.
+    minCtDC = selectionParameters(parameters)[2]
+    parameters['pairCountsWhere'] = ''
+    parameters['pairCountsHaving'] = ''
+    if (minCtDC is None or minCtDC < 1
+        or parseBoolean(parameters.get('incremental'))):
+        return
+    parameters['pairCountsJoin'] = 'join'
+    parameters['pairCountsWhere'] = string.Template(
+        pairCountsWhereTemplate).substitute(parameters, minCtDC=minCtDC)
+    parameters['pairCountsHaving'] = (
+        '\n     having count(*) >= {}'.format(minCtDC))
+
+class Backend(object):
+    '''Interface of counting engines.  A backend is constructed with the
+    run parameters and computes the counts and scores for all the
+    drug-condition pairs.  The backend records the phases of its runs
+    in its metrics.
+    '''
+
+    def __init__(self, parameters, metrics=None):
+        self.parameters = parameters
+        self.metrics = metrics if metrics is not None else Metrics()
+
+    def iterRows(self, drugIds, condIds):
+        '''Generates the report rows (as ReportRow tuples) in order by
+        drug and condition.
+        '''
+        raise NotImplementedError()
+
+    def iterSweepRows(self, drugIds, condIds, configs):
+        '''Generates the report rows of all the given configurations (as
+        SweepRow tuples) in order by configuration, drug, and condition.
+        The configurations are numbered from 1 in the given order.
+        '''
+        raise NotImplementedError()
+
+    def iterStratifiedRows(self, drugIds, condIds):
+        '''Generates the report rows of each stratum (as StratumRow
+        tuples) in order by stratum, drug, and condition.
+        '''
+        raise NotImplementedError()
+
+    def warmUp(self):
+        '''Prepares to score many requests, for example by keeping the
+        data or the connection to it.  Does nothing by default.
+        '''
+        pass
+
+    def close(self):
+        '''Releases whatever warmUp kept.'''
+        pass
+
+    def temporalScore(self, drugIds, condIds):
+        '''Returns the report as an open file (ready for reading) and
+        the script output (or None).
+        '''
+        # Write the rows to a temporary file like the Oracle engine does
+        reportOutput = tempfile.TemporaryFile(mode='w+')
+        writeReportRows(selectReportRows(
+                iterUncancelled(self.iterRows(drugIds, condIds)),
+                *selectionParameters(self.parameters)), reportOutput)
+        reportOutput.flush()
+        reportOutput.seek(0)
+        return reportOutput, None
+
+class OracleBackend(Backend):
+
+    def fillInScriptParameters(self, drugIds, condIds, idsTablePrefix):
+        parameters = self.parameters
+        # Construct the statements that load the IDs
+        parameters['drugIdsInserts'] = oracleIdsInserts(
+            idsTablePrefix + parameters['drugIdsTableName'], drugIds)
+        parameters['condIdsInserts'] = oracleIdsInserts(
+            idsTablePrefix + parameters['condIdsTableName'], condIds)
+        # Construct the queries for the first occurrences, which come
+        # from the cache if it is enabled
+        useCache = parseBoolean(parameters.get('firstOccurrenceCache'))
+        parameters['cacheTablesDdl'] = ''
+        if useCache:
+            parameters['cacheTablesDdl'] = string.Template(
+                oracleCacheTablesDdlTemplate).substitute(
+                cacheTableName=parameters['firstOccurrenceCacheTableName'])
+        for name, source in firstOccurrencesSources(
+                parameters, drugIds, condIds):
+            query = string.Template(
+                oracleFirstOccurrencesQueryTemplate).substitute(source)
+            parameters[name + 'CacheLookup'] = ''
+            if useCache:
+                source['firstOccurrencesQuery'] = query
+                parameters[name + 'CacheLookup'] = string.Template(
+                    oracleCacheLookupTemplate).substitute(source)
+                query = string.Template(
+                    cachedFirstOccurrencesQueryTemplate).substitute(
+                    source, cacheId=':' + source['bindName'])
+            parameters[name + 'Query'] = query
+
+    def buildScript(self, drugIds, condIds, reportTemplate):
+        parameters = self.parameters
+        if parseBoolean(parameters.get('incremental')):
+            scriptTemplate = oracleIncrementalScriptTemplate
+            idsTablePrefix = 'new_'
+        elif parseBoolean(parameters.get('normalized')):
+            scriptTemplate = oracleNormalizedScriptTemplate
+            idsTablePrefix = ''
+            parameters['reportRowsSource'] = string.Template(
+                normalizedReportRowsTemplate).substitute(parameters)
+        else:
+            scriptTemplate = sqlScriptTemplate
+            idsTablePrefix = ''
+        self.fillInScriptParameters(drugIds, condIds, idsTablePrefix)
+        # Construct the report commands
+        parameters['marginalsSpools'] = oracleMarginalsSpools(parameters)
+        parameters['reportCommands'] = string.Template(
+            reportTemplate).substitute(parameters)
+        # Build the SQL script
+        sqlTemplate = string.Template(scriptTemplate)
+        return sqlTemplate.substitute(parameters)
+
+    def buildSweepScript(self, drugIds, condIds, configs):
+        parameters = self.parameters
+        if parseBoolean(parameters.get('incremental')):
+            raise ValueError('Sweeps do not support incremental mode.')
+        if parameters.get('runId'):
+            raise ValueError('Sweeps do not support checkpointed runs.')
+        # Find the first occurrences without any offset and join them
+        # with the widest window of all the configurations
+        parameters['drugOccurrenceOffset'] = 0
+        (parameters['conditionWindowStart'],
+         parameters['conditionWindowEnd']) = sweepJoinWindow(configs)
+        parameters['reportRowMarker'] = oracleReportRowMarker
+        self.fillInScriptParameters(drugIds, condIds, '')
+        parts = [string.Template(oracleSetupScriptTemplate).substitute(
+                parameters)]
+        # Count, score, and report each configuration from the shared
+        # join.  Configurations that only differ in pseudocount reuse the
+        # counts.
+        countsTemplate = string.Template(
+            sweepClearScriptTemplate + oracleCountsScriptTemplate)
+        reportTemplate = string.Template(
+            oracleScoresScriptTemplate + oracleReportScriptTemplate)
+        for index, config, isNewCounts in iterSweepCounts(configs):
+            configParameters = dict(parameters, config=index)
+            configParameters.update(sweepConfigParameters(config))
+            if isNewCounts:
+                configParameters['firstDrugsConds'] = string.Template(
+                    sweepDrugsCondsTemplate).substitute(configParameters)
+                parts.append(countsTemplate.substitute(configParameters))
+            configParameters['marginalsSpools'] = oracleMarginalsSpools(
+                configParameters, index)
+            configParameters['reportCommands'] = string.Template(
+                oracleSweepReportTemplate).substitute(configParameters)
+            parts.append(reportTemplate.substitute(configParameters))
+        parts.append(oracleCommitScript)
+        parts.append(string.Template(oracleCleanupScriptTemplate).substitute(
+                parameters))
+        return ''.join(parts)
+
+    def buildStratifiedScript(self, drugIds, condIds):
+        # Returns the script that counts, scores, and reports all the
+        # pairs within each stratum (see checkStratifiedRun for the
+        # options it does not support)
+        parameters = self.parameters
+        parameters['reportRowMarker'] = oracleReportRowMarker
+        self.fillInScriptParameters(drugIds, condIds, '')
+        fillInStratifiedParameters(parameters, drugIds, condIds, 'oracle')
+        parameters['marginalsSpools'] = oracleMarginalsSpools(
+            parameters, stratified=True)
+        parameters['reportCommands'] = string.Template(
+            oracleStratifiedReportTemplate).substitute(parameters)
+        return string.Template(oracleStratifiedScriptTemplate).substitute(
+            parameters)
+
+    def buildShardsScripts(self, drugIds, condIds, reportTemplate):
+        '''Returns the scripts of a sharded run: the setup script, the
+        script of each shard, the merge script (which reports), and the
+        cleanup script for failures.  Each shard counts a part of the
+        drugs with all the conditions in its own session and tables.
+        '''
+        parameters = self.parameters
+        if parseBoolean(parameters.get('incremental')):
+            raise ValueError('Sharding does not support incremental mode.')
+        if parseBoolean(parameters.get('firstOccurrenceCache')):
+            raise ValueError('Sharding does not support the first occurrence cache.')
+        numShards = int(parameters['shards'])
+        # Deal the drugs into the shards (without duplicates)
+        drugIds = list(collections.OrderedDict.fromkeys(drugIds))
+        shardsDrugIds = [ids for ids in (
+                drugIds[index::numShards] for index in range(numShards))
+                         if ids]
+        baseName = parameters['countsScoresTableName']
+        parameters['shardCondPersonsTableName'] = baseName + '_cond_persons'
+        parameters['shardPersonsTableName'] = baseName + '_persons'
+        shardScripts = []
+        shardTableNames = []
+        for index, ids in enumerate(shardsDrugIds, start=1):
+            shardName = '{}_s{}'.format(baseName, index)
+            shardParameters = dict(parameters)
+            shardParameters.update((
+                    ('countsScoresTableName', shardName),
+                    ('drugMarginalsTableName', shardName + '_drugs'),
+                    ('condMarginalsTableName', shardName + '_conds'),
+                    ))
+            # Pruning by the marginals of the shard is sound because the
+            # pairs of its drugs only have its people with any pair
+            fillInPairCountsPruning(shardParameters)
+            shardBackend = OracleBackend(shardParameters)
+            shardBackend.fillInScriptParameters(ids, condIds, '')
+            shardScripts.append(string.Template(
+                    oracleShardScriptTemplate).substitute(shardParameters))
+            shardTableNames.append((
+                    shardParameters['countsScoresTableName'],
+                    shardParameters['drugMarginalsTableName'],
+                    shardParameters['condMarginalsTableName']))
+        # Construct the merge
+        parameters['firstShardCondMarginalsTableName'] = shardTableNames[0][2]
+        parameters['shardDrugMarginalsUnion'] = '\n     union all\n     '.join(
+            'select * from {}'.format(names[1]) for names in shardTableNames)
+        parameters['shardCountsUnion'] = '\n     union all\n     '.join(
+            'select * from {}'.format(names[0]) for names in shardTableNames)
+        parameters['shardTablesDrops'] = '\n'.join(
+            oracleDropTableIfExists(name) for name in
+            [name for names in shardTableNames for name in names]
+            + [parameters['shardCondPersonsTableName'],
+               parameters['shardPersonsTableName']])
+        parameters['cacheTablesDdl'] = ''
+        parameters['marginalsSpools'] = oracleMarginalsSpools(parameters)
+        parameters['reportCommands'] = string.Template(
+            reportTemplate).substitute(parameters)
+        return (
+            string.Template(oracleShardsSetupScriptTemplate).substitute(
+                parameters),
+            shardScripts,
+            string.Template(oracleShardsMergeScriptTemplate).substitute(
+                parameters),
+            string.Template(oracleShardsCleanupScriptTemplate).substitute(
+                parameters),
+            )
+
+    def runShards(self, drugIds, condIds, reportTemplate):
+        '''Runs the setup and the shards of a sharded run concurrently
+        and returns the merge script to run for the report.
+        '''
+        logger = logging.getLogger(__name__)
+        parameters = self.parameters
+        with self.metrics.timed('build_script'):
+            setupScript, shardScripts, mergeScript, cleanupScript = (
+                self.buildShardsScripts(drugIds, condIds, reportTemplate))
+        # The shards run in other threads but belong to the same job
+        job = currentScoringJob()
+        def runScript(script):
+            with runningScoringJob(job):
+                return runOracleSqlScript(
+                    parameters['dbConnectionName'],
+                    parameters['dbUser'],
+                    parameters['dbPass'],
+                    script,
+                    )
+        with self.metrics.timed('sqlplus_shards_setup'):
+            readOracleMetrics(
+                runScript(setupScript), self.metrics, 'shards_setup.')
+        numWorkers = int(parameters.get('shardWorkers') or len(shardScripts))
+        logger.info('Running %s shards with %s workers',
+                    len(shardScripts), numWorkers)
+        pool = multiprocessing.pool.ThreadPool(numWorkers)
+        try:
+            start = time.time()
+            with self.metrics.timed('sqlplus_shards'):
+                outputs = pool.map(runScript, shardScripts)
+            logger.info('Shards took %.3f s', time.time() - start)
+            for index, output in enumerate(outputs, start=1):
+                readOracleMetrics(
+                    output, self.metrics, 'shard{}.'.format(index))
+        except Exception:
+            # Try to drop the tables of the shards but report the
+            # original error
+            logger.info('Dropping the tables of the shards')
+            try:
+                runScript(cleanupScript)
+            except OracleError as e:
+                logger.warning('Failed to drop the tables of the shards: %s', e)
+            raise
+        finally:
+            pool.close()
+        return mergeScript
+
+    def buildCheckpointedScripts(self, drugIds, condIds, reportTemplate):
+        '''Returns the (name, script) of each phase of a checkpointed run
+        in order and the script that reports its results and drops its
+        tables.  The working tables are permanent tables of the run named
+        after `countsScoresTableName`.
+        '''
+        parameters = self.parameters
+        if parseBoolean(parameters.get('incremental')):
+            raise ValueError('Checkpointed runs do not support incremental mode.')
+        if parseBoolean(parameters.get('firstOccurrenceCache')):
+            raise ValueError('Checkpointed runs do not support the first occurrence cache.')
+        if int(parameters.get('shards') or 1) > 1:
+            raise ValueError('Checkpointed runs do not support sharding.')
+        baseName = parameters['countsScoresTableName'] + '_ck'
+        parameters.update((
+                ('drugIdsTableName', baseName + '_drug_ids'),
+                ('condIdsTableName', baseName + '_cond_ids'),
+                ('firstDrugsTableName', baseName + '_fd'),
+                ('firstCondsTableName', baseName + '_fc'),
+                ('firstDrugsCondsTableName', baseName + '_fdc'),
+                ('firstDrugsConds', baseName + '_fdc'),
+                ))
+        parameters['checkpointTablesDrops'] = '\n'.join(
+            oracleDropTableIfExists(parameters[name]) for name in (
+                'drugIdsTableName', 'condIdsTableName', 'firstDrugsTableName',
+                'firstCondsTableName', 'firstDrugsCondsTableName'))
+        self.fillInScriptParameters(drugIds, condIds, '')
+        parameters['marginalsSpools'] = oracleMarginalsSpools(parameters)
+        parameters['reportCommands'] = string.Template(
+            reportTemplate).substitute(parameters)
+        phaseScripts = [
+            (name, string.Template(
+                    oracleHeaderScriptTemplate + template
+                    + oracleCheckpointPhaseEndScript).substitute(parameters))
+            for name, template in oracleCheckpointPhaseTemplates.items()]
+        return phaseScripts, string.Template(
+            oracleCheckpointReportScriptTemplate).substitute(parameters)
+
+    def runCheckpointedPhases(self, drugIds, condIds, reportTemplate):
+        '''Runs the phases of a checkpointed run that its manifest does
+        not record as done, each in its own session, and returns the
+        script to run for the report.  A failed phase is retried up to
+        `phaseRetries` times.  The manifest records each phase once it
+        is done.
+        '''
+        logger = logging.getLogger(__name__)
+        parameters = self.parameters
+        runId = parameters['runId']
+        with self.metrics.timed('build_script'):
+            phaseScripts, reportScript = self.buildCheckpointedScripts(
+                drugIds, condIds, reportTemplate)
+        fileName = runManifestFileName(parameters)
+        signature = runSignature(drugIds, condIds, parameters)
+        manifest = None
+        if parseBoolean(parameters.get('resume')):
+            manifest = readRunManifest(fileName)
+            if manifest is None:
+                raise ValueError('No manifest of run {} in {}'.format(
+                        runId, fileName))
+            if manifest['signature'] != signature:
+                raise ValueError(
+                    'Run {} was started with other IDs or parameters.'.format(
+                        runId))
+            if manifest.get('finished'):
+                raise ValueError('Run {} has already finished.'.format(runId))
+            logger.info('Resuming run %s after phases: %s', runId,
+                        ', '.join(manifest['phases']) or 'none')
+        if manifest is None:
+            manifest = collections.OrderedDict((
+                    ('version', runManifestVersion),
+                    ('runId', runId),
+                    ('signature', signature),
+                    ('started', datetime.datetime.now().isoformat()),
+                    ('finished', None),
+                    ('phases', collections.OrderedDict()),
+                    ))
+            writeRunManifest(fileName, manifest)
+        retries = int(parameters.get('phaseRetries') or 0)
+        for name, script in phaseScripts:
+            if name in manifest['phases']:
+                logger.info('Skipping phase %s of run %s', name, runId)
+                continue
+            for attempt in range(1, retries + 2):
+                try:
+                    with self.metrics.timed('sqlplus_' + name) as phase:
+                        output = runOracleSqlScript(
+                            parameters['dbConnectionName'],
+                            parameters['dbUser'],
+                            parameters['dbPass'],
+                            script,
+                            )
+                    break
+                except OracleError as e:
+                    if attempt > retries:
+                        raise
+                    delay = float(parameters.get('phaseRetryDelay') or 0)
+                    logger.warning('Phase %s of run %s failed (%s), retrying in %s s',
+                                   name, runId, e, delay)
+                    time.sleep(delay)
+            readOracleMetrics(output, self.metrics)
+            manifest['phases'][name] = collections.OrderedDict((
+                    ('finished', datetime.datetime.now().isoformat()),
+                    ('seconds', phase['seconds']),
+                    ('attempts', attempt),
+                    ))
+            writeRunManifest(fileName, manifest)
+        return reportScript
+
+    def finishCheckpointedRun(self):
+        # Records in the manifest of a checkpointed run that its report
+        # is done (and its tables dropped)
+        parameters = self.parameters
+        if not parameters.get('runId'):
+            return
+        fileName = runManifestFileName(parameters)
+        manifest = readRunManifest(fileName)
+        manifest['finished'] = datetime.datetime.now().isoformat()
+        writeRunManifest(fileName, manifest)
+
+    def buildRunScript(self, drugIds, condIds, reportTemplate):
+        # Returns the script that computes (or merges) and reports the
+        # results, first running any shards or the phases of a
+        # checkpointed run
+        if self.parameters.get('runId'):
+            return self.runCheckpointedPhases(drugIds, condIds, reportTemplate)
+        if int(self.parameters.get('shards') or 1) > 1:
+            return self.runShards(drugIds, condIds, reportTemplate)
+        with self.metrics.timed('build_script'):
+            return self.buildScript(drugIds, condIds, reportTemplate)
+
+    def temporalScore(self, drugIds, condIds):
+        parameters = self.parameters
+        # Create a temporary file for the report output
+        reportOutput = tempfile.NamedTemporaryFile(suffix='.csv')
+        parameters['reportFileName'] = reportOutput.name
+        sqlScript = self.buildRunScript(
+            drugIds, condIds, oracleSpoolReportTemplate)
+        # Run the SQL script
+        with self.metrics.timed('sqlplus'):
+            scriptOutput = runOracleSqlScript(
+                parameters['dbConnectionName'],
+                parameters['dbUser'],
+                parameters['dbPass'],
+                sqlScript,
+                )
+        readOracleMetrics(scriptOutput, self.metrics)
+        self.finishCheckpointedRun()
+        # Prepare report output for reading as input
+        reportOutput.flush()
+        reportOutput.seek(0)
+        return reportOutput, scriptOutput
+
+    def iterRows(self, drugIds, condIds):
+        self.parameters['reportRowMarker'] = oracleReportRowMarker
+        sqlScript = self.buildRunScript(
+            drugIds, condIds, oracleStreamReportTemplate)
+        for fields in self.iterMarkedFields(sqlScript):
+            yield parseReportFields(fields)
+        self.finishCheckpointedRun()
+
+    def iterSweepRows(self, drugIds, condIds, configs):
+        with self.metrics.timed('build_script'):
+            sqlScript = self.buildSweepScript(drugIds, condIds, configs)
+        for fields in self.iterMarkedFields(sqlScript):
+            yield SweepRow(int(fields[0]), *parseReportFields(fields[1:]))
+
+    def iterStratifiedRows(self, drugIds, condIds):
+        with self.metrics.timed('build_script'):
+            sqlScript = self.buildStratifiedScript(drugIds, condIds)
+        isNumeric = self.parameters['stratifyBy'] in ('period', 'age')
+        for fields in self.iterMarkedFields(sqlScript):
+            stratum = fields[0].strip()
+            yield StratumRow(int(stratum) if isNumeric else stratum,
+                             *parseReportFields(fields[1:]))
+
+    def iterMarkedFields(self, sqlScript):
+        # Runs the script and picks out the fields of the marked rows
+        # from the output as sqlplus writes it
+        logger = logging.getLogger(__name__)
+        parameters = self.parameters
+        reader = OracleMetricsReader(self.metrics)
+        with self.metrics.timed('sqlplus') as phase:
+            phase['rows'] = 0
+            for line in iterOracleSqlScript(
+                    parameters['dbConnectionName'],
+                    parameters['dbUser'],
+                    parameters['dbPass'],
+                    sqlScript,
+                    ):
+                fields = line.split(',')
+                if fields[0].strip() == oracleReportRowMarker:
+                    phase['rows'] += 1
+                    yield fields[1:]
+                elif line.strip():
+                    logger.debug('Oracle output: %s', line.rstrip())
+                    reader.feed(line)
+
+# Pattern of the feedback of sqlplus on the rows changed by a statement
+_oracleFeedbackPattern = re.compile(
+    r'^\s*(\d+|no) rows? (created|updated|deleted|merged|inserted)\.')
+
+class OracleMetricsReader(object):
+    '''Reads the phases of an Oracle script from its output into metrics.
+    The script reports the start of each phase with a line like
+    'metric,<phase>,<timestamp>' (the last phase is 'end') and sqlplus
+    reports the rows of each statement as feedback.
+    '''
+
+    def __init__(self, metrics, prefix=''):
+        self.metrics = metrics
+        self.prefix = prefix
+        self.phase = None
+        self.phaseStart = None
+
+    def feed(self, line):
+        fields = line.strip().split(',')
+        if fields[0] == 'metric' and len(fields) == 3:
+            timestamp = datetime.datetime.strptime(
+                fields[2].strip(), '%Y-%m-%d %H:%M:%S.%f')
+            if self.phase is not None:
+                self.phase['seconds'] = (
+                    timestamp - self.phaseStart).total_seconds()
+            self.phase = None
+            if fields[1] != 'end':
+                self.phase = self.metrics.add(self.prefix + fields[1])
+                self.phaseStart = timestamp
+            return
+        match = _oracleFeedbackPattern.match(line)
+        if match is not None and self.phase is not None:
+            rows = 0 if match.group(1) == 'no' else int(match.group(1))
+            self.phase['rows'] = (self.phase['rows'] or 0) + rows
+
+def readOracleMetrics(output, metrics, prefix=''):
+    # Reads the phases of an Oracle script from its output (an open
+    # file) into the given metrics and rewinds the output
+    reader = OracleMetricsReader(metrics, prefix)
+    for line in output:
+        reader.feed(line)
+    output.seek(0)
+
+def oracleDropTableIfExists(tableName):
+    # Returns PL/SQL that drops the given table if it exists
+    return ("begin\n"
+            "  execute immediate 'drop table {}';\n"
+            "exception\n"
+            "  when others then if sqlcode != -0942 then raise; end if;\n"
+            "end;\n"
+            "/".format(tableName))
+
+def oracleMarginalsSpools(parameters, config=None, stratified=False):
+    # Returns sqlplus commands that spool the marginals tables to their
+    # report files (if any).  In a sweep, the configuration is put in
+    # the first column and the files are appended to after the first
+    # configuration.  Stratified tables are in order by stratum first.
+    spools = []
+    for tableName, fileName, column in (
+            (parameters['drugMarginalsTableName'],
+             parameters.get('drugMarginalsFileName'), 'drug'),
+            (parameters['condMarginalsTableName'],
+             parameters.get('condMarginalsFileName'), 'cond'),
+            ):
+        if not fileName:
+            continue
+        if stratified:
+            column = 'stratum, ' + column
+        if config is None:
+            spools.append(
+                'spool {}\nselect *\nfrom {}\norder by {};\nspool off'
+                .format(os.path.abspath(fileName), tableName, column))
+        else:
+            spools.append(
+                'spool {}{}\nselect {} as config, t.*\nfrom {} t\n'
+                'order by {};\nspool off'
+                .format(os.path.abspath(fileName),
+                        ' append' if config > 1 else '',
+                        config, tableName, column))
+    return '\n'.join(spools)
+
+# Number of IDs per insert statement.  Keeps the statements short enough
+# to parse quickly and under the limit on the number of arguments to a
+# collection constructor.
+oracleIdsChunkSize = 500
+
+def oracleIdsInserts(tableName, ids, chunkSize=None):
+    '''Returns SQL statements that insert the given IDs (without
+    duplicates) into the given staging table.
+    '''
+    if chunkSize is None:
+        chunkSize = oracleIdsChunkSize
+    # Remove duplicates, keep order, and format as integers (not reprs)
+    ids = [str(int(id_)) for id_ in collections.OrderedDict.fromkeys(ids)]
+    statements = []
+    for start in range(0, len(ids), chunkSize):
+        statements.append(
+            'insert into {} (id)\n'
+            'select column_value from table(number15_table({}));'
+            .format(tableName, ', '.join(ids[start:start + chunkSize])))
+    return '\n'.join(statements)
+
+def firstOccurrencesSources(parameters, drugIds, condIds):
+    # Returns the name and description of the source of each table of
+    # first occurrences for substituting into the query and cache
+    # templates
+    cacheParameters = dict(
+        cacheTableName=parameters['firstOccurrenceCacheTableName'],
+        cacheSize=max(2, int(parameters['firstOccurrenceCacheSize'])),
+        )
+    drugSource = dict(
+        cacheParameters,
+        bindName='drug_cache_id',
+        eraTableName=parameters['drugEraTableName'],
+        conceptColumn='drug_concept_id',
+        dateColumn='drug_era_start_date',
+        idsTableName=parameters['drugIdsTableName'],
+        offset=int(parameters['drugOccurrenceOffset']),
+        idsHash=idsHash(drugIds),
+        )
+    condSource = dict(
+        cacheParameters,
+        bindName='cond_cache_id',
+        eraTableName=parameters['condEraTableName'],
+        conceptColumn='condition_concept_id',
+        dateColumn='condition_era_start_date',
+        idsTableName=parameters['condIdsTableName'],
+        offset=0,
+        idsHash=idsHash(condIds),
+        )
+    return (('firstDrugs', drugSource), ('firstConds', condSource))
+
+def idsHash(ids):
+    '''Returns a hash (as hex) that identifies the given set of IDs
+    regardless of order and duplicates.
+    '''
+    ids = sorted(set(int(id_) for id_ in ids))
+    return hashlib.sha1(
+        ','.join(str(id_) for id_ in ids).encode('ascii')).hexdigest()
+
+def fillInStratifiedParameters(parameters, drugIds, condIds, dialect):
+    # Fills in the parameters of the stratified script of the given
+    # dialect ('oracle' or 'sqlite'): the type of the strata and the
+    # queries for the first occurrences in each stratum.  The strata
+    # are those of eraStrata, and a person column is compared as text.
+    stratifyBy = parameters['stratifyBy']
+    width = int(parameters['stratumWidth'])
+    isOracle = dialect == 'oracle'
+    personJoin = ''
+    if stratifyBy != 'period':
+        personJoin = '\njoin {} p on p.person_id = e.person_id'.format(
+            parameters['personTableName'])
+    if stratifyBy in ('period', 'age'):
+        parameters['stratumType'] = 'number(9)' if isOracle else 'integer'
+    else:
+        parameters['stratumType'] = 'varchar2(255)' if isOracle else 'text'
+    for name, source in firstOccurrencesSources(
+            parameters, drugIds, condIds):
+        date = 'e.' + source['dateColumn']
+        if isOracle:
+            year = 'extract(year from {})'.format(date)
+            firstDate = 'min({})'.format(date)
+        else:
+            year = "cast(strftime('%Y', {}) as integer)".format(date)
+            firstDate = 'julianday(min({}))'.format(date)
+        if stratifyBy in ('period', 'age'):
+            value = year
+            if stratifyBy == 'age':
+                value = '{} - cast(p.year_of_birth as integer)'.format(year)
+            # Round down to a multiple of the width (SQLite's % keeps
+            # the sign of the dividend)
+            if isOracle:
+                stratum = 'floor(({}) / {}) * {}'.format(value, width, width)
+            else:
+                stratum = '(({0}) - ((({0}) % {1}) + {1}) % {1})'.format(
+                    value, width)
+        elif isOracle:
+            stratum = 'to_char(p.{})'.format(stratifyBy)
+        else:
+            stratum = 'cast(p.{} as text)'.format(stratifyBy)
+        parameters[name + 'Query'] = string.Template(
+            stratifiedFirstOccurrencesQueryTemplate).substitute(
+            source, stratum=stratum, firstDate=firstDate,
+            personJoin=personJoin)
+
+def checkStratifiedRun(parameters):
+    # Raises a ValueError for the stratified runs that the engine cannot
+    # do, before anything runs
+    stratifyBy = parameters.get('stratifyBy')
+    if not re.match(r'^\w+$', stratifyBy or ''):
+        raise ValueError('Unknown stratifyBy: {}'.format(stratifyBy))
+    if parseBoolean(parameters.get('incremental')):
+        raise ValueError('Stratified runs do not support incremental mode.')
+    engine = parameters.get('engine') or 'oracle'
+    if engine in ('numpy', 'bitmap'):
+        if parameters.get('firstOccurrenceStore'):
+            raise ValueError('Stratified runs do not use a first occurrence store.')
+        if parseBoolean(parameters.get('streaming')):
+            raise ValueError('Stratified runs do not support streaming.')
+    else:
+        if parseBoolean(parameters.get('firstOccurrenceCache')):
+            raise ValueError('Stratified runs do not support the first occurrence cache.')
+        if int(parameters.get('shards') or 1) > 1:
+            raise ValueError('Stratified runs do not support sharding.')
+        if parameters.get('runId'):
+            raise ValueError('Stratified runs do not support checkpointed runs.')
+
+# Version of the format of run manifests
+runManifestVersion = 1
+
+# Parameters that the results of the phases of a checkpointed run
+# depend on
+runSignatureParameterNames = (
+    'dbSchemaName', 'drugEraTableName', 'condEraTableName',
+    'conditionWindowStart', 'conditionWindowEnd', 'drugOccurrenceOffset',
+    'pseudocount', 'sparse', 'countsScoresTableName',
+    'drugMarginalsTableName', 'condMarginalsTableName', 'minCtDC')
+
+def runSignature(drugIds, condIds, parameters):
+    '''Returns a hash (as hex) that identifies the IDs and parameters
+    of a checkpointed run, so that it is only resumed with the same.
+    '''
+    content = json.dumps([idsHash(drugIds), idsHash(condIds)] + [
+            str(parameters.get(name)) for name in runSignatureParameterNames])
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+def runManifestFileName(parameters):
+    return os.path.join(parameters.get('checkpointDirectory') or '.',
+                        '{}.json'.format(parameters['runId']))
+
+def readRunManifest(fileName):
+    # Returns the manifest of a checkpointed run or None if there is none
+    if not os.path.exists(fileName):
+        return None
+    with open(fileName) as manifestFile:
+        manifest = json.load(
+            manifestFile, object_pairs_hook=collections.OrderedDict)
+    if manifest.get('version') != runManifestVersion:
+        raise ValueError('Unknown version of run manifest {}: {}'.format(
+                fileName, manifest.get('version')))
+    return manifest
+
+def writeRunManifest(fileName, manifest):
+    # Writes the manifest to a temporary file and renames it so that a
+    # failure never leaves a partial manifest
+    directory = os.path.dirname(fileName) or '.'
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    tempFileName = fileName + '.tmp'
+    with open(tempFileName, 'w') as manifestFile:
+        json.dump(manifest, manifestFile, indent=2)
+        manifestFile.write('\n')
+    os.rename(tempFileName, fileName)
+
+class SqliteBackend(Backend):
+    '''Counts in an embedded SQLite database of era tables.  If CSV
+    extracts are given, they are loaded into the database first.
+    '''
+
+    # Connection kept open between runs by warmUp
+    connection = None
+
+    def connect(self):
+        # Returns the kept connection or opens one.  Either is recorded
+        # with the job of the current thread so that cancelling the job
+        # interrupts its statements.
+        job = currentScoringJob()
+        if self.connection is not None:
+            if job is not None:
+                job.addConnection(self.connection)
+            return self.connection
+        parameters = self.parameters
+        dbFileName = parameters.get('sqliteDbFileName') or ':memory:'
+        logger = logging.getLogger(__name__)
+        logger.info('Opening SQLite DB: %s', dbFileName)
+        connection = sqlite3.connect(dbFileName)
+        if job is not None:
+            job.addConnection(connection)
+        if parameters.get('drugEraFileName'):
+            with self.metrics.timed('load_drug_eras'):
+                loadEraCsvIntoSqlite(
+                    connection, parameters['drugEraFileName'],
+                    parameters['drugEraTableName'], 'drug')
+        if parameters.get('condEraFileName'):
+            with self.metrics.timed('load_cond_eras'):
+                loadEraCsvIntoSqlite(
+                    connection, parameters['condEraFileName'],
+                    parameters['condEraTableName'], 'condition')
+        if parameters.get('personFileName') and parameters.get('stratifyBy'):
+            with self.metrics.timed('load_persons'):
+                loadPersonCsvIntoSqlite(
+                    connection, parameters['personFileName'],
+                    parameters['personTableName'])
+        return connection
+
+    def convertParameters(self):
+        # Convert the parameters, which may be strings from a config
+        # file, so that they are safe to put in SQL
+        parameters = self.parameters
+        parameters['conditionWindowStart'] = int(parameters['conditionWindowStart'])
+        parameters['conditionWindowEnd'] = int(parameters['conditionWindowEnd'])
+        parameters['drugOccurrenceOffset'] = int(parameters['drugOccurrenceOffset'])
+        parameters['pseudocount'] = repr(float(parameters['pseudocount']))
+
+    def iterRows(self, drugIds, condIds):
+        parameters = self.parameters
+        self.convertParameters()
+        explain = parseBoolean(parameters.get('explainQueryPlans'))
+        if parseBoolean(parameters.get('incremental')):
+            scriptTemplate = sqliteIncrementalScriptTemplate
+            idsTablePrefix = 'new_'
+        elif parseBoolean(parameters.get('normalized')):
+            scriptTemplate = sqliteNormalizedScriptTemplate
+            idsTablePrefix = ''
+            parameters['reportRowsSource'] = string.Template(
+                normalizedReportRowsTemplate).substitute(parameters)
+        else:
+            scriptTemplate = sqliteScriptTemplate
+            idsTablePrefix = ''
+        connection = self.connect()
+        try:
+            with self.metrics.timed('stage_ids'):
+                self.stageIds(connection, drugIds, condIds, idsTablePrefix)
+            if idsTablePrefix:
+                sqliteCheckIncrementalState(connection, parameters)
+            # Run the script
+            script = string.Template(scriptTemplate).substitute(parameters)
+            runSqliteScript(connection, script, explain, self.metrics)
+            connection.commit()
+            writeMarginalsReports(
+                (tuple(row) for row in connection.execute(
+                        'select * from {} order by drug'.format(
+                            parameters['drugMarginalsTableName']))),
+                (tuple(row) for row in connection.execute(
+                        'select * from {} order by cond'.format(
+                            parameters['condMarginalsTableName']))),
+                parameters)
+            # Generate the report rows from the results table
+            query = string.Template(reportQueryTemplate).substitute(parameters)
+            with self.metrics.timed('report') as phase:
+                phase['rows'] = 0
+                for row in connection.execute(query):
+                    phase['rows'] += 1
+                    yield ReportRow._make(row)
+        finally:
+            self.release(connection)
+
+    def iterSweepRows(self, drugIds, condIds, configs):
+        parameters = self.parameters
+        if parseBoolean(parameters.get('incremental')):
+            raise ValueError('Sweeps do not support incremental mode.')
+        explain = parseBoolean(parameters.get('explainQueryPlans'))
+        # Find the first occurrences without any offset and join them
+        # with the widest window of all the configurations
+        parameters['drugOccurrenceOffset'] = 0
+        (parameters['conditionWindowStart'],
+         parameters['conditionWindowEnd']) = sweepJoinWindow(configs)
+        connection = self.connect()
+        try:
+            with self.metrics.timed('stage_ids'):
+                self.stageIds(connection, drugIds, condIds, '')
+            script = string.Template(sqliteSetupScriptTemplate).substitute(
+                parameters)
+            runSqliteScript(connection, script, explain, self.metrics)
+            # Count, score, and report each configuration from the shared
+            # join.  Configurations that only differ in pseudocount reuse
+            # the counts.
+            countsTemplate = string.Template(
+                sweepClearScriptTemplate + sqliteCountsScriptTemplate)
+            scoresTemplate = string.Template(sqliteScoresScriptTemplate)
+            query = string.Template(reportQueryTemplate).substitute(parameters)
+            drugMarginalsRows = []
+            condMarginalsRows = []
+            for index, config, isNewCounts in iterSweepCounts(configs):
+                configParameters = dict(parameters)
+                configParameters.update(sweepConfigParameters(config))
+                if isNewCounts:
+                    configParameters['firstDrugsConds'] = string.Template(
+                        sweepDrugsCondsTemplate).substitute(configParameters)
+                    runSqliteScript(
+                        connection,
+                        countsTemplate.substitute(configParameters), explain,
+                        self.metrics)
+                runSqliteScript(
+                    connection, scoresTemplate.substitute(configParameters),
+                    explain, self.metrics)
+                drugMarginalsRows.extend(
+                    (index,) + tuple(row) for row in connection.execute(
+                        'select * from {} order by drug'.format(
+                            parameters['drugMarginalsTableName'])))
+                condMarginalsRows.extend(
+                    (index,) + tuple(row) for row in connection.execute(
+                        'select * from {} order by cond'.format(
+                            parameters['condMarginalsTableName'])))
+                with self.metrics.timed('report') as phase:
+                    phase['rows'] = 0
+                    for row in connection.execute(query):
+                        phase['rows'] += 1
+                        yield SweepRow(index, *row)
+            connection.commit()
+            writeMarginalsReports(
+                drugMarginalsRows, condMarginalsRows, parameters)
+        finally:
+            self.release(connection)
+
+    def iterStratifiedRows(self, drugIds, condIds):
+        parameters = self.parameters
+        self.convertParameters()
+        explain = parseBoolean(parameters.get('explainQueryPlans'))
+        connection = self.connect()
+        try:
+            with self.metrics.timed('stage_ids'):
+                self.stageIds(connection, drugIds, condIds, '')
+            fillInStratifiedParameters(parameters, drugIds, condIds, 'sqlite')
+            script = string.Template(sqliteStratifiedScriptTemplate).substitute(
+                parameters)
+            runSqliteScript(connection, script, explain, self.metrics)
+            connection.commit()
+            writeMarginalsReports(
+                (tuple(row) for row in connection.execute(
+                        'select * from {} order by stratum, drug'.format(
+                            parameters['drugMarginalsTableName']))),
+                (tuple(row) for row in connection.execute(
+                        'select * from {} order by stratum, cond'.format(
+                            parameters['condMarginalsTableName']))),
+                parameters)
+            query = 'select * from {} order by stratum, drug, cond'.format(
+                parameters['countsScoresTableName'])
+            with self.metrics.timed('report') as phase:
+                phase['rows'] = 0
+                for row in connection.execute(query):
+                    phase['rows'] += 1
+                    yield StratumRow._make(row)
+        finally:
+            self.release(connection)
+
+    def warmUp(self):
+        self.connection = self.connect()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def release(self, connection):
+        # Close the connection unless it is kept open
+        if connection is not self.connection:
+            connection.close()
+
+    def stageIds(self, connection, drugIds, condIds, idsTablePrefix):
+        # Stage the IDs and construct the queries for their first
+        # occurrences, which come from the cache if it is enabled
+        parameters = self.parameters
+        for idsTableName, ids in (
+                (idsTablePrefix + 'drug_ids', drugIds),
+                (idsTablePrefix + 'cond_ids', condIds),
+                ):
+            connection.execute(
+                'drop table if exists temp.{}'.format(idsTableName))
+            connection.execute(
+                'create temporary table {} (id integer primary key)'
+                .format(idsTableName))
+            connection.executemany(
+                'insert or ignore into {} values (?)'.format(idsTableName),
+                ((int(id_),) for id_ in ids))
+        useCache = parseBoolean(parameters.get('firstOccurrenceCache'))
+        for name, source in firstOccurrencesSources(
+                parameters, drugIds, condIds):
+            query = string.Template(
+                sqliteFirstOccurrencesQueryTemplate).substitute(source)
+            if useCache:
+                source['firstOccurrencesQuery'] = query
+                query = string.Template(
+                    cachedFirstOccurrencesQueryTemplate).substitute(
+                    source, cacheId=sqliteCacheLookup(connection, source))
+            parameters[name + 'Query'] = query
+
+def sqliteCacheLookup(connection, source):
+    '''Returns the ID of the valid cache entry for the first
+    occurrences described by the given source, filling a new entry if
+    there is none.  Entries are invalid if the row count or maximum
+    start date of the rows of their IDs in the era table has changed.  Evicts the least
+    recently used entries beyond the cache size.
+    '''
+    logger = logging.getLogger(__name__)
+    cacheTableName = source['cacheTableName']
+    connection.execute(
+        'create table if not exists {} (cache_id integer primary key, '
+        'era_table text not null, occ_offset integer not null, '
+        'ids_hash text not null, fingerprint text not null, '
+        'last_used integer not null)'.format(cacheTableName))
+    connection.execute(
+        'create table if not exists {}_data (cache_id integer not null, '
+        'person integer not null, concept integer not null, '
+        'occ_date real not null)'.format(cacheTableName))
+    connection.execute(
+        'create index if not exists {0}_data_idx on {0}_data (cache_id)'
+        .format(cacheTableName))
+    fingerprint = '{}:{}'.format(*connection.execute(
+            'select count(*), max(e.{dateColumn}) from {eraTableName} e '
+            'join {idsTableName} ids on ids.id = e.{conceptColumn}'
+            .format(**source)).fetchone())
+    key = (source['eraTableName'], source['offset'], source['idsHash'])
+    keyCondition = 'era_table = ? and occ_offset = ? and ids_hash = ?'
+    row = connection.execute(
+        'select cache_id, fingerprint from {} where {}'.format(
+            cacheTableName, keyCondition), key).fetchone()
+    if row is not None and row[1] == fingerprint:
+        cacheId = row[0]
+        logger.info('Using cached first occurrences from %s: %s',
+                    source['eraTableName'], cacheId)
+    else:
+        # Remove any stale entry and fill a new one
+        if row is not None:
+            connection.execute(
+                'delete from {}_data where cache_id = ?'.format(
+                    cacheTableName), (row[0],))
+            connection.execute(
+                'delete from {} where cache_id = ?'.format(cacheTableName),
+                (row[0],))
+        cursor = connection.execute(
+            'insert into {} (era_table, occ_offset, ids_hash, fingerprint, '
+            'last_used) values (?, ?, ?, ?, 0)'.format(cacheTableName),
+            key + (fingerprint,))
+        cacheId = cursor.lastrowid
+        logger.info('Caching first occurrences from %s: %s',
+                    source['eraTableName'], cacheId)
+        connection.execute(
+            'insert into {}_data (cache_id, person, concept, occ_date) '
+            'select ?, fo.person, fo.concept, fo.occ_date from ({}) fo'
+            .format(cacheTableName, source['firstOccurrencesQuery']),
+            (cacheId,))
+    # Mark the entry as the most recently used
+    connection.execute(
+        'update {0} set last_used = '
+        '(select max(last_used) + 1 from {0}) where cache_id = ?'
+        .format(cacheTableName), (cacheId,))
+    # Evict the least recently used entries
+    evicted = [row[0] for row in connection.execute(
+            'select cache_id from {} order by last_used desc '
+            'limit -1 offset ?'.format(cacheTableName),
+            (source['cacheSize'],))]
+    for evictedId in evicted:
+        logger.info('Evicting cached first occurrences: %s', evictedId)
+        connection.execute(
+            'delete from {}_data where cache_id = ?'.format(cacheTableName),
+            (evictedId,))
+        connection.execute(
+            'delete from {} where cache_id = ?'.format(cacheTableName),
+            (evictedId,))
+    connection.commit()
+    return cacheId
+
+def sqliteCheckIncrementalState(connection, parameters):
+    '''Checks that the state of previous incremental runs was built with
+    the same window, offset, and era data (row count and maximum start
+    date of each era table) as this run.  If not, discards the state
+    and stages the IDs scored so far with the given ones so that the
+    run rebuilds everything.  Records the settings and data of this run.
+    '''
+    logger = logging.getLogger(__name__)
+    countsTableName = parameters['countsScoresTableName']
+    connection.execute(
+        'create table if not exists {}_state (window_start integer, '
+        'window_end integer, occ_offset integer, drug_eras text, '
+        'cond_eras text)'.format(countsTableName))
+    state = (
+        parameters['conditionWindowStart'],
+        parameters['conditionWindowEnd'],
+        parameters['drugOccurrenceOffset'],
+        ) + tuple('{}:{}'.format(*connection.execute(
+                'select count(*), max({}) from {}'.format(
+                    dateColumn, parameters[tableName])).fetchone())
+                  for tableName, dateColumn in (
+                ('drugEraTableName', 'drug_era_start_date'),
+                ('condEraTableName', 'condition_era_start_date')))
+    savedState = connection.execute(
+        'select * from {}_state'.format(countsTableName)).fetchone()
+    if savedState is not None and tuple(savedState) == state:
+        return
+    hasState = connection.execute(
+        "select count(*) from sqlite_master where type = 'table' "
+        "and name = ?", (countsTableName + '_drug_ids',)).fetchone()[0]
+    if hasState:
+        logger.warning('Rebuilding the incremental state of %s because '
+                       'the settings or era data changed', countsTableName)
+        for idsType in ('drug', 'cond'):
+            connection.execute(
+                'insert or ignore into new_{0}_ids (id) '
+                'select id from {1}_{0}_ids'.format(idsType, countsTableName))
+        for suffix in ('_drug_ids', '_cond_ids', '_fd', '_fc', '_fdc', ''):
+            connection.execute(
+                'delete from {}{}'.format(countsTableName, suffix))
+    connection.execute('delete from {}_state'.format(countsTableName))
+    connection.execute(
+        'insert into {}_state values (?, ?, ?, ?, ?)'.format(countsTableName),
+        state)
+
+def splitSqlScript(script):
+    # Splits a script into statements without their comment lines
+    # (Python 2 sqlite3 needs each statement to start with its keyword).
+    # Only works for scripts without semicolons at the ends of lines in
+    # literals or comments.
+    for statement in script.split(';\n'):
+        code = '\n'.join(line for line in statement.splitlines()
+                         if not line.strip().startswith('--'))
+        code = code.strip().rstrip(';')
+        if code:
+            yield code
+
+def runSqliteScript(connection, script, explain=False, metrics=None):
+    # Runs the statements of the script, recording each as a phase named
+    # by its first line in the given metrics (if any)
+    logger = logging.getLogger(__name__)
+    logger.info('Running SQLite script')
+    for statement in splitSqlScript(script):
+        # Interrupting only stops the running statement
+        checkCancelled()
+        logger.debug('SQLite statement:\n%s', statement)
+        # Summarize the statement by its first line
+        summary = statement.splitlines()[0].strip()
+        # Log the query plan of the statement before running it
+        if explain and summary.split()[0].lower() in ('insert', 'update', 'select'):
+            plan = connection.execute('explain query plan ' + statement)
+            logger.info('Query plan for: %s\n%s', summary, '\n'.join(
+                    ' '.join(str(field) for field in row) for row in plan))
+        start = time.time()
+        cursor = connection.execute(statement)
+        seconds = time.time() - start
+        logger.log(logging.INFO if explain else logging.DEBUG,
+                   'SQLite statement took %.3f s and changed %s rows: %s',
+                   seconds, cursor.rowcount, summary)
+        if metrics is not None:
+            metrics.add(summary.rstrip(' ('), seconds,
+                        cursor.rowcount if cursor.rowcount >= 0 else None)
+    logger.info('SQLite script done.')
+
+def loadEraCsvIntoSqlite(connection, fileName, tableName, eraType):
+    '''Loads a CSV extract of an era table (with a header row) into the
+    given table, replacing it, and indexes it for the scoring queries.
+    '''
+    logger = logging.getLogger(__name__)
+    logger.info('Loading era records from %s into SQLite table: %s',
+                fileName, tableName)
+    with open(fileName, 'r') as csvFile:
+        reader = csv.reader(csvFile)
+        header = [name.strip().lower() for name in next(reader)]
+        columns = ('person_id', eraType + '_concept_id',
+                   eraType + '_era_start_date')
+        indices = [header.index(column) for column in columns]
+        connection.execute('drop table if exists {}'.format(tableName))
+        connection.execute(
+            'create table {} (person_id integer not null, '
+            '{}_concept_id integer not null, {}_era_start_date text not null)'
+            .format(tableName, eraType, eraType))
+        connection.executemany(
+            'insert into {} values (?, ?, ?)'.format(tableName),
+            ((int(row[indices[0]]), int(row[indices[1]]),
+              row[indices[2]].strip()[:10])
+             for row in reader if row))
+    # Index so that the first occurrence queries only read the index
+    connection.execute(
+        'create index {0}_concept_idx on {0} '
+        '({1}_concept_id, person_id, {1}_era_start_date)'
+        .format(tableName, eraType))
+    connection.commit()
+
+def loadPersonCsvIntoSqlite(connection, fileName, tableName):
+    '''Loads a CSV extract of the person table (with a header row) into
+    the given table, replacing it.  The columns other than `person_id`
+    are loaded as text (stripped), as readPersonCsv reads them.
+    '''
+    logger = logging.getLogger(__name__)
+    logger.info('Loading persons from %s into SQLite table: %s',
+                fileName, tableName)
+    with open(fileName, 'r') as csvFile:
+        reader = csv.reader(csvFile)
+        header = [name.strip().lower() for name in next(reader)]
+        for name in header:
+            if not re.match(r'^\w+$', name):
+                raise ValueError('Bad column name in {}: {}'.format(
+                        fileName, name))
+        connection.execute('drop table if exists {}'.format(tableName))
+        connection.execute('create table {} ({})'.format(
+                tableName, ', '.join(
+                    name + (' integer' if name == 'person_id' else ' text')
+                    for name in header)))
+        connection.executemany(
+            'insert into {} values ({})'.format(
+                tableName, ', '.join('?' * len(header))),
+            ([field.strip() for field in row] for row in reader if row))
+    connection.execute(
+        'create index {0}_person_idx on {0} (person_id)'.format(tableName))
+    connection.commit()
+
+# Names of the report columns in order
+reportColumnNames = (
+    'drug', 'cond',
+    'ct_d_bef_c', 'ct_c_bef_d', 'ct_d_c',
+    'ct_d_bef_anyc', 'ct_d_anyc', 'ct_anyd_bef_c', 'ct_anyd_c',
+    'ct_d', 'ct_c', 'ct_ppl',
+    'temporal_score',
+    )
+
+# A row of the report with its values as ints and a float score
+ReportRow = collections.namedtuple('ReportRow', reportColumnNames)
+
+# Parameters that can be given lists of values to sweep over.  A sweep
+# evaluates every combination of their values.
+sweepParameterNames = (
+    'conditionWindowStart', 'conditionWindowEnd',
+    'drugOccurrenceOffset', 'pseudocount',
+    )
+
+SweepConfig = collections.namedtuple('SweepConfig', sweepParameterNames)
+
+# Report rows of a sweep have the number of their configuration first
+SweepRow = collections.namedtuple('SweepRow', ('config',) + reportColumnNames)
+
+# Report rows of stratified runs
+StratumRow = collections.namedtuple('StratumRow', ('stratum',) + reportColumnNames)
+
+# Rows of normalized reports only have the columns of the pair.  The
+# other columns are in the marginals reports and the run summary.
+pairColumnNames = (
+    'drug', 'cond', 'ct_d_bef_c', 'ct_c_bef_d', 'ct_d_c', 'temporal_score')
+
+PairRow = collections.namedtuple('PairRow', pairColumnNames)
+
+def parseValues(value, convert):
+    # Interpret a single value or a list of values given as a sequence
+    # or as a comma-separated string in a config file
+    if isinstance(value, str):
+        value = [field for field in value.split(',') if field.strip()]
+    elif not isinstance(value, (list, tuple)):
+        value = [value]
+    return [convert(field) for field in value]
+
+def sweepConfigurations(parameters):
+    '''Returns the grid of configurations (as SweepConfig tuples) given
+    by the lists of values of the sweep parameters.  Parameters with a
+    single value are the same in every configuration.
+    '''
+    values = [parseValues(parameters[name],
+                          float if name == 'pseudocount' else int)
+              for name in sweepParameterNames]
+    return [SweepConfig._make(combination)
+            for combination in itertools.product(*values)]
+
+def requireSingleConfiguration(parameters):
+    if len(sweepConfigurations(parameters)) > 1:
+        raise ValueError('Multiple configurations given.  '
+                         'Use iterSweepScores to sweep over them.')
+
+def sweepJoinWindow(configs):
+    # Returns the window of unshifted drug occurrences that contains the
+    # windows of all the configurations
+    return (min(config.conditionWindowStart + config.drugOccurrenceOffset
+                for config in configs),
+            max(config.conditionWindowEnd + config.drugOccurrenceOffset
+                for config in configs))
+
+def iterSweepCounts(configs):
+    # Generates the number of each configuration, the configuration, and
+    # whether its counts differ from those of the previous configuration
+    # (only the pseudocount does not change the counts)
+    previousKey = None
+    for index, config in enumerate(configs, start=1):
+        key = config[:3]
+        yield index, config, key != previousKey
+        previousKey = key
+
+def sweepConfigParameters(config):
+    # Returns the script parameters of a configuration of a sweep
+    return dict(
+        conditionWindowStart=config.conditionWindowStart,
+        conditionWindowEnd=config.conditionWindowEnd,
+        drugOccurrenceOffset=config.drugOccurrenceOffset,
+        joinWindowStart=(
+            config.conditionWindowStart + config.drugOccurrenceOffset),
+        joinWindowEnd=config.conditionWindowEnd + config.drugOccurrenceOffset,
+        pseudocount=repr(config.pseudocount),
+        )
+
+# Parameters that select the report rows to keep
+selectionParameterNames = ('topK', 'minScore', 'minCtDC')
+
+def selectionParameters(parameters):
+    '''Returns the values of the selection parameters (topK, minScore,
+    and minCtDC) converted from the given parameters, with None for
+    those not given.
+    '''
+    def convert(name, convert):
+        value = parameters.get(name)
+        if value is None or (isinstance(value, str) and not value.strip()):
+            return None
+        return convert(value)
+    return (convert('topK', int), convert('minScore', float),
+            convert('minCtDC', int))
+
+def selectReportRows(rows, topK=None, minScore=None, minCtDC=None):
+    '''Selects the report rows with a score of at least minScore and a
+    `ct_d_c` of at least minCtDC and then, if topK is given, the topK
+    rows with the highest scores in order by decreasing score (rows
+    with the same score stay in their order).  Only topK rows are kept
+    in memory at once.  Returns an iterator of the selected rows.
+    '''
+    rows = iter(rows)
+    if minScore is not None:
+        rows = (row for row in rows if row.temporal_score >= minScore)
+    if minCtDC is not None:
+        rows = (row for row in rows if row.ct_d_c >= minCtDC)
+    if topK is not None:
+        rows = iter(heapq.nlargest(
+                topK, rows, key=lambda row: row.temporal_score))
+    return rows
+
+def selectGroupedRows(rows, topK=None, minScore=None, minCtDC=None):
+    # Selects the rows of each group (configuration of a sweep or
+    # stratum, given by the first field) as selectReportRows does
+    for group, groupRows in itertools.groupby(rows, key=lambda row: row[0]):
+        for row in selectReportRows(groupRows, topK, minScore, minCtDC):
+            yield row
+
+def parseReportFields(fields):
+    # Convert the fields of a report line (CSV or sqlplus-spooled with
+    # padding) to a report row
+    score = fields[12].strip()
+    return ReportRow._make(
+        [int(field) for field in fields[:12]]
+        + [float(score) if score else None])
+
+def readReportRows(reportFile):
+    '''Generates the rows of a report file (CSV or sqlplus-spooled) as
+    ReportRow tuples.
+    '''
+    for fields in csv.reader(reportFile):
+        if fields:
+            yield parseReportFields(fields)
+
+# Names of the columns of the marginals reports in order
+drugMarginalsColumnNames = ('drug', 'ct_d_bef_anyc', 'ct_d_anyc', 'ct_d', 'ct_ppl')
+condMarginalsColumnNames = ('cond', 'ct_anyd_bef_c', 'ct_anyd_c', 'ct_c', 'ct_ppl')
+
+# Counts of people as arrays indexed by drug index and/or condition
+# index.  Pair counts are D x C, drug counts are D, condition counts are
+# C, and the count of people is a scalar.
+Counts = collections.namedtuple('Counts', (
+        'ct_d_bef_c', 'ct_c_bef_d', 'ct_d_c',
+        'ct_d_bef_anyc', 'ct_d_anyc', 'ct_anyd_bef_c', 'ct_anyd_c',
+        'ct_d', 'ct_c', 'ct_ppl',
+        ))
+
+def requireNumpy():
+    if numpy is None:
+        raise ImportError('The local counting engine requires NumPy.')
+
+def iterEraCsvRecords(csvFile, conceptColumn, dateColumn,
+                      personColumn='person_id'):
+    # Generates the (person ID, concept ID, start date) records of an
+    # open CSV extract of an era table as read by readEraCsv
+    reader = csv.reader(csvFile)
+    header = [name.strip().lower() for name in next(reader)]
+    personIndex = header.index(personColumn)
+    conceptIndex = header.index(conceptColumn)
+    dateIndex = header.index(dateColumn)
+    for row in reader:
+        if not row:
+            continue
+        yield (int(row[personIndex]), int(row[conceptIndex]),
+               row[dateIndex].strip()[:10])
+
+def eraRecordsArrays(persons, concepts, dates):
+    # Converts lists of the fields of era records to arrays of person
+    # IDs, concept IDs, and days from the Unix epoch
+    return (numpy.array(persons, dtype=numpy.int64),
+            numpy.array(concepts, dtype=numpy.int64),
+            numpy.array(dates, dtype='datetime64[D]').astype(numpy.int64))
+
+def readEraCsv(fileName, conceptColumn, dateColumn, personColumn='person_id'):
+    '''Reads era records from a CSV extract of an era table and returns
+    them as arrays of person IDs, concept IDs, and start days.
+
+    The extract must have a header row naming the columns as in the CDM
+    era table.  Dates must be in ISO format (YYYY-MM-DD); any time part
+    is ignored.  Days are counted from the Unix epoch.
+    '''
+    requireNumpy()
+    logger = logging.getLogger(__name__)
+    logger.info('Reading era records from: %s', fileName)
+    persons = []
+    concepts = []
+    dates = []
+    with open(fileName, 'r') as csvFile:
+        for person, concept, date in iterEraCsvRecords(
+                csvFile, conceptColumn, dateColumn, personColumn):
+            persons.append(person)
+            concepts.append(concept)
+            dates.append(date)
+    logger.info('Read %s era records', len(dates))
+    return eraRecordsArrays(persons, concepts, dates)
+
+def iterPersonSortedRecords(records, fileName):
+    # Passes through the records, checking that they are sorted by
+    # person
+    lastPerson = None
+    for record in records:
+        if lastPerson is not None and record[0] < lastPerson:
+            raise ValueError(
+                'Era records are not sorted by person_id: {} after {} in {}'
+                .format(record[0], lastPerson, fileName))
+        lastPerson = record[0]
+        yield record
+
+def iterEraChunks(drugEraFileName, condEraFileName, drugIds, condIds,
+                  chunkSize):
+    '''Reads the CSV extracts of the drug and condition era tables, which
+    must be sorted by person, in a single pass and generates chunks of
+    their records as pairs of drug era arrays and condition era arrays
+    (as returned by readEraCsv).  Only the records of the given IDs are
+    kept.  Each chunk has all the records of its people and at least
+    the given number of records (except the last), so memory is bounded
+    by the chunk size rather than by the size of the extracts.
+    '''
+    drugIds = set(drugIds)
+    condIds = set(condIds)
+    with open(drugEraFileName, 'r') as drugFile, \
+            open(condEraFileName, 'r') as condFile:
+        drugRecords = iterPersonSortedRecords(iterEraCsvRecords(
+                drugFile, 'drug_concept_id', 'drug_era_start_date'),
+                                              drugEraFileName)
+        condRecords = iterPersonSortedRecords(iterEraCsvRecords(
+                condFile, 'condition_concept_id',
+                'condition_era_start_date'), condEraFileName)
+        drugBuffer = ([], [], [])
+        condBuffer = ([], [], [])
+        drugRecord = next(drugRecords, None)
+        condRecord = next(condRecords, None)
+        while drugRecord is not None or condRecord is not None:
+            # Buffer the records of the next person in both extracts
+            person = min(record[0] for record in (drugRecord, condRecord)
+                         if record is not None)
+            while drugRecord is not None and drugRecord[0] == person:
+                if drugRecord[1] in drugIds:
+                    for field, values in zip(drugRecord, drugBuffer):
+                        values.append(field)
+                drugRecord = next(drugRecords, None)
+            while condRecord is not None and condRecord[0] == person:
+                if condRecord[1] in condIds:
+                    for field, values in zip(condRecord, condBuffer):
+                        values.append(field)
+                condRecord = next(condRecords, None)
+            # Emit the buffers once they are big enough
+            if len(drugBuffer[0]) + len(condBuffer[0]) >= chunkSize:
+                yield (eraRecordsArrays(*drugBuffer),
+                       eraRecordsArrays(*condBuffer))
+                drugBuffer = ([], [], [])
+                condBuffer = ([], [], [])
+        if drugBuffer[0] or condBuffer[0]:
+            yield eraRecordsArrays(*drugBuffer), eraRecordsArrays(*condBuffer)
+
+def firstOccurrences(persons, concepts, days, ids):
+    '''Returns the first occurrence of each concept in each person as
+    arrays of persons, concept indices, and days, sorted by person and
+    then concept.  Only concepts in the given sorted array of IDs are
+    kept and they are converted to indices into that array.
+    '''
+    keep = numpy.isin(concepts, ids)
+    persons, concepts, days = persons[keep], concepts[keep], days[keep]
+    # Sort so that the first record of each (person, concept) group is
+    # the earliest
+    order = numpy.lexsort((days, concepts, persons))
+    persons, concepts, days = persons[order], concepts[order], days[order]
+    isFirst = numpy.ones(len(persons), dtype=bool)
+    isFirst[1:] = ((persons[1:] != persons[:-1])
+                   | (concepts[1:] != concepts[:-1]))
+    return (persons[isFirst],
+            numpy.searchsorted(ids, concepts[isFirst]),
+            days[isFirst])
+
+def joinFirstOccurrences(firstDrugs, firstConds, windowStart, windowEnd):
+    '''Joins first drug occurrences and first condition occurrences on
+    person, keeping only the condition occurrences within the window
+    around the drug occurrence.  Returns arrays of row indices into the
+    first drugs and the first conditions.
+    '''
+    drugPersons, drugIdxs, drugDays = firstDrugs
+    condPersons, condIdxs, condDays = firstConds
+    # Find the range of condition rows for the person of each drug row
+    lows = numpy.searchsorted(condPersons, drugPersons, side='left')
+    highs = numpy.searchsorted(condPersons, drugPersons, side='right')
+    lengths = highs - lows
+    # Expand each drug row into the condition rows of its person
+    drugRows = numpy.repeat(numpy.arange(len(drugPersons)), lengths)
+    starts = numpy.cumsum(lengths) - lengths
+    condRows = (numpy.arange(lengths.sum())
+                - numpy.repeat(starts, lengths)
+                + numpy.repeat(lows, lengths))
+    # Apply the window
+    offsets = condDays[condRows] - drugDays[drugRows]
+    inWindow = (offsets >= windowStart) & (offsets <= windowEnd)
+    return drugRows[inWindow], condRows[inWindow]
+
+def numpyCounts(firstDrugs, firstConds, numDrugs, numConds,
+                windowStart, windowEnd):
+    '''Counts people for all the report columns from first occurrences.
+    Each first occurrence is unique per person, so counts of distinct
+    people are counts of rows (or of distinct first occurrence rows).
+    '''
+    drugRows, condRows = joinFirstOccurrences(
+        firstDrugs, firstConds, windowStart, windowEnd)
+    before = firstDrugs[2][drugRows] < firstConds[2][condRows]
+    return joinCounts(firstDrugs, firstConds, numDrugs, numConds,
+                      drugRows, condRows, before)
+
+def joinCounts(firstDrugs, firstConds, numDrugs, numConds,
+               drugRows, condRows, before, minPairCount=0, pairMask=None):
+    '''Counts people for all the report columns from first occurrences
+    and their join (as returned by joinFirstOccurrences) given whether
+    the drug occurrence is before the condition occurrence in each
+    joined row.
+
+    Pairs whose `ct_d_c` cannot reach the given minimum because their
+    drug or condition has fewer people with any pair (`ct_d_anyc` or
+    `ct_anyd_c`) are not counted and have pair counts of zero.  If a
+    pair mask (masks of the drugs and of the conditions that can pair,
+    as from pairMasks) is given, it prunes instead.
+    '''
+    drugPersons, drugIdxs, drugDays = firstDrugs
+    condPersons, condIdxs, condDays = firstConds
+    numPairs = numDrugs * numConds
+    def pairCounts(idxs):
+        return numpy.bincount(idxs, minlength=numPairs).reshape(
+            (numDrugs, numConds))
+    def rowCounts(rows, idxs, length):
+        return numpy.bincount(idxs[numpy.unique(rows)], minlength=length)
+    ct_d_anyc = rowCounts(drugRows, drugIdxs, numDrugs)
+    ct_anyd_c = rowCounts(condRows, condIdxs, numConds)
+    pairDrugRows, pairCondRows, pairBefore = drugRows, condRows, before
+    if pairMask is None and minPairCount > 0:
+        pairMask = (ct_d_anyc >= minPairCount, ct_anyd_c >= minPairCount)
+    if pairMask is not None:
+        canPair = (pairMask[0][drugIdxs[drugRows]]
+                   & pairMask[1][condIdxs[condRows]])
+        pairDrugRows = drugRows[canPair]
+        pairCondRows = condRows[canPair]
+        pairBefore = before[canPair]
+    pairIdxs = drugIdxs[pairDrugRows] * numConds + condIdxs[pairCondRows]
+    ct_d_c = pairCounts(pairIdxs)
+    ct_d_bef_c = pairCounts(pairIdxs[pairBefore])
+    return Counts(
+        ct_d_bef_c=ct_d_bef_c,
+        ct_c_bef_d=ct_d_c - ct_d_bef_c,
+        ct_d_c=ct_d_c,
+        ct_d_bef_anyc=rowCounts(drugRows[before], drugIdxs, numDrugs),
+        ct_d_anyc=ct_d_anyc,
+        ct_anyd_bef_c=rowCounts(condRows[before], condIdxs, numConds),
+        ct_anyd_c=ct_anyd_c,
+        ct_d=numpy.bincount(drugIdxs, minlength=numDrugs),
+        ct_c=numpy.bincount(condIdxs, minlength=numConds),
+        ct_ppl=len(numpy.union1d(drugPersons, condPersons)),
+        )
+
+def partitionCounts(partition):
+    '''Counts people for all the report columns from the era records of
+    a partition of the people for each of the given (window start,
+    window end, offset) settings.  The partition is a tuple of the drug
+    era arrays, the condition era arrays (as returned by readEraCsv),
+    the sorted arrays of drug and condition IDs, the settings, and the
+    function that counts the first occurrences (sweepCounts or
+    bitmapCounts).  Returns a list of Counts, one for each setting.
+
+    Shifting the drug by the offset shifts the window by the offset and
+    makes the drug before the condition when the days between them are
+    more than the offset, so the first occurrences are found once for
+    all the settings.
+    '''
+    logger = logging.getLogger(__name__)
+    drugEras, condEras, drugIds, condIds, settings, countsFunction = partition
+    firstDrugs = firstOccurrences(*(tuple(drugEras) + (drugIds,)))
+    firstConds = firstOccurrences(*(tuple(condEras) + (condIds,)))
+    logger.info('Found %s first drug occurrences and %s first condition occurrences',
+                len(firstDrugs[0]), len(firstConds[0]))
+    return countsFunction(
+        firstDrugs, firstConds, len(drugIds), len(condIds), settings)
+
+def firstOccurrencesCounts(firstDrugs, firstConds, numDrugs, numConds,
+                           settings, minPairCount=0, pairMasks=None):
+    # Counts people from first occurrences for each of the given
+    # settings as in partitionCounts, pruning pairs as joinCounts does.
+    # Joins all the first occurrences of each person, so sweepCounts is
+    # used instead; this is the reference it is tested against.
+    logger = logging.getLogger(__name__)
+    drugRows, condRows = joinFirstOccurrences(
+        firstDrugs, firstConds,
+        min(start + offset for start, end, offset in settings),
+        max(end + offset for start, end, offset in settings))
+    days = firstConds[2][condRows] - firstDrugs[2][drugRows]
+    logger.info('Joined %s first occurrences', len(days))
+    countsList = []
+    for index, (start, end, offset) in enumerate(settings):
+        inWindow = (days >= start + offset) & (days <= end + offset)
+        countsList.append(joinCounts(
+                firstDrugs, firstConds, numDrugs, numConds,
+                drugRows[inWindow], condRows[inWindow],
+                days[inWindow] > offset, minPairCount,
+                pairMasks[index] if pairMasks is not None else None))
+    return countsList
+
+# Maximum number of drug-condition pairs to expand at once when
+# counting pairs from ranges of rows
+sweepChunkSize = 1 << 22
+
+def sweepCounts(firstDrugs, firstConds, numDrugs, numConds, settings,
+                minPairCount=0, pairMasks=None):
+    '''Counts people from first occurrences for each of the given
+    settings as firstOccurrencesCounts does, but without joining them.
+    The first occurrences of each side are sorted by person and day, so
+    the occurrences of the other side within the window of each
+    occurrence (and within the part of the window before or after it)
+    are a range of rows found by binary search.  The marginals are
+    counted from whether the ranges are empty, and the pair counts from
+    the pairs in the ranges, expanded a chunk at a time.  Time is linear
+    in the pairs within the window (not all the pairs of each person)
+    and memory does not grow with them.  Pairs are pruned as joinCounts
+    does, by the mask of each setting if pairMasks is given.
+    '''
+    drugPersons, drugIdxs, drugDays = firstDrugs
+    condPersons, condIdxs, condDays = firstConds
+    personIds = numpy.union1d(drugPersons, condPersons)
+    drugRanks = numpy.searchsorted(personIds, drugPersons)
+    condRanks = numpy.searchsorted(personIds, condPersons)
+    # Keys that order occurrences by person and then day.  Days outside
+    # the days of the data are clipped to just outside them, so that
+    # searches stay within the person.
+    allDays = numpy.concatenate((drugDays, condDays))
+    firstDay = int(allDays.min()) if len(allDays) > 0 else 0
+    numDays = int(allDays.max()) - firstDay + 1 if len(allDays) > 0 else 1
+    def keys(ranks, days):
+        return (ranks * (numDays + 2)
+                + numpy.clip(days - firstDay + 1, 0, numDays + 1))
+    condOrder = numpy.argsort(keys(condRanks, condDays), kind='mergesort')
+    condKeys = keys(condRanks, condDays)[condOrder]
+    sortedCondIdxs = condIdxs[condOrder]
+    drugKeys = numpy.sort(keys(drugRanks, drugDays), kind='mergesort')
+    def firstAtOrAfter(sortedKeys, ranks, days):
+        return numpy.searchsorted(sortedKeys, keys(ranks, days), 'left')
+    def firstAfter(sortedKeys, ranks, days):
+        return numpy.searchsorted(sortedKeys, keys(ranks, days), 'right')
+    countsList = []
+    for index, (start, end, offset) in enumerate(settings):
+        checkCancelled()
+        # The conditions within the window of each drug: [lows, highs),
+        # with those after the offset (the drug is before) from mids
+        lows = firstAtOrAfter(condKeys, drugRanks, drugDays + start + offset)
+        highs = firstAfter(condKeys, drugRanks, drugDays + end + offset)
+        mids = numpy.clip(firstAfter(condKeys, drugRanks, drugDays + offset),
+                          lows, numpy.maximum(lows, highs))
+        ct_d_anyc = numpy.bincount(drugIdxs[highs > lows], minlength=numDrugs)
+        # The drugs within the window of each condition, and those that
+        # are before it
+        drugLows = firstAtOrAfter(drugKeys, condRanks, condDays - end - offset)
+        drugHighs = firstAfter(drugKeys, condRanks, condDays - start - offset)
+        drugBeforeHighs = numpy.minimum(
+            drugHighs, firstAfter(drugKeys, condRanks, condDays - offset - 1))
+        ct_anyd_c = numpy.bincount(condIdxs[drugHighs > drugLows],
+                                   minlength=numConds)
+        # Only count the pairs that can reach the minimum
+        pairMask = pairMasks[index] if pairMasks is not None else None
+        if pairMask is None and minPairCount > 0:
+            pairMask = (ct_d_anyc >= minPairCount, ct_anyd_c >= minPairCount)
+        canPair = highs > lows
+        if pairMask is not None:
+            canPair &= pairMask[0][drugIdxs]
+        ct_d_c, ct_d_bef_c = rangePairCounts(
+            drugIdxs[canPair], lows[canPair], mids[canPair], highs[canPair],
+            sortedCondIdxs, numDrugs, numConds,
+            pairMask[1] if pairMask is not None else None)
+        countsList.append(Counts(
+                ct_d_bef_c=ct_d_bef_c,
+                ct_c_bef_d=ct_d_c - ct_d_bef_c,
+                ct_d_c=ct_d_c,
+                ct_d_bef_anyc=numpy.bincount(drugIdxs[highs > mids],
+                                             minlength=numDrugs),
+                ct_d_anyc=ct_d_anyc,
+                ct_anyd_bef_c=numpy.bincount(
+                    condIdxs[drugBeforeHighs > drugLows], minlength=numConds),
+                ct_anyd_c=ct_anyd_c,
+                ct_d=numpy.bincount(drugIdxs, minlength=numDrugs),
+                ct_c=numpy.bincount(condIdxs, minlength=numConds),
+                ct_ppl=len(personIds),
+                ))
+    return countsList
+
+def marginalsCounts(firstDrugs, firstConds, numDrugs, numConds, settings):
+    # Counts people for the marginals only (with pair counts of zero) as
+    # sweepCounts does, for finding the masks to prune the pairs of
+    # partitions by
+    noPairs = (numpy.zeros(numDrugs, dtype=bool),
+               numpy.zeros(numConds, dtype=bool))
+    return sweepCounts(firstDrugs, firstConds, numDrugs, numConds, settings,
+                       pairMasks=[noPairs] * len(settings))
+
+def pairMasks(countsList, minPairCount):
+    # Returns the masks of the drugs and of the conditions whose pairs
+    # can reach the given minimum for each of the given counts
+    return [(counts.ct_d_anyc >= minPairCount,
+             counts.ct_anyd_c >= minPairCount) for counts in countsList]
+
+def rangePairCounts(drugIdxs, lows, mids, highs, condIdxs, numDrugs,
+                    numConds, canPairConds=None):
+    '''Counts the drug-condition pairs of the given drugs with the
+    conditions in the given ranges of rows [low, high) of the condition
+    indices, and the pairs in the parts of the ranges from mid.  Only
+    the pairs of the conditions in canPairConds (a mask) are counted if
+    it is given.  Returns the two D x C arrays of counts.
+    '''
+    numPairs = numDrugs * numConds
+    ct_d_c = numpy.zeros(numPairs, dtype=numpy.int64)
+    ct_d_bef_c = numpy.zeros(numPairs, dtype=numpy.int64)
+    # Split the drugs into chunks of about sweepChunkSize pairs
+    ends = numpy.cumsum(highs - lows)
+    bounds = numpy.unique(numpy.concatenate((
+                [0], numpy.searchsorted(
+                    ends, numpy.arange(sweepChunkSize, ends[-1] if len(ends)
+                                       else 0, sweepChunkSize)),
+                [len(ends)])))
+    for low, high in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+        lengths = highs[low:high] - lows[low:high]
+        starts = numpy.cumsum(lengths) - lengths
+        rows = (numpy.arange(lengths.sum())
+                - numpy.repeat(starts, lengths)
+                + numpy.repeat(lows[low:high], lengths))
+        pairCondIdxs = condIdxs[rows]
+        pairIdxs = (numpy.repeat(drugIdxs[low:high], lengths) * numConds
+                    + pairCondIdxs)
+        isBefore = rows >= numpy.repeat(mids[low:high], lengths)
+        if canPairConds is not None:
+            canPair = canPairConds[pairCondIdxs]
+            pairIdxs = pairIdxs[canPair]
+            isBefore = isBefore[canPair]
+        ct_d_c += numpy.bincount(pairIdxs, minlength=numPairs)
+        ct_d_bef_c += numpy.bincount(pairIdxs[isBefore], minlength=numPairs)
+    return (ct_d_c.reshape((numDrugs, numConds)),
+            ct_d_bef_c.reshape((numDrugs, numConds)))
+
+def personBitmaps(persons, idxs, numConcepts, personIds):
+    '''Returns a bitmap of the people of each concept from first
+    occurrences (persons and concept indices) as a 2D array of 64-bit
+    words with a row for each concept.  Bit i of the bitmaps (bit i % 64
+    of word i // 64) is the person at index i in the given sorted array
+    of person IDs.
+    '''
+    bitmaps = numpy.zeros((numConcepts, (len(personIds) + 63) // 64),
+                          dtype=numpy.uint64)
+    bits = numpy.searchsorted(personIds, persons)
+    # Each (concept, person) is set once, so adding sets the bits
+    numpy.add.at(bitmaps, (idxs, bits // 64), numpy.left_shift(
+            numpy.uint64(1), (bits % 64).astype(numpy.uint64)))
+    return bitmaps
+
+def popcounts(bitmaps):
+    # Counts the set bits in each bitmap (along the last axis)
+    if hasattr(numpy, 'bitwise_count'):
+        bitCounts = numpy.bitwise_count(bitmaps)
+    else:
+        # Count the bits of each word in parallel within the word (for
+        # NumPy before 2.0)
+        words = numpy.asarray(bitmaps, dtype=numpy.uint64)
+        words = words - ((words >> numpy.uint64(1))
+                         & numpy.uint64(0x5555555555555555))
+        words = ((words & numpy.uint64(0x3333333333333333))
+                 + ((words >> numpy.uint64(2))
+                    & numpy.uint64(0x3333333333333333)))
+        words = ((words + (words >> numpy.uint64(4)))
+                 & numpy.uint64(0x0f0f0f0f0f0f0f0f))
+        bitCounts = ((words * numpy.uint64(0x0101010101010101))
+                     >> numpy.uint64(56))
+    return bitCounts.sum(axis=-1, dtype=numpy.int64)
+
+def bitmapCounts(firstDrugs, firstConds, numDrugs, numConds, settings,
+                 minPairCount=0, pairMasks=None):
+    '''Counts people from first occurrences for each of the given
+    settings as sweepCounts does, but counts the columns that are sizes
+    of sets of people with bitmaps of the people of each drug and
+    condition.  `ct_d`, `ct_c`, and `ct_ppl` are always counted from the
+    bitmaps.  When the window of a setting contains the days between all
+    the first drug and condition occurrences, so too are `ct_d_c` (an
+    intersection), `ct_d_anyc`, and `ct_anyd_c`, and only the pairs with
+    the drug before the condition are counted by date for the `*_bef_*`
+    columns.  Other windows are counted by date.  Pairs are pruned as
+    sweepCounts does, so only the drugs and conditions that can reach the
+    minimum are intersected.
+    '''
+    logger = logging.getLogger(__name__)
+    drugPersons, drugIdxs, drugDays = firstDrugs
+    condPersons, condIdxs, condDays = firstConds
+    personIds = numpy.union1d(drugPersons, condPersons)
+    drugBitmaps = personBitmaps(drugPersons, drugIdxs, numDrugs, personIds)
+    condBitmaps = personBitmaps(condPersons, condIdxs, numConds, personIds)
+    anyDrugBitmap = numpy.bitwise_or.reduce(drugBitmaps, axis=0)
+    anyCondBitmap = numpy.bitwise_or.reduce(condBitmaps, axis=0)
+    logger.info('Built bitmaps of %s people for %s drugs and %s conditions',
+                len(personIds), numDrugs, numConds)
+    # Days between all the occurrences
+    if len(drugDays) > 0 and len(condDays) > 0:
+        minDays = int(condDays.min()) - int(drugDays.max())
+        maxDays = int(condDays.max()) - int(drugDays.min())
+    else:
+        minDays = maxDays = 0
+    # Set sizes that are the same for all the settings
+    ct_d = popcounts(drugBitmaps)
+    ct_c = popcounts(condBitmaps)
+    ct_ppl = int(popcounts(anyDrugBitmap | anyCondBitmap))
+    ct_d_c = ct_d_anyc = ct_anyd_c = None
+    countsList = []
+    for index, (start, end, offset) in enumerate(settings):
+        checkCancelled()
+        pairMask = pairMasks[index] if pairMasks is not None else None
+        if start + offset > minDays or end + offset < maxDays:
+            # Count by date within the window
+            counts, = sweepCounts(firstDrugs, firstConds, numDrugs, numConds,
+                                  [(start, end, offset)], minPairCount,
+                                  [pairMask] if pairMask is not None else None)
+            countsList.append(counts._replace(ct_d=ct_d, ct_c=ct_c,
+                                              ct_ppl=ct_ppl))
+            continue
+        if ct_d_c is None:
+            # Intersect each drug with all the conditions (that can
+            # reach the minimum).  The marginals, and so the masks, are
+            # the same for all the settings with such windows.
+            ct_d_anyc = popcounts(drugBitmaps & anyCondBitmap)
+            ct_anyd_c = popcounts(condBitmaps & anyDrugBitmap)
+            if pairMask is not None:
+                canPairDrugs, canPairConds = pairMask
+            else:
+                canPairDrugs = ct_d_anyc >= minPairCount
+                canPairConds = ct_anyd_c >= minPairCount
+            pairCondBitmaps = condBitmaps[canPairConds]
+            ct_d_c = numpy.zeros((numDrugs, numConds), dtype=numpy.int64)
+            for drugIdx in numpy.flatnonzero(canPairDrugs).tolist():
+                ct_d_c[drugIdx, canPairConds] = popcounts(
+                    pairCondBitmaps & drugBitmaps[drugIdx])
+        # Count by date the pairs with the drug before the condition:
+        # the pairs in the part of the window after the offset
+        before, = sweepCounts(firstDrugs, firstConds, numDrugs, numConds,
+                              [(max(start, 1) + offset, end + offset, 0)])
+        ct_d_bef_c = before.ct_d_c
+        ct_d_bef_c[~canPairDrugs] = 0
+        ct_d_bef_c[:, ~canPairConds] = 0
+        countsList.append(Counts(
+                ct_d_bef_c=ct_d_bef_c,
+                ct_c_bef_d=ct_d_c - ct_d_bef_c,
+                ct_d_c=ct_d_c,
+                ct_d_bef_anyc=before.ct_d_anyc,
+                ct_d_anyc=ct_d_anyc,
+                ct_anyd_bef_c=before.ct_anyd_c,
+                ct_anyd_c=ct_anyd_c,
+                ct_d=ct_d,
+                ct_c=ct_c,
+                ct_ppl=ct_ppl,
+                ))
+    return countsList
+
+def allFirstOccurrences(eras):
+    # Returns the sorted array of all the concept IDs in the given era
+    # records and the first occurrences of all of them
+    ids = numpy.unique(eras[1])
+    return ids, firstOccurrences(*(tuple(eras) + (ids,)))
+
+def selectFirstOccurrences(allFirst, ids):
+    '''Returns the first occurrences of the concepts with the given
+    sorted array of IDs (as returned by firstOccurrences) from the first
+    occurrences of all the concepts (as returned by
+    allFirstOccurrences).
+    '''
+    allIds, (persons, idxs, days) = allFirst
+    concepts = allIds[idxs]
+    keep = numpy.isin(concepts, ids)
+    return (persons[keep], numpy.searchsorted(ids, concepts[keep]),
+            days[keep])
+
+def filterEras(eras, ids):
+    # Returns the era records (as arrays) of the concepts with the given
+    # IDs
+    keep = numpy.isin(eras[1], ids)
+    return tuple(array[keep] for array in eras)
+
+def partitionEras(eras, numPartitions):
+    '''Splits era records (as arrays of persons, concepts, and days) into
+    the given number of partitions by person.  All the records of a
+    person are in the same partition, so the counts of the partitions
+    add up to the counts of all the people.
+    '''
+    keys = numpy.remainder(eras[0], numPartitions)
+    order = numpy.argsort(keys, kind='mergesort')
+    bounds = numpy.cumsum(numpy.bincount(keys, minlength=numPartitions))
+    lows = numpy.concatenate(([0], bounds[:-1]))
+    return [tuple(array[order[low:high]] for array in eras)
+            for low, high in zip(lows.tolist(), bounds.tolist())]
+
+def addCounts(counts1, counts2):
+    # Adds the counts of disjoint sets of people
+    return Counts._make(
+        field1 + field2 for field1, field2 in zip(counts1, counts2))
+
+def readPersonCsv(fileName, column):
+    '''Reads the given column of a CSV extract of the person table and
+    returns the sorted array of person IDs and a list of the values (as
+    stripped strings) in the same order.  The extract must have a
+    header row naming the columns as in the CDM person table.
+    '''
+    logger = logging.getLogger(__name__)
+    logger.info('Reading %s of people from: %s', column, fileName)
+    with open(fileName, 'r') as csvFile:
+        reader = csv.reader(csvFile)
+        header = [name.strip().lower() for name in next(reader)]
+        personIndex = header.index('person_id')
+        valueIndex = header.index(column.lower())
+        records = sorted((int(row[personIndex]), row[valueIndex].strip())
+                         for row in reader if row)
+    return (numpy.array([person for person, value in records],
+                        dtype=numpy.int64),
+            [value for person, value in records])
+
+def lookUpPersons(persons, personIds, values):
+    # Returns the values of the given persons from the sorted array of
+    # person IDs and the array of their values, with a mask of the
+    # persons found
+    if len(personIds) == 0:
+        return (numpy.zeros(len(persons), dtype=values.dtype),
+                numpy.zeros(len(persons), dtype=bool))
+    idxs = numpy.minimum(numpy.searchsorted(personIds, persons),
+                         len(personIds) - 1)
+    return values[idxs], personIds[idxs] == persons
+
+def eraStrata(erasList, stratifyBy, width=10, personFileName=None):
+    '''Returns the stratum of each era record of each of the given era
+    arrays (as returned by readEraCsv) and the labels of the strata.
+    The strata are given as arrays of indices into the sorted list of
+    labels, with -1 for records with an unknown stratum.
+
+    Strata are calendar periods of the given number of years of the
+    start dates ('period', labeled by their first year), age bands of
+    the given number of years at the start dates ('age', labeled by
+    their first age, from `year_of_birth` in the person extract), or
+    the values of the named column of the person extract (for example
+    'gender_concept_id' or 'care_site_id').
+    '''
+    def years(days):
+        return (days.astype('datetime64[D]').astype('datetime64[Y]')
+                .astype(numpy.int64) + 1970)
+    # Find an integer key of the stratum of each record
+    keyLabels = None
+    if stratifyBy == 'period':
+        keysList = [(years(eras[2]) // width) * width for eras in erasList]
+        isKnownList = [numpy.ones(len(keys), dtype=bool) for keys in keysList]
+    else:
+        if not personFileName:
+            raise ValueError(
+                'Stratifying by {} requires a person extract.'.format(
+                    stratifyBy))
+        column = 'year_of_birth' if stratifyBy == 'age' else stratifyBy
+        personIds, values = readPersonCsv(personFileName, column)
+        if stratifyBy == 'age':
+            values = numpy.array([int(value) for value in values],
+                                 dtype=numpy.int64)
+        else:
+            keyLabels, values = numpy.unique(values, return_inverse=True)
+        keysList = []
+        isKnownList = []
+        for eras in erasList:
+            keys, isKnown = lookUpPersons(eras[0], personIds, values)
+            if stratifyBy == 'age':
+                keys = ((years(eras[2]) - keys) // width) * width
+            keysList.append(keys)
+            isKnownList.append(isKnown)
+    # Number the strata that occur in order by key
+    usedKeys = numpy.unique(numpy.concatenate(
+            [keys[isKnown] for keys, isKnown in zip(keysList, isKnownList)]))
+    strataList = []
+    for keys, isKnown in zip(keysList, isKnownList):
+        strata = numpy.searchsorted(usedKeys, keys)
+        strata[~isKnown] = -1
+        strataList.append(strata)
+    if keyLabels is None:
+        labels = usedKeys.tolist()
+    else:
+        labels = keyLabels[usedKeys].tolist()
+    return strataList, labels
+
+def stratumCounts(stratum):
+    '''Counts people for all the report columns from the first
+    occurrences of a stratum.  The stratum is a tuple of the first drug
+    occurrences, the first condition occurrences, the numbers of drugs
+    and conditions, the settings, and the counts function, as its
+    arguments.  Returns a list of Counts, one for each setting.
+    '''
+    return stratum[-1](*stratum[:-1])
+
+def stratifyEras(eras, strata, personsPerStratum):
+    '''Returns the era records (as arrays) of the known strata with each
+    person replaced by a person of their stratum, so that first
+    occurrences and their join are within strata and people are sorted
+    by stratum.
+    '''
+    known = strata >= 0
+    return ((strata[known] * personsPerStratum + eras[0][known]),
+            eras[1][known], eras[2][known])
+
+# Version of the format of first occurrence stores.  Stores of other
+# versions are rebuilt.
+firstOccurrenceStoreVersion = 1
+
+# First occurrences of all the concepts of an era table as columns:
+# sorted concept IDs, and persons, concept indices (into the IDs), and
+# days sorted by person and then concept, with the distinct persons and
+# the offset of the first row of each of them (plus the number of rows)
+FirstOccurrenceStore = collections.namedtuple('FirstOccurrenceStore', (
+        'ids', 'persons', 'concepts', 'days', 'personIds', 'offsets'))
+
+_storeColumnTypes = (
+    ('ids', 'int64'),
+    ('persons', 'int64'),
+    ('concepts', 'int32'),
+    ('days', 'int32'),
+    ('personIds', 'int64'),
+    ('offsets', 'int64'),
+    )
+
+def eraSourceSignature(fileName):
+    # Identifies the contents of an era extract so that stores built
+    # from it are rebuilt when it changes
+    stat = os.stat(fileName)
+    return dict(fileName=os.path.abspath(fileName), size=stat.st_size,
+                mtime=stat.st_mtime)
+
+def writeFirstOccurrenceStore(directory, name, allFirst, source):
+    '''Writes the first occurrences of all the concepts (as returned by
+    allFirstOccurrences) as a columnar store named by the given name in
+    the given directory.  Each column is a file of fixed-width integers
+    in NumPy format.  The manifest, which records the source (as
+    returned by eraSourceSignature), is written last, so a store
+    without a manifest is incomplete and is rebuilt.
+    '''
+    logger = logging.getLogger(__name__)
+    ids, (persons, concepts, days) = allFirst
+    isFirst = numpy.ones(len(persons), dtype=bool)
+    isFirst[1:] = persons[1:] != persons[:-1]
+    offsets = numpy.append(numpy.flatnonzero(isFirst), len(persons))
+    columns = dict(ids=ids, persons=persons, concepts=concepts, days=days,
+                   personIds=persons[isFirst], offsets=offsets)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    manifestFileName = os.path.join(directory, name + '.json')
+    if os.path.exists(manifestFileName):
+        os.remove(manifestFileName)
+    for column, dtype in _storeColumnTypes:
+        numpy.save(os.path.join(directory, '{}_{}.npy'.format(name, column)),
+                   columns[column].astype(dtype))
+    with open(manifestFileName, 'w') as manifestFile:
+        json.dump(dict(version=firstOccurrenceStoreVersion, source=source,
+                       rows=len(persons), persons=len(offsets) - 1),
+                  manifestFile, indent=2)
+    logger.info('Stored %s first occurrences of %s people in: %s',
+                len(persons), len(offsets) - 1, manifestFileName)
+
+def openFirstOccurrenceStore(directory, name, source=None):
+    '''Opens the columnar store of first occurrences named by the given
+    name in the given directory with memory-mapping and returns it as a
+    FirstOccurrenceStore.  Returns None if the store is missing,
+    incomplete, of another version, or (if a source is given) built from
+    another source.  The columns are read-only and their pages are
+    shared by all the processes that open the store.
+    '''
+    manifestFileName = os.path.join(directory, name + '.json')
+    if not os.path.exists(manifestFileName):
+        return None
+    with open(manifestFileName, 'r') as manifestFile:
+        manifest = json.load(manifestFile)
+    if (manifest.get('version') != firstOccurrenceStoreVersion
+        or (source is not None and manifest.get('source') != source)):
+        return None
+    return FirstOccurrenceStore._make(
+        numpy.load(os.path.join(directory, '{}_{}.npy'.format(name, column)),
+                   mmap_mode='r')
+        for column, dtype in _storeColumnTypes)
+
+def storeFirstOccurrences(store, rows=None):
+    # Returns the first occurrences in the store (or in the given slice
+    # of its rows) as returned by allFirstOccurrences
+    rows = rows or slice(None)
+    return store.ids, (store.persons[rows], store.concepts[rows],
+                       store.days[rows])
+
+def storePartitionsRows(drugStore, condStore, numPartitions):
+    '''Splits the people in the drug and condition stores into the given
+    number of ranges of person IDs with about the same number of rows
+    and returns the slices of the rows of each range in each store.
+    Uses the offset indices, so only the distinct persons are searched.
+    '''
+    # Without drug rows there is nothing to split at, so all the people
+    # go in one partition
+    if len(drugStore.persons) == 0:
+        return [(slice(0, 0), slice(0, len(condStore.persons)))]
+    # Split at the persons at even fractions of the drug rows
+    splits = numpy.searchsorted(
+        drugStore.offsets[:-1],
+        numpy.arange(1, numPartitions) * len(drugStore.persons)
+        // numPartitions, side='right') - 1
+    bounds = numpy.unique(drugStore.personIds[numpy.maximum(splits, 0)])
+    def rowBounds(store):
+        personBounds = numpy.searchsorted(store.personIds, bounds)
+        return ([0] + store.offsets[personBounds].tolist()
+                + [len(store.persons)])
+    drugBounds = rowBounds(drugStore)
+    condBounds = rowBounds(condStore)
+    return [(slice(drugBounds[index], drugBounds[index + 1]),
+             slice(condBounds[index], condBounds[index + 1]))
+            for index in range(len(drugBounds) - 1)]
+
+def storePartitionCounts(partition):
+    '''Counts people for all the report columns from a range of the rows
+    of the first occurrence stores for each of the given settings (as in
+    partitionCounts).  The partition is a tuple of the store directory,
+    the slices of the drug rows and the condition rows, the sorted
+    arrays of drug and condition IDs, the settings, and the counts
+    function.  The stores are opened in this process, so their rows are
+    not copied between processes.
+    '''
+    (directory, drugRows, condRows, drugIds, condIds, settings,
+     countsFunction) = partition
+    drugStore = openFirstOccurrenceStore(directory, 'drug')
+    condStore = openFirstOccurrenceStore(directory, 'cond')
+    return countsFunction(
+        selectFirstOccurrences(storeFirstOccurrences(drugStore, drugRows),
+                               drugIds),
+        selectFirstOccurrences(storeFirstOccurrences(condStore, condRows),
+                               condIds),
+        len(drugIds), len(condIds), settings)
+
+def computeTemporalScores(ct_d_bef_c, ct_d_c,
+                          ct_d_bef_anyc, ct_d_anyc,
+                          ct_anyd_bef_c, ct_anyd_c,
+                          pseudocount):
+    # Same formula as the "Compute temporal scores" step of the SQL
+    # script.  Works on scalars and broadcasts on arrays.
+    m = float(pseudocount)
+    return (((ct_d_bef_c + m) / (ct_d_c + m + m))
+            / ((ct_d_bef_anyc + m) / (ct_d_anyc + m + m)
+               * (ct_anyd_bef_c + m) / (ct_anyd_c + m + m)))
+
+def iterCountsRows(counts, drugIds, condIds, pseudocount, sparse=False,
+                   topK=None, minScore=None, minCtDC=None):
+    '''Generates report rows (in order by drug and condition) from the
+    given counts.  The drug and condition IDs must be the sorted arrays
+    used to index the counts.  If sparse, only generates rows for pairs
+    that occur together in some person.  The rows are selected as
+    selectReportRows does, but with array operations before any rows
+    are made.
+    '''
+    numDrugs, numConds = len(drugIds), len(condIds)
+    # Broadcast the marginals to D x C
+    drugShape = (numDrugs, 1)
+    scores = computeTemporalScores(
+        counts.ct_d_bef_c, counts.ct_d_c,
+        counts.ct_d_bef_anyc.reshape(drugShape),
+        counts.ct_d_anyc.reshape(drugShape),
+        counts.ct_anyd_bef_c, counts.ct_anyd_c,
+        pseudocount)
+    drugIdList = drugIds.tolist()
+    condIdList = condIds.tolist()
+    ctDBefAnyc = counts.ct_d_bef_anyc.tolist()
+    ctDAnyc = counts.ct_d_anyc.tolist()
+    ctAnydBefC = counts.ct_anyd_bef_c.tolist()
+    ctAnydC = counts.ct_anyd_c.tolist()
+    ctD = counts.ct_d.tolist()
+    ctC = counts.ct_c.tolist()
+    ctPpl = int(counts.ct_ppl)
+    if topK is not None or minScore is not None or minCtDC is not None:
+        for drugIdx, condIdx in selectPairs(
+                counts, scores, sparse, topK, minScore, minCtDC):
+            yield ReportRow(
+                drugIdList[drugIdx], condIdList[condIdx],
+                int(counts.ct_d_bef_c[drugIdx, condIdx]),
+                int(counts.ct_c_bef_d[drugIdx, condIdx]),
+                int(counts.ct_d_c[drugIdx, condIdx]),
+                ctDBefAnyc[drugIdx], ctDAnyc[drugIdx],
+                ctAnydBefC[condIdx], ctAnydC[condIdx],
+                ctD[drugIdx], ctC[condIdx], ctPpl,
+                float(scores[drugIdx, condIdx]))
+        return
+    for drugIdx in range(numDrugs):
+        ctDBefC = counts.ct_d_bef_c[drugIdx].tolist()
+        ctCBefD = counts.ct_c_bef_d[drugIdx].tolist()
+        ctDC = counts.ct_d_c[drugIdx].tolist()
+        drugScores = scores[drugIdx].tolist()
+        if sparse:
+            condIdxs = numpy.flatnonzero(counts.ct_d_c[drugIdx]).tolist()
+        else:
+            condIdxs = range(numConds)
+        for condIdx in condIdxs:
+            yield ReportRow(
+                drugIdList[drugIdx], condIdList[condIdx],
+                ctDBefC[condIdx], ctCBefD[condIdx], ctDC[condIdx],
+                ctDBefAnyc[drugIdx], ctDAnyc[drugIdx],
+                ctAnydBefC[condIdx], ctAnydC[condIdx],
+                ctD[drugIdx], ctC[condIdx], ctPpl,
+                drugScores[condIdx])
+
+def selectPairs(counts, scores, sparse, topK, minScore, minCtDC):
+    # Returns the (drug index, condition index) pairs of the rows that
+    # selectReportRows would select from the rows of the given counts
+    # and scores
+    selected = numpy.ones(scores.shape, dtype=bool)
+    if sparse:
+        selected &= counts.ct_d_c > 0
+    if minScore is not None:
+        selected &= scores >= minScore
+    if minCtDC is not None:
+        selected &= counts.ct_d_c >= minCtDC
+    pairIdxs = numpy.flatnonzero(selected)
+    if topK is not None:
+        pairScores = scores.ravel()[pairIdxs]
+        # Only sort the scores at least as high as the topK-th highest
+        if len(pairIdxs) > topK > 0:
+            threshold = numpy.partition(
+                pairScores, len(pairScores) - topK)[len(pairScores) - topK]
+            isCandidate = pairScores >= threshold
+            pairIdxs = pairIdxs[isCandidate]
+            pairScores = pairScores[isCandidate]
+        order = numpy.lexsort((pairIdxs, -pairScores))[:max(topK, 0)]
+        pairIdxs = pairIdxs[order]
+    numConds = scores.shape[1]
+    return [divmod(pairIdx, numConds) for pairIdx in pairIdxs.tolist()]
+
+def marginalsRows(counts, drugIds, condIds):
+    # Returns the drug marginals rows and the condition marginals rows
+    # for the given counts
+    ctPpl = int(counts.ct_ppl)
+    drugRows = [row + (ctPpl,) for row in zip(
+            drugIds.tolist(), counts.ct_d_bef_anyc.tolist(),
+            counts.ct_d_anyc.tolist(), counts.ct_d.tolist())]
+    condRows = [row + (ctPpl,) for row in zip(
+            condIds.tolist(), counts.ct_anyd_bef_c.tolist(),
+            counts.ct_anyd_c.tolist(), counts.ct_c.tolist())]
+    return drugRows, condRows
+
+def zeroPairRow(drugMarginalsRow, condMarginalsRow, pseudocount):
+    '''Returns the report row of a drug-condition pair that does not
+    occur together in any person, as omitted by sparse mode, given the
+    marginals rows of the drug and the condition.
+    '''
+    drug, ct_d_bef_anyc, ct_d_anyc, ct_d, ct_ppl = drugMarginalsRow
+    cond, ct_anyd_bef_c, ct_anyd_c, ct_c, ct_ppl = condMarginalsRow
+    score = computeTemporalScores(
+        0, 0, ct_d_bef_anyc, ct_d_anyc, ct_anyd_bef_c, ct_anyd_c, pseudocount)
+    return ReportRow(drug, cond, 0, 0, 0,
+                     ct_d_bef_anyc, ct_d_anyc, ct_anyd_bef_c, ct_anyd_c,
+                     ct_d, ct_c, ct_ppl, score)
+
+def densifyReportRows(pairRows, drugMarginalsRows, condMarginalsRows,
+                      pseudocount):
+    '''Generates the full report (in order by drug and condition) from a
+    sparse report and the marginals reports.  Rows must have typed
+    values (ints and a float score).
+    '''
+    pairRows = dict(((row[0], row[1]), row) for row in pairRows)
+    condMarginalsRows = sorted(condMarginalsRows)
+    for drugRow in sorted(drugMarginalsRows):
+        for condRow in condMarginalsRows:
+            row = pairRows.get((drugRow[0], condRow[0]))
+            if row is None:
+                row = zeroPairRow(drugRow, condRow, pseudocount)
+            yield row
+
+def normalizeReportRows(rows, summary):
+    '''Generates the rows of a normalized report (as PairRow tuples)
+    from the given report rows, leaving out the columns of the drug, the
+    condition, and the run, which the marginals reports and the run
+    summary have once each.  Records the number of pairs in the given
+    summary (a dict).
+    '''
+    numPairs = 0
+    for row in rows:
+        numPairs += 1
+        yield PairRow(row[0], row[1], row[2], row[3], row[4], row[-1])
+    summary['numPairs'] = numPairs
+
+def joinNormalizedRows(pairRows, drugMarginalsRows, condMarginalsRows):
+    '''Generates the report rows (as ReportRow tuples) of the given rows
+    of a normalized report, in their order, by joining each with the
+    marginals rows of its drug and condition.  Only the marginals are
+    kept in memory.  The rows of a sparse report can then be densified
+    with densifyReportRows.
+    '''
+    drugMarginalsRows = dict((row[0], row) for row in drugMarginalsRows)
+    condMarginalsRows = dict((row[0], row) for row in condMarginalsRows)
+    for drug, cond, ct_d_bef_c, ct_c_bef_d, ct_d_c, score in pairRows:
+        drug, ct_d_bef_anyc, ct_d_anyc, ct_d, ct_ppl = drugMarginalsRows[drug]
+        cond, ct_anyd_bef_c, ct_anyd_c, ct_c, ct_ppl = condMarginalsRows[cond]
+        yield ReportRow(drug, cond, ct_d_bef_c, ct_c_bef_d, ct_d_c,
+                        ct_d_bef_anyc, ct_d_anyc, ct_anyd_bef_c, ct_anyd_c,
+                        ct_d, ct_c, ct_ppl, score)
+
+def readMarginalsRows(fileName):
+    # Returns the rows of a marginals report file (CSV or
+    # sqlplus-spooled with padding) as tuples of ints
+    with open(fileName) as marginalsFile:
+        return [tuple(int(field) for field in fields)
+                for fields in csv.reader(marginalsFile) if fields]
+
+def readNormalizedReport(reportFileName, drugMarginalsFileName,
+                         condMarginalsFileName):
+    '''Generates the report rows (as ReportRow tuples) of a normalized
+    report file (plain or gzip-compressed CSV) and its marginals report
+    files as joinNormalizedRows does.  The report is read as the rows
+    are generated.
+    '''
+    drugMarginalsRows = readMarginalsRows(drugMarginalsFileName)
+    condMarginalsRows = readMarginalsRows(condMarginalsFileName)
+    openReport = gzip.open if reportFileName.endswith('.gz') else open
+    with openReport(reportFileName) as reportFile:
+        pairRows = (PairRow._make(
+                [int(field) for field in fields[:-1]]
+                + [float(fields[-1]) if fields[-1] else None])
+                    for fields in csv.reader(reportFile) if fields)
+        for row in joinNormalizedRows(
+                pairRows, drugMarginalsRows, condMarginalsRows):
+            yield row
+
+def writeRunSummary(summary, fileName):
+    # Writes the summary of a run as a JSON object
+    with open(fileName, 'w') as summaryFile:
+        json.dump(summary, summaryFile, indent=2)
+        summaryFile.write('\n')
+
+def writeMarginalsReports(drugRows, condRows, parameters):
+    # Write the marginals to their report files (if any) as plain CSV
+    for rows, fileName in (
+            (drugRows, parameters.get('drugMarginalsFileName')),
+            (condRows, parameters.get('condMarginalsFileName')),
+            ):
+        if fileName:
+            with open(fileName, 'w') as marginalsFile:
+                writer = csv.writer(marginalsFile, lineterminator='\n')
+                writer.writerows(rows)
+
+def writeReportRows(rows, reportFile):
+    # Write rows as plain CSV (no header, like the spooled Oracle report)
+    writer = csv.writer(reportFile, lineterminator='\n')
+    for row in rows:
+        score = row[-1]
+        writer.writerow(tuple(row[:-1]) + ('' if score is None else repr(score),))
+
+def writeCsvReport(rows, reportFile, reportFormat):
+    # Write rows to the report file as plain or gzip-compressed CSV
+    if reportFormat == 'csv.gz':
+        with gzip.GzipFile(fileobj=reportFile, mode='wb') as gzipFile:
+            writeReportRows(rows, gzipFile)
+    else:
+        writeReportRows(rows, reportFile)
+
+# Types of the columns of reports in NumPy format.  They are
+# little-endian so that the files are portable, and the counts fit in 32
+# bits (like the number(9) columns of the Oracle results table).
+reportColumnTypes = (
+    (('drug', '<i8'), ('cond', '<i8'))
+    + tuple((name, '<i4') for name in reportColumnNames[2:-1])
+    + (('temporal_score', '<f8'),))
+
+# Number of rows to convert and write at once in NumPy format
+npyReportChunkSize = 65536
+
+def npyReportHeader(dtype, numRows):
+    # Returns the header of a .npy file (format version 1.0) of the given
+    # number of records.  It is padded to the same length for any number
+    # of rows so that it can be rewritten once the number is known.
+    def header(numRows):
+        return "{{'descr': {!r}, 'fortran_order': False, 'shape': ({},), }}".format(
+            numpy.lib.format.dtype_to_descr(dtype), numRows)
+    # Align the data to 64 bytes as NumPy does
+    length = len(header(10 ** 20)) + 1
+    length += -(len(numpy.lib.format.magic(1, 0)) + 2 + length) % 64
+    return (numpy.lib.format.magic(1, 0) + struct.pack('<H', length)
+            + (header(numRows).ljust(length - 1) + '\n').encode('latin1'))
+
+def writeNpyReport(rows, reportFile):
+    '''Writes report rows to a binary file in NumPy format (.npy) as a
+    structured array with a field for each column (see
+    reportColumnTypes).  Missing scores are NaN.  The rows are written a
+    chunk at a time and then the header is rewritten with their number,
+    so the file must be seekable.  See loadReportArray.
+    '''
+    requireNumpy()
+    dtype = numpy.dtype(list(reportColumnTypes))
+    start = reportFile.tell()
+    reportFile.write(npyReportHeader(dtype, 0))
+    numRows = 0
+    rows = iter(rows)
+    while True:
+        chunk = [tuple(row[:-1]) + (
+                float('nan') if row[-1] is None else row[-1],)
+                 for row in itertools.islice(rows, npyReportChunkSize)]
+        if not chunk:
+            break
+        reportFile.write(numpy.array(chunk, dtype=dtype).tobytes())
+        numRows += len(chunk)
+    end = reportFile.tell()
+    reportFile.seek(start)
+    reportFile.write(npyReportHeader(dtype, numRows))
+    reportFile.seek(end)
+
+def loadReportArray(fileName):
+    '''Returns the rows of a report in NumPy format (as written by
+    writeNpyReport) as a read-only structured array memory-mapped from
+    the file.  Loading takes no time whatever the size of the report,
+    columns are read from disk as they are used, and processes that load
+    the same report share its pages.
+    '''
+    requireNumpy()
+    report = numpy.load(fileName, mmap_mode='r')
+    if report.dtype.names != reportColumnNames:
+        raise ValueError('Not a report in NumPy format: {}'.format(fileName))
+    return report
+
+def writeSweepReports(rows, fileNamePattern, reportFormat='csv'):
+    '''Writes the rows of each configuration of a sweep to their own
+    report file without the configuration column.  The file names are
+    made by substituting the configuration number for '{config}' in the
+    given pattern.
+    '''
+    for config, configRows in itertools.groupby(rows, key=lambda row: row[0]):
+        mode = 'wb' if reportFormat in ('csv.gz', 'npy') else 'w'
+        configRows = (ReportRow._make(row[1:]) for row in configRows)
+        with open(fileNamePattern.format(config=config), mode) as reportFile:
+            if reportFormat == 'npy':
+                writeNpyReport(configRows, reportFile)
+            else:
+                writeCsvReport(configRows, reportFile, reportFormat)
+
+def writeSweepConfigs(configs, fileName):
+    # Write the configurations of a sweep (with a header) as CSV
+    with open(fileName, 'w') as configsFile:
+        writer = csv.writer(configsFile, lineterminator='\n')
+        writer.writerow(('config',) + sweepParameterNames)
+        for index, config in enumerate(configs, start=1):
+            writer.writerow((index,) + config)
+
+# Number of counts columns at the start of a report
+numCountsColumns = 12
+
+def twoByTwoTable(counts, pseudocount):
+    # Returns the cells of the 2x2 table of drug and condition (ignoring
+    # time) with the pseudocount added: both, drug only, condition only,
+    # and neither
+    m = float(pseudocount)
+    a = counts['ct_d_c'] + m
+    b = counts['ct_d'] - counts['ct_d_c'] + m
+    c = counts['ct_c'] - counts['ct_d_c'] + m
+    d = counts['ct_ppl'] - counts['ct_d'] - counts['ct_c'] + counts['ct_d_c'] + m
+    return a, b, c, d
+
+def computeOddsRatios(counts, pseudocount):
+    a, b, c, d = twoByTwoTable(counts, pseudocount)
+    return (a * d) / (b * c)
+
+def computeRelativeRisks(counts, pseudocount):
+    # Risk of the condition with the drug over the risk without it
+    a, b, c, d = twoByTwoTable(counts, pseudocount)
+    return (a / (a + b)) / (c / (c + d))
+
+def computeDrugBeforeCondProbs(counts, pseudocount):
+    # Numerator of the temporal score: Pr(t_d < t_c | d, c)
+    m = float(pseudocount)
+    return (counts['ct_d_bef_c'] + m) / (counts['ct_d_c'] + m + m)
+
+# Scores that rescoring can compute from the counts columns of a report.
+# Each function takes a mapping of column names to arrays of counts and
+# a pseudocount.
+scoreFunctions = collections.OrderedDict((
+        ('temporal_score', lambda counts, pseudocount: computeTemporalScores(
+                counts['ct_d_bef_c'], counts['ct_d_c'],
+                counts['ct_d_bef_anyc'], counts['ct_d_anyc'],
+                counts['ct_anyd_bef_c'], counts['ct_anyd_c'],
+                pseudocount)),
+        ('odds_ratio', computeOddsRatios),
+        ('relative_risk', computeRelativeRisks),
+        ('pr_d_bef_c', computeDrugBeforeCondProbs),
+        ))
+
+def readReportCounts(reportFileName):
+    '''Reads the counts columns of a report file (plain, spooled, or
+    gzip-compressed CSV without a header, or NumPy format if its name
+    ends in '.npy') into an array of ints with a row per pair and a
+    column per counts column.  Any other columns are ignored.
+    '''
+    requireNumpy()
+    logger = logging.getLogger(__name__)
+    logger.info('Reading counts from report: %s', reportFileName)
+    if reportFileName.endswith('.npy'):
+        report = loadReportArray(reportFileName)
+        counts = numpy.empty((len(report), numCountsColumns),
+                             dtype=numpy.int64)
+        for index, name in enumerate(reportColumnNames[:numCountsColumns]):
+            counts[:, index] = report[name]
+    else:
+        counts = numpy.loadtxt(reportFileName, delimiter=',', ndmin=2,
+                               usecols=range(numCountsColumns),
+                               dtype=numpy.int64)
+    logger.info('Read counts of %s pairs', len(counts))
+    return counts
+
+def readResultsTableCounts(dbFileName, tableName):
+    '''Reads the counts columns of a results table in a SQLite DB into
+    an array of ints like readReportCounts.
+    '''
+    requireNumpy()
+    logger = logging.getLogger(__name__)
+    logger.info('Reading counts from SQLite table: %s: %s',
+                dbFileName, tableName)
+    connection = sqlite3.connect(dbFileName)
+    try:
+        rows = connection.execute(
+            'select {} from {} order by drug, cond'.format(
+                ', '.join(reportColumnNames[:numCountsColumns]), tableName)
+            ).fetchall()
+    finally:
+        connection.close()
+    logger.info('Read counts of %s pairs', len(rows))
+    return numpy.array(rows, dtype=numpy.int64).reshape(
+        (-1, numCountsColumns))
+
+def rescoreCounts(counts, pseudocounts=(1,), scoreNames=('temporal_score',)):
+    '''Computes scores from an array of counts (as returned by
+    readReportCounts) for each combination of pseudocount and score.
+    Returns the names of the score columns and an array of scores with
+    a column per combination.  Columns are named by their score (and
+    their pseudocount if there are several pseudocounts).
+    '''
+    requireNumpy()
+    countsColumns = dict(
+        (name, counts[:, index].astype(numpy.float64))
+        for index, name in enumerate(reportColumnNames[:numCountsColumns]))
+    names = []
+    scores = []
+    for pseudocount in pseudocounts:
+        for scoreName in scoreNames:
+            if scoreName not in scoreFunctions:
+                raise ValueError('Unknown score: {}'.format(scoreName))
+            if len(pseudocounts) > 1:
+                names.append('{}_{}'.format(scoreName, pseudocount))
+            else:
+                names.append(scoreName)
+            scores.append(scoreFunctions[scoreName](countsColumns, pseudocount))
+    return names, numpy.column_stack(scores)
+
+def writeRescoredReport(reportFile, counts, scoreNames, scores, header=False):
+    '''Writes the counts and scores as a report in CSV format (with a
+    header if requested).  With just the temporal score, the report is
+    in the same format as other reports.  The report file is a file
+    name (compressed if it ends in '.gz') or an open file.
+    '''
+    names = reportColumnNames[:numCountsColumns] + tuple(scoreNames)
+    numpy.savetxt(
+        reportFile, numpy.column_stack((counts, scores)),
+        fmt=['%d'] * numCountsColumns + ['%s'] * len(scoreNames),
+        delimiter=',', header=(','.join(names) if header else ''),
+        comments='')
+
+class NumpyBackend(Backend):
+
+    # Function that counts people from first occurrences
+    countsFunction = staticmethod(sweepCounts)
+
+    # First occurrences of all the drugs and conditions kept by warmUp
+    allFirstOccurrences = None
+
+    def readEras(self):
+        # Returns the drug era arrays and the condition era arrays
+        parameters = self.parameters
+        drugEras = readEraCsv(
+            parameters['drugEraFileName'],
+            'drug_concept_id', 'drug_era_start_date')
+        condEras = readEraCsv(
+            parameters['condEraFileName'],
+            'condition_concept_id', 'condition_era_start_date')
+        return drugEras, condEras
+
+    def openStores(self):
+        # Returns the drug and condition first occurrence stores, building
+        # them from the era extracts if they are missing or out of date,
+        # or None if there is no store directory
+        parameters = self.parameters
+        directory = parameters.get('firstOccurrenceStore')
+        if not directory:
+            return None
+        sources = (eraSourceSignature(parameters['drugEraFileName']),
+                   eraSourceSignature(parameters['condEraFileName']))
+        stores = tuple(openFirstOccurrenceStore(directory, name, source)
+                       for name, source in zip(('drug', 'cond'), sources))
+        if None not in stores:
+            return stores
+        with self.metrics.timed('build_store') as phase:
+            drugEras, condEras = self.readEras()
+            phase['rows'] = len(drugEras[0]) + len(condEras[0])
+            for name, eras, source in zip(
+                    ('drug', 'cond'), (drugEras, condEras), sources):
+                writeFirstOccurrenceStore(
+                    directory, name, allFirstOccurrences(eras), source)
+        return tuple(openFirstOccurrenceStore(directory, name)
+                     for name in ('drug', 'cond'))
+
+    def warmUp(self):
+        requireNumpy()
+        stores = self.openStores()
+        if stores is not None:
+            self.allFirstOccurrences = tuple(
+                storeFirstOccurrences(store) for store in stores)
+            return
+        drugEras, condEras = self.readEras()
+        self.allFirstOccurrences = (
+            allFirstOccurrences(drugEras), allFirstOccurrences(condEras))
+
+    def close(self):
+        self.allFirstOccurrences = None
+
+    def prunedCountsFunction(self):
+        # Returns the counts function with the pairs that cannot reach
+        # minCtDC pruned.  Only for counting all the people at once, as
+        # partitions do not know the totals to prune by (see
+        # partitionsCountsFunction).
+        minCtDC = selectionParameters(self.parameters)[2]
+        if minCtDC:
+            return functools.partial(self.countsFunction,
+                                     minPairCount=minCtDC)
+        return self.countsFunction
+
+    def partitionsCountsFunction(self, countPartitions):
+        # Returns the counts function for partitions of the people with
+        # the pairs that cannot reach minCtDC pruned.  The marginals of
+        # all the people are counted first (without pairs) by the given
+        # function, which counts all the partitions with the given
+        # counts function and returns the totals.
+        minCtDC = selectionParameters(self.parameters)[2]
+        if not minCtDC:
+            return self.countsFunction
+        logger = logging.getLogger(__name__)
+        logger.info('Counting the marginals to prune pairs by')
+        with self.metrics.timed('count_marginals'):
+            masks = pairMasks(countPartitions(marginalsCounts), minCtDC)
+        return functools.partial(self.countsFunction, pairMasks=masks)
+
+    def countPeople(self, drugIds, condIds, settings):
+        # Returns the sorted arrays of drug and condition IDs and the
+        # counts for each of the given (window start, window end,
+        # offset) settings, counting partitions of the people in
+        # parallel if requested
+        parameters = self.parameters
+        if parseBoolean(parameters.get('incremental')):
+            raise ValueError('The numpy engine does not support incremental mode.')
+        drugIds = numpy.unique(numpy.array(drugIds, dtype=numpy.int64))
+        condIds = numpy.unique(numpy.array(condIds, dtype=numpy.int64))
+        # Use the first occurrences kept by warmUp if any
+        if self.allFirstOccurrences is not None:
+            allFirstDrugs, allFirstConds = self.allFirstOccurrences
+            with self.metrics.timed('count'):
+                return drugIds, condIds, self.prunedCountsFunction()(
+                    selectFirstOccurrences(allFirstDrugs, drugIds),
+                    selectFirstOccurrences(allFirstConds, condIds),
+                    len(drugIds), len(condIds), settings)
+        numProcesses = int(parameters.get('processes') or 1)
+        # Stream the era records in chunks of people if requested
+        if parseBoolean(parameters.get('streaming')):
+            if parameters.get('firstOccurrenceStore'):
+                raise ValueError('Streaming does not use a first occurrence store.')
+            def countStream(countsFunction):
+                return self.countStream(drugIds, condIds, settings,
+                                        numProcesses, countsFunction)
+            return drugIds, condIds, countStream(
+                self.partitionsCountsFunction(countStream))
+        # Use the first occurrence stores if any
+        stores = self.openStores()
+        if stores is not None:
+            return drugIds, condIds, self.countStores(
+                stores, drugIds, condIds, settings, numProcesses)
+        # Load the era records
+        with self.metrics.timed('read_eras') as phase:
+            drugEras, condEras = self.readEras()
+            phase['rows'] = len(drugEras[0]) + len(condEras[0])
+        if numProcesses <= 1:
+            with self.metrics.timed('count'):
+                return drugIds, condIds, partitionCounts(
+                    (drugEras, condEras, drugIds, condIds, settings,
+                     self.prunedCountsFunction()))
+        # Only send the records of the given IDs to the processes
+        drugEras = filterEras(drugEras, drugIds)
+        condEras = filterEras(condEras, condIds)
+        erasPartitions = list(zip(partitionEras(drugEras, numProcesses),
+                                  partitionEras(condEras, numProcesses)))
+        del drugEras, condEras
+        def countPartitions(countsFunction):
+            return self.countPartitions(partitionCounts, [
+                    (partitionDrugEras, partitionCondEras, drugIds, condIds,
+                     settings, countsFunction)
+                    for partitionDrugEras, partitionCondEras
+                    in erasPartitions], numProcesses)
+        return drugIds, condIds, countPartitions(
+            self.partitionsCountsFunction(countPartitions))
 
-exit
-'''
+    def countStream(self, drugIds, condIds, settings, numProcesses,
+                    countsFunction):
+        # Counts chunks of people as they are read from the extracts
+        # with the given counts function and adds up their counts.  At
+        # most two chunks per process are in memory at once.
+        logger = logging.getLogger(__name__)
+        parameters = self.parameters
+        chunks = iterEraChunks(
+            parameters['drugEraFileName'], parameters['condEraFileName'],
+            drugIds.tolist(), condIds.tolist(),
+            int(parameters['streamChunkSize']))
+        partitions = ((chunkDrugEras, chunkCondEras, drugIds, condIds,
+                       settings, countsFunction)
+                      for chunkDrugEras, chunkCondEras in chunks)
+        total = None
+        numRecords = 0
+        with self.metrics.timed('stream') as phase:
+            pool = (multiprocessing.Pool(numProcesses)
+                    if numProcesses > 1 else None)
+            try:
+                pending = collections.deque()
+                for partition in itertools.chain(partitions, [None]):
+                    checkCancelled()
+                    if partition is not None:
+                        numRecords += len(partition[0][0]) + len(partition[1][0])
+                        if pool is None:
+                            pending.append(partitionCounts(partition))
+                        else:
+                            pending.append(pool.apply_async(
+                                    partitionCounts, (partition,)))
+                    # Add up the counts of the oldest chunks when enough
+                    # are pending or at the end
+                    while pending and (partition is None or
+                                       len(pending) >= 2 * numProcesses):
+                        countsList = pending.popleft()
+                        if pool is not None:
+                            countsList = getUncancelled(countsList.get)
+                        if total is None:
+                            total = countsList
+                        else:
+                            total = [addCounts(counts1, counts2) for
+                                     counts1, counts2 in zip(total, countsList)]
+                if pool is not None:
+                    pool.close()
+            except Exception:
+                if pool is not None:
+                    pool.terminate()
+                raise
+            finally:
+                if pool is not None:
+                    pool.join()
+            phase['rows'] = numRecords
+        logger.info('Streamed %s era records of the requested IDs', numRecords)
+        if total is None:
+            # No records at all
+            total = countsFunction(
+                (numpy.zeros(0, dtype=numpy.int64),) * 3,
+                (numpy.zeros(0, dtype=numpy.int64),) * 3,
+                len(drugIds), len(condIds), settings)
+        return total
 
-_settingPattern = re.compile(r'^\s*([\w~!@$%^&*+|;,./?-]+)\s*[:=]\s*(.*?)\s*$')
+    def countStores(self, stores, drugIds, condIds, settings, numProcesses):
+        # Counts from the first occurrence stores.  The processes open
+        # the stores themselves and are only sent ranges of their rows.
+        drugStore, condStore = stores
+        if numProcesses <= 1:
+            with self.metrics.timed('count'):
+                return self.prunedCountsFunction()(
+                    selectFirstOccurrences(
+                        storeFirstOccurrences(drugStore), drugIds),
+                    selectFirstOccurrences(
+                        storeFirstOccurrences(condStore), condIds),
+                    len(drugIds), len(condIds), settings)
+        directory = self.parameters['firstOccurrenceStore']
+        rowsPartitions = storePartitionsRows(
+            drugStore, condStore, numProcesses)
+        def countPartitions(countsFunction):
+            return self.countPartitions(storePartitionCounts, [
+                    (directory, drugRows, condRows, drugIds, condIds,
+                     settings, countsFunction)
+                    for drugRows, condRows in rowsPartitions], numProcesses)
+        return countPartitions(self.partitionsCountsFunction(countPartitions))
 
-# Can't use ConfigParser because it case-converts all names
-def parseConfig(fileName):
-    logger = logging.getLogger(__name__)
-    settings = collections.OrderedDict()
-    logger.info('Loading configuration file: %s', fileName)
-    with open(fileName, 'r') as inputFile:
-        for lineNumber, line in enumerate(inputFile, start=1):
-            strippedLine = line.strip()
-            # Skip blank lines and comments
-            if not strippedLine or strippedLine.startswith('#'):
-                continue
-            # Parse settings
-            match = _settingPattern.match(line)
-            if match is None:
-                logger.warning("Skipping non-setting at %s:%s: '%s'", fileName, lineNumber, line.rstrip('\n'))
-            else:
-                name, value = match.group(1, 2)
-                settings[name] = value
-    return settings
+    def countPartitions(self, function, partitions, numProcesses):
+        # Counts the partitions with the given function in a pool of
+        # processes and returns the total counts for each setting
+        logger = logging.getLogger(__name__)
+        logger.info('Counting %s partitions of the people in %s processes',
+                    len(partitions), numProcesses)
+        with self.metrics.timed('count'):
+            pool = multiprocessing.Pool(numProcesses)
+            try:
+                # Add up the partial counts as the partitions finish
+                total = None
+                results = pool.imap_unordered(function, partitions)
+                for partition in partitions:
+                    countsList = getUncancelled(results.next)
+                    if total is None:
+                        total = countsList
+                    else:
+                        total = [addCounts(counts1, counts2) for
+                                 counts1, counts2 in zip(total, countsList)]
+                pool.close()
+            except Exception:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        return total
 
-def dictToPrettyString(dict_):
-    lines = ['{']
-    for name, value in dict_.viewitems():
-        lines.append(str(name) + ': ' + str(value) + ',')
-    lines.append('}')
-    return '\n'.join(lines)
+    def iterRows(self, drugIds, condIds):
+        requireNumpy()
+        parameters = self.parameters
+        # Convert the parameters, which may be strings from a config file
+        windowStart = int(parameters['conditionWindowStart'])
+        windowEnd = int(parameters['conditionWindowEnd'])
+        drugOffset = int(parameters['drugOccurrenceOffset'])
+        pseudocount = float(parameters['pseudocount'])
+        drugIds, condIds, (counts,) = self.countPeople(
+            drugIds, condIds, [(windowStart, windowEnd, drugOffset)])
+        drugMarginalsRows, condMarginalsRows = marginalsRows(
+            counts, drugIds, condIds)
+        writeMarginalsReports(drugMarginalsRows, condMarginalsRows, parameters)
+        # Score and generate the report rows
+        with self.metrics.timed('report') as phase:
+            phase['rows'] = 0
+            for row in iterCountsRows(counts, drugIds, condIds, pseudocount,
+                                      parameters['sparse'],
+                                      *selectionParameters(parameters)):
+                phase['rows'] += 1
+                yield row
 
-_integerPattern = re.compile(r'\s*\d+\s*')
+    def iterSweepRows(self, drugIds, condIds, configs):
+        requireNumpy()
+        parameters = self.parameters
+        # Count each distinct setting of the counts once.
+        # Configurations that only differ in pseudocount reuse the
+        # counts.
+        settings = [config[:3] for index, config, isNewCounts
+                    in iterSweepCounts(configs) if isNewCounts]
+        drugIds, condIds, countsList = self.countPeople(
+            drugIds, condIds, settings)
+        countsIter = iter(countsList)
+        drugMarginalsRows = []
+        condMarginalsRows = []
+        for index, config, isNewCounts in iterSweepCounts(configs):
+            if isNewCounts:
+                counts = next(countsIter)
+                configDrugRows, configCondRows = marginalsRows(
+                    counts, drugIds, condIds)
+            drugMarginalsRows.extend((index,) + row for row in configDrugRows)
+            condMarginalsRows.extend((index,) + row for row in configCondRows)
+            with self.metrics.timed('report') as phase:
+                phase['rows'] = 0
+                for row in iterCountsRows(counts, drugIds, condIds,
+                                          config.pseudocount,
+                                          parameters['sparse'],
+                                          *selectionParameters(parameters)):
+                    phase['rows'] += 1
+                    yield SweepRow(index, *row)
+        writeMarginalsReports(drugMarginalsRows, condMarginalsRows, parameters)
 
-def parseIds(inputFile):
-    ids = []
-    for lineNumber, line in enumerate(inputFile, start=1):
-        strippedLine = line.strip()
-        # Skip empty lines and comments
-        if not line or strippedLine.startswith('#'):
-            continue
-        # Convert integer IDs to integers
-        id_ = strippedLine
-        match = _integerPattern.match(id_)
-        if match is not None:
-            id_ = int(match.group())
-        ids.append(id_)
-    return ids
+    def iterStratifiedRows(self, drugIds, condIds):
+        requireNumpy()
+        parameters = self.parameters
+        windowStart = int(parameters['conditionWindowStart'])
+        windowEnd = int(parameters['conditionWindowEnd'])
+        drugOffset = int(parameters['drugOccurrenceOffset'])
+        pseudocount = float(parameters['pseudocount'])
+        drugIds = numpy.unique(numpy.array(drugIds, dtype=numpy.int64))
+        condIds = numpy.unique(numpy.array(condIds, dtype=numpy.int64))
+        with self.metrics.timed('read_eras') as phase:
+            drugEras, condEras = self.readEras()
+            phase['rows'] = len(drugEras[0]) + len(condEras[0])
+        # Find the stratum of each record and make the people of each
+        # stratum distinct, so that the first occurrences are found and
+        # joined once for all the strata
+        with self.metrics.timed('strata') as phase:
+            drugEras = filterEras(drugEras, drugIds)
+            condEras = filterEras(condEras, condIds)
+            (drugStrata, condStrata), labels = eraStrata(
+                (drugEras, condEras), parameters['stratifyBy'],
+                int(parameters['stratumWidth']),
+                parameters.get('personFileName'))
+            phase['rows'] = len(labels)
+            personsPerStratum = 1 + max(
+                [int(eras[0].max()) for eras in (drugEras, condEras)
+                 if len(eras[0]) > 0] or [0])
+            if len(labels) * personsPerStratum >= 2 ** 62:
+                raise ValueError('Too many strata for the person IDs.')
+            firstDrugs = firstOccurrences(*(
+                    stratifyEras(drugEras, drugStrata, personsPerStratum)
+                    + (drugIds,)))
+            firstConds = firstOccurrences(*(
+                    stratifyEras(condEras, condStrata, personsPerStratum)
+                    + (condIds,)))
+        del drugEras, condEras
+        # The first occurrences are sorted by person, so the people of
+        # each stratum are together
+        def stratumRows(firstOccs, stratum):
+            bounds = numpy.searchsorted(
+                firstOccs[0], [stratum * personsPerStratum,
+                               (stratum + 1) * personsPerStratum])
+            return tuple(array[bounds[0]:bounds[1]] for array in firstOccs)
+        strata = ((stratumRows(firstDrugs, stratum),
+                   stratumRows(firstConds, stratum),
+                   len(drugIds), len(condIds),
+                   [(windowStart, windowEnd, drugOffset)],
+                   self.prunedCountsFunction())
+                  for stratum in range(len(labels)))
+        # Count the strata in order, in parallel if requested
+        numProcesses = int(parameters.get('processes') or 1)
+        pool = (multiprocessing.Pool(numProcesses)
+                if numProcesses > 1 else None)
+        try:
+            if pool is None:
+                countsIter = (stratumCounts(stratum) for stratum in strata)
+            else:
+                countsIter = pool.imap(stratumCounts, strata)
+            drugMarginalsRows = []
+            condMarginalsRows = []
+            for label in labels:
+                with self.metrics.timed('count'):
+                    if pool is None:
+                        checkCancelled()
+                        counts, = next(countsIter)
+                    else:
+                        counts, = getUncancelled(countsIter.next)
+                stratumDrugRows, stratumCondRows = marginalsRows(
+                    counts, drugIds, condIds)
+                drugMarginalsRows.extend(
+                    (label,) + row for row in stratumDrugRows)
+                condMarginalsRows.extend(
+                    (label,) + row for row in stratumCondRows)
+                with self.metrics.timed('report') as phase:
+                    phase['rows'] = 0
+                    for row in iterCountsRows(
+                            counts, drugIds, condIds, pseudocount,
+                            parameters['sparse'],
+                            *selectionParameters(parameters)):
+                        phase['rows'] += 1
+                        yield StratumRow(label, *row)
+            if pool is not None:
+                pool.close()
+        finally:
+            # Also stops the processes if the rows are not all read
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        writeMarginalsReports(drugMarginalsRows, condMarginalsRows, parameters)
 
-def temporalScore(drugIds, condIds, parameters=defaultParameters):
-    logger = logging.getLogger(__name__)
-    logger.info('Computing temporal scores')
-    # Copy the parameters to avoid modifying the original
-    parameters = dict(parameters)
-    # Construct the tuples of IDs (in string form)
-    parameters['drugIdsTuple'] = repr(tuple(drugIds))
-    parameters['condIdsTuple'] = repr(tuple(condIds))
-    # Create a temporary file for the report output
-    reportOutput = tempfile.NamedTemporaryFile(suffix='.csv')
-    parameters['reportFileName'] = reportOutput.name
-    # Build the SQL script
-    sqlTemplate = string.Template(sqlScriptTemplate)
-    sqlScript = sqlTemplate.substitute(parameters)
-    # Run the SQL script
-    scriptOutput = runOracleSqlScript(
-        parameters['dbConnectionName'],
-        parameters['dbUser'],
-        parameters['dbPass'],
-        sqlScript,
-        )
-    # Prepare report output for reading as input
-    reportOutput.flush()
-    reportOutput.seek(0)
-    return reportOutput, scriptOutput
+class BitmapBackend(NumpyBackend):
+    '''Counts like the 'numpy' engine but counts the columns that are
+    sizes of sets of people with bitmaps of people (see bitmapCounts).
+    '''
+
+    countsFunction = staticmethod(bitmapCounts)
+
+# Counting engines by name
+backends = {
+    'oracle': OracleBackend,
+    'sqlite': SqliteBackend,
+    'numpy': NumpyBackend,
+    'bitmap': BitmapBackend,
+    }
 
 class OracleError(Exception):
 
@@ -365,8 +5481,8 @@ def runOracleSqlScript(dbName, dbUser, dbPass, script):
     try:
         # Run the Oracle script as a sub-process
         logger.info('Running Oracle sub-process: %s', ' '.join(command))
-        process = subprocess.Popen(command, stdin=subprocess.PIPE,
-                                   stdout=output, stderr=subprocess.STDOUT)
+        process = startSubprocess(command, stdin=subprocess.PIPE,
+                                  stdout=output, stderr=subprocess.STDOUT)
         # Write the password to the standard input of the process.
         # Since stdout and stderr are not pipes, communicate() should
         # not return any data.  Communicate needs to be called for some
@@ -404,20 +5520,435 @@ def runOracleSqlScript(dbName, dbUser, dbPass, script):
     logger.info('Oracle sub-process done.')
     return output
 
+# Like runOracleSqlScript but generates the lines of output as sqlplus
+# writes them instead of collecting them in a file
+def iterOracleSqlScript(dbName, dbUser, dbPass, script):
+    logger = logging.getLogger(__name__)
+    logger.info('Running Oracle script')
+    logger.debug('Oracle script:\n%s', script)
+    # Dump the script out to a temporary file such that it can be opened
+    # by name
+    scriptFile = tempfile.NamedTemporaryFile(suffix='.sql', mode='w')
+    scriptFile.write(script)
+    scriptFile.flush()
+    os.fsync(scriptFile.fileno())
+    # Keep the last lines of output for reporting errors
+    lastLines = collections.deque(maxlen=100)
+    command = ['sqlplus', '-s', dbUser + '@' + dbName, '@' + scriptFile.name]
+    process = None
+    try:
+        logger.info('Running Oracle sub-process: %s', ' '.join(command))
+        process = startSubprocess(command, stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT,
+                                  universal_newlines=True)
+        # Write the password and close input so that sqlplus does not
+        # wait for more
+        process.stdin.write(dbPass)
+        process.stdin.close()
+        for line in iter(process.stdout.readline, ''):
+            lastLines.append(line)
+            yield line
+        process.wait()
+        if process.returncode == 0:
+            logger.info('Oracle sub-process finished successfully.')
+        else:
+            if process.returncode > 0:
+                logger.error('Oracle sub-process failed with code: %s', process.returncode)
+            else:
+                logger.error('Oracle sub-process killed by signal: %s', -process.returncode)
+            logger.info('Oracle output (last lines):\n%s', ''.join(lastLines))
+            if process.returncode > 0:
+                raise OracleError(exitCode=process.returncode)
+            else:
+                raise OracleError(signal=-process.returncode)
+    finally:
+        # Stop sqlplus if the consumer stopped early or something failed
+        if process is not None and process.poll() is None:
+            logger.warning('Killing Oracle sub-process')
+            process.kill()
+            process.wait()
+        # Close the temporary file (which deletes it)
+        scriptFile.close()
+    logger.info('Oracle sub-process done.')
+
+class ScoringJobCancelled(Exception):
+    pass
+
+# The scoring job run by the current thread, if any
+_currentJob = threading.local()
+
+def currentScoringJob():
+    return getattr(_currentJob, 'job', None)
+
+@contextlib.contextmanager
+def runningScoringJob(job):
+    # Makes the given job (or None) the job of the current thread, so
+    # that the sub-processes started for it are killed if it is
+    # cancelled
+    previous = currentScoringJob()
+    _currentJob.job = job
+    try:
+        yield job
+    finally:
+        _currentJob.job = previous
+
+def checkCancelled():
+    # Raises ScoringJobCancelled if the job of the current thread has
+    # been cancelled
+    job = currentScoringJob()
+    if job is not None and job.cancelled:
+        raise ScoringJobCancelled(job.stopReason())
+
+# Seconds between checks for cancellation while waiting for processes
+cancelPollInterval = 0.1
+
+def getUncancelled(get):
+    # Returns the result of the given get function of a pool result
+    # (AsyncResult.get or IMapIterator.next), which takes a timeout, and
+    # checks whether the job of the current thread has been cancelled
+    # while waiting
+    while True:
+        checkCancelled()
+        try:
+            return get(cancelPollInterval)
+        except multiprocessing.TimeoutError:
+            pass
+
+def iterUncancelled(rows):
+    # Generates the given rows until the job of the current thread is
+    # cancelled
+    for row in rows:
+        checkCancelled()
+        yield row
+
+def startSubprocess(command, **kwargs):
+    # Starts a sub-process as subprocess.Popen does, for the job of the
+    # current thread if any
+    job = currentScoringJob()
+    if job is None:
+        return subprocess.Popen(command, **kwargs)
+    return job.startProcess(command, **kwargs)
+
+class ScoringJob(object):
+    '''A temporalScore run of a batch of runs (see runScoringJobs) with
+    its own drug and condition IDs, parameters, and timeout (in seconds,
+    or None).  Once it has finished, `reportOutput` and `scriptOutput`
+    are as returned by temporalScore, or else `error` is the exception
+    that stopped it (a ScoringJobCancelled if it was cancelled or timed
+    out, as `timedOut` tells).  `seconds` is how long it ran and
+    `metrics` has the phases of the run.
+    '''
+
+    def __init__(self, name, drugIds, condIds, parameters=defaultParameters,
+                 timeout=None):
+        self.name = name
+        self.drugIds = drugIds
+        self.condIds = condIds
+        self.parameters = parameters
+        self.timeout = timeout
+        self.metrics = Metrics()
+        self.reportOutput = None
+        self.scriptOutput = None
+        self.error = None
+        self.seconds = None
+        self.cancelled = False
+        self.timedOut = False
+        self.finished = False
+        self.processes = []
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def stopReason(self):
+        return 'Job {} {}'.format(
+            self.name, 'timed out' if self.timedOut else 'cancelled')
+
+    def startProcess(self, command, **kwargs):
+        # Starts a sub-process of the job unless it has been cancelled
+        with self.lock:
+            if self.cancelled:
+                raise ScoringJobCancelled(self.stopReason())
+            process = subprocess.Popen(command, **kwargs)
+            self.processes.append(process)
+            return process
+
+    def addConnection(self, connection):
+        # Records a SQLite connection the job runs statements on so that
+        # cancelling interrupts them, unless it has been cancelled
+        with self.lock:
+            if self.cancelled:
+                raise ScoringJobCancelled(self.stopReason())
+            self.connections.append(connection)
+
+    def cancel(self, timedOut=False):
+        '''Stops the job unless it has finished.  Kills its running
+        sub-processes (the sqlplus processes of the 'oracle' engine) and
+        interrupts the statements running on its SQLite connections.
+        The 'numpy' and 'bitmap' engines stop at the next partition,
+        setting, or report row (terminating their processes).
+        '''
+        logger = logging.getLogger(__name__)
+        with self.lock:
+            if self.cancelled or self.finished:
+                return
+            self.cancelled = True
+            self.timedOut = timedOut
+            processes = list(self.processes)
+            connections = list(self.connections)
+        logger.warning('%s', self.stopReason())
+        for connection in connections:
+            try:
+                connection.interrupt()
+            except sqlite3.ProgrammingError:
+                # It was closed in the meantime
+                pass
+        for process in processes:
+            if process.poll() is None:
+                logger.warning('Killing sub-process %s of job %s',
+                               process.pid, self.name)
+                try:
+                    process.kill()
+                except OSError:
+                    # It exited in the meantime
+                    pass
+
+    def score(self):
+        return temporalScore(
+            self.drugIds, self.condIds, self.parameters, self.metrics)
+
+    def run(self):
+        '''Runs the job in the current thread and records its results.'''
+        logger = logging.getLogger(__name__)
+        start = time.time()
+        try:
+            with runningScoringJob(self):
+                checkCancelled()
+                self.reportOutput, self.scriptOutput = self.score()
+        except Exception as e:
+            # Killed sub-processes fail with their own errors
+            if self.cancelled and not isinstance(e, ScoringJobCancelled):
+                e = ScoringJobCancelled(self.stopReason())
+            if not isinstance(e, ScoringJobCancelled):
+                logger.exception('Job %s failed', self.name)
+            self.error = e
+        finally:
+            self.seconds = time.time() - start
+            with self.lock:
+                self.finished = True
+        logger.info('Job %s finished in %.3f s', self.name, self.seconds)
+
+def runScoringJobs(jobs, concurrency=4):
+    '''Runs the given ScoringJobs concurrently, at most `concurrency` at a
+    time and each in its own thread, and generates them as they finish,
+    whether or not they succeed.  Jobs with a timeout are cancelled when
+    they have run that long.  Closing the generator before all the jobs
+    have finished cancels the running jobs and does not start the rest.
+
+    The 'oracle' engine runs sqlplus in sub-processes, so its jobs run
+    in parallel and the batch takes about as long as its longest jobs.
+    The local engines run in the threads (except for their `processes`),
+    so their jobs mostly take turns.
+    '''
+    logger = logging.getLogger(__name__)
+    pending = collections.deque(jobs)
+    finished = queue.Queue()
+    # Deadline of each running job (None if it has none)
+    running = {}
+    def runJob(job):
+        try:
+            job.run()
+        finally:
+            finished.put(job)
+    try:
+        while pending or running:
+            while pending and len(running) < concurrency:
+                job = pending.popleft()
+                logger.info('Starting job %s', job.name)
+                running[job] = (None if job.timeout is None
+                                else time.time() + float(job.timeout))
+                thread = threading.Thread(
+                    target=runJob, args=(job,),
+                    name='ScoringJob-{}'.format(job.name))
+                thread.daemon = True
+                thread.start()
+            # Wait for a job to finish or the next deadline, checking
+            # for interrupts at least every second
+            deadlines = [deadline for deadline in running.values()
+                         if deadline is not None]
+            wait = 1.0
+            if deadlines:
+                wait = min(wait, max(0.0, min(deadlines) - time.time()))
+            try:
+                job = finished.get(True, wait)
+            except queue.Empty:
+                now = time.time()
+                for job, deadline in list(running.items()):
+                    if deadline is not None and deadline <= now:
+                        job.cancel(timedOut=True)
+                        running[job] = None
+                continue
+            del running[job]
+            yield job
+    finally:
+        for job in running:
+            job.cancel()
+
+# Parameters that requests to the scoring service can set
+serviceRequestParameterNames = (
+    sweepParameterNames + ('sparse',) + selectionParameterNames)
+
+class ScoringService(object):
+    '''Scores requests for drug-condition pairs with a backend that is
+    kept warm between them.  The 'numpy' and 'bitmap' engines keep the
+    first occurrences of all the concepts in memory, and the 'sqlite'
+    engine keeps its connection open and the first occurrences of the
+    requested IDs in the first occurrences cache.  The 'oracle' engine
+    is not supported, since each of its runs logs in with sqlplus.  Each
+    request can set the parameters in serviceRequestParameterNames.
+    Requests are scored one at a time.
+    '''
+
+    def __init__(self, parameters):
+        logger = logging.getLogger(__name__)
+        parameters = dict(parameters)
+        if (parameters.get('engine') or 'oracle') == 'oracle':
+            raise ValueError(
+                'The scoring service does not support the oracle engine')
+        # Requests get rows, not files
+        parameters['drugMarginalsFileName'] = None
+        parameters['condMarginalsFileName'] = None
+        if (parameters.get('engine') == 'sqlite'
+                and not parseBoolean(parameters.get('incremental'))):
+            parameters['firstOccurrenceCache'] = True
+        self.backend = makeBackend(parameters)
+        self.parameters = dict(self.backend.parameters)
+        logger.info('Warming up the %s engine', parameters.get('engine'))
+        self.backend.warmUp()
+
+    def score(self, drugIds, condIds, options=None):
+        '''Returns the report rows (as ReportRow tuples) of the given drugs
+        and conditions with the given parameters (a dict) set.
+        '''
+        parameters = dict(self.parameters)
+        for name, value in (options or {}).items():
+            if name not in serviceRequestParameterNames:
+                raise ValueError('Unknown parameter: {}'.format(name))
+            parameters[name] = value
+        requireSingleConfiguration(parameters)
+        # Derive as makeBackend does
+        parameters['sparse'] = parseBoolean(parameters.get('sparse'))
+        parameters['pairCountsJoin'] = (
+            'join' if parameters['sparse'] else 'left join')
+        self.backend.parameters = parameters
+        return list(selectReportRows(self.backend.iterRows(drugIds, condIds),
+                                     *selectionParameters(parameters)))
+
+    def close(self):
+        self.backend.close()
+
+class ScoringRequestHandler(httpServer.BaseHTTPRequestHandler):
+    '''Handles requests to the scoring service of the server.  Requests
+    are 'GET /scores?drugs=1,2&conds=3,4' or 'POST /scores' with a JSON
+    object with lists of 'drugs' and 'conds'.  Either can also give the
+    'format' of the response ('json' or 'csv') and any of
+    serviceRequestParameterNames.
+    '''
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        request = dict((name, values[-1]) for name, values in
+                       urlparse.parse_qs(url.query).items())
+        self.respond(url.path, request)
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError as e:
+            self.sendError(400, 'Bad JSON: {}'.format(e))
+            return
+        if not isinstance(request, dict):
+            self.sendError(400, 'Request is not a JSON object.')
+            return
+        self.respond(url.path, request)
+
+    def respond(self, path, request):
+        logger = logging.getLogger(__name__)
+        if path != '/scores':
+            self.sendError(404, 'Not found: {}'.format(path))
+            return
+        request = dict((str(name), value) for name, value in request.items())
+        try:
+            drugIds = parseValues(request.pop('drugs', ()), int)
+            condIds = parseValues(request.pop('conds', ()), int)
+            responseFormat = request.pop('format', 'json')
+            if responseFormat not in ('json', 'csv'):
+                raise ValueError(
+                    'Unknown format: {}'.format(responseFormat))
+            if not drugIds or not condIds:
+                raise ValueError('Give the drugs and conditions to score.')
+            start = time.time()
+            rows = self.server.service.score(drugIds, condIds, request)
+            logger.info('Scored %s rows in %.3f s', len(rows),
+                        time.time() - start)
+        except ValueError as e:
+            self.sendError(400, str(e))
+            return
+        except Exception as e:
+            logger.exception('Failed to score request')
+            self.sendError(500, str(e))
+            return
+        if responseFormat == 'csv':
+            reportOutput = tempfile.TemporaryFile(mode='w+')
+            writeReportRows(rows, reportOutput)
+            reportOutput.seek(0)
+            self.send(200, 'text/csv', reportOutput.read())
+            reportOutput.close()
+        else:
+            self.send(200, 'application/json', json.dumps(
+                    {'rows': [row._asdict() for row in rows]}))
+
+    def sendError(self, code, message):
+        self.send(code, 'application/json', json.dumps({'error': message}))
+
+    def send(self, code, contentType, body):
+        body = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).info(format, *args)
+
+def makeScoringServer(service, host='localhost', port=8765):
+    # Returns an HTTP server of the given service on the given address
+    server = httpServer.HTTPServer((host, port), ScoringRequestHandler)
+    server.service = service
+    return server
+
 # Define the CLI
 _argParser = argparse.ArgumentParser(
     prog='temporalScore',
     description='''Evaluates the adverse drug event likelihood of
     drug-condition pairs using the temporal score from page 4 of (Page,
     et al. AAAI 2012) and outputs each pair with its counts and scores
-    in CSV format.  Runs only on an Oracle DB in IMEDS common data model
-    format.
+    in CSV format.  Runs on an Oracle DB in IMEDS common data model
+    format or locally on CSV extracts of the drug and condition era
+    tables.
 
     The drug-condition pairs are constructed as a Cartesian product of
     the lists of drugs and conditions in the given files.
 
     The parameters for this program are described in accompanying
     documentation.
+
+    To recompute the scores of an existing report without the database,
+    use 'temporalScore rescore' (see 'temporalScore rescore -h').  To
+    serve scores to other programs over HTTP, use 'temporalScore serve'
+    (see 'temporalScore serve -h').
     ''',
     )
 _argParser.add_argument(
@@ -444,6 +5975,11 @@ _argParser.add_argument(
     metavar='OUTPUT',
     type=argparse.FileType('w'),
     )
+_argParser.add_argument(
+    '--format',
+    help='Format of the report.  \'spool\' copies the report file of the engine (sqlplus-formatted for Oracle) once it is complete.  \'csv\' and \'csv.gz\' write plain or gzip-compressed CSV rows as they are produced.  \'npy\' writes a NumPy structured array with a typed field per column that loads instantly memory-mapped (needs an output file).  Overrides the parameters file.  Default is \'spool\'.',
+    choices=('spool', 'csv', 'csv.gz', 'npy'),
+    )
 _argParser.add_argument(
     '--db-conn',
     help='Name of the Oracle DB connection.  Overrides the parameters file.  Default is \'lsomop\'.',
@@ -465,6 +6001,257 @@ _argParser.add_argument(
     metavar='NAME',
     )
 _argParser.add_argument(
+    '--engine',
+    help='Counting engine: \'oracle\' (counts in the Oracle DB), \'sqlite\' (counts in an embedded SQLite DB), \'numpy\' (counts in memory), or \'bitmap\' (counts in memory with bitmaps of people).  Overrides the parameters file.  Default is \'oracle\'.',
+    choices=('oracle', 'sqlite', 'numpy', 'bitmap'),
+    )
+_argParser.add_argument(
+    '--drug-eras',
+    help='CSV extract of the drug era table for local engines.  Overrides the parameters file.',
+    metavar='FILE',
+    )
+_argParser.add_argument(
+    '--cond-eras',
+    help='CSV extract of the condition era table for local engines.  Overrides the parameters file.',
+    metavar='FILE',
+    )
+_argParser.add_argument(
+    '--processes',
+    help='Number of processes for the \'numpy\' engine to count partitions of the people in.  Overrides the parameters file.',
+    metavar='N',
+    type=int,
+    )
+_argParser.add_argument(
+    '--store',
+    help='Directory to keep the first occurrences for the \'numpy\' engine in as memory-mapped columns.  They are built from the CSV extracts on the first run and reused until the extracts change.  Overrides the parameters file.',
+    metavar='DIR',
+    )
+_argParser.add_argument(
+    '--streaming',
+    help='Read the CSV extracts, which must be sorted by person_id, in a single pass and count them in chunks of people so that memory does not grow with their size (\'numpy\' and \'bitmap\' engines).',
+    action='store_true',
+    default=None,
+    )
+_argParser.add_argument(
+    '--sqlite-db',
+    help='SQLite DB file containing the era tables for the \'sqlite\' engine.  Any CSV extracts are loaded into it.  Overrides the parameters file.  Default is an in-memory DB.',
+    metavar='FILE',
+    )
+_argParser.add_argument(
+    '--explain',
+    help='Log the query plans and timings of the SQLite statements.',
+    action='store_true',
+    default=None,
+    )
+_argParser.add_argument(
+    '--sparse',
+    help='Only report drug-condition pairs that occur together in some person.  Rows for the other pairs can be rebuilt from the marginals.',
+    action='store_true',
+    default=None,
+    )
+_argParser.add_argument(
+    '--normalized',
+    help='Only report the columns of each drug-condition pair (drug, cond, ct_d_bef_c, ct_c_bef_d, ct_d_c, temporal_score).  The columns of the drugs and conditions are in the marginals files (which must be given) and ct_ppl is in the run summary.',
+    action='store_true',
+    default=None,
+    )
+_argParser.add_argument(
+    '--summary',
+    help='Output file containing the summary of a normalized run (ct_ppl, the numbers of drugs, conditions, and pairs, and the counting parameters) in JSON format.  Overrides the parameters file.',
+    metavar='FILE',
+    )
+_argParser.add_argument(
+    '--top-k',
+    help='Only report the N drug-condition pairs with the highest scores, in order by decreasing score.  The report is written as CSV rows (the \'spool\' format is not used).  Overrides the parameters file.',
+    metavar='N',
+    type=int,
+    )
+_argParser.add_argument(
+    '--min-score',
+    help='Only report drug-condition pairs with at least this score.  Overrides the parameters file.',
+    metavar='SCORE',
+    type=float,
+    )
+_argParser.add_argument(
+    '--min-ct-d-c',
+    help='Only report drug-condition pairs with at least this many people with both the drug and the condition (ct_d_c).  Overrides the parameters file.',
+    metavar='N',
+    type=int,
+    )
+_argParser.add_argument(
+    '--stratify-by',
+    help='Count and score the pairs within each stratum: \'period\' (calendar period of the era start dates), \'age\' (age band at the era start dates), or the name of a column of the person extract.  The stratum is the first column of the report (\'numpy\' and \'bitmap\' engines).  Overrides the parameters file.',
+    metavar='ATTRIBUTE',
+    )
+_argParser.add_argument(
+    '--persons',
+    help='CSV extract of the person table for stratifying by age or by a column of it.  Overrides the parameters file.',
+    metavar='FILE',
+    )
+_argParser.add_argument(
+    '--incremental',
+    help='Add the drug and condition IDs that are new since the last incremental run to its results instead of starting over.  Use the same parameters and data for every run.',
+    action='store_true',
+    default=None,
+    )
+_argParser.add_argument(
+    '--cache',
+    help='Reuse the first occurrences of the drugs and conditions from previous runs with the same IDs (and cache them for future runs).  Cached first occurrences are recomputed if their era table changes.',
+    action='store_true',
+    default=None,
+    )
+_argParser.add_argument(
+    '--shards',
+    help='Split the drugs into this many shards and count them concurrently in separate Oracle sessions.  Overrides the parameters file.',
+    metavar='N',
+    type=int,
+    )
+_argParser.add_argument(
+    '--run-id',
+    help='Run the Oracle script in phases that each commit their results to tables of the run, recording the phases that are done in a manifest named after this ID, so that a failed run can be resumed with --resume.  Overrides the parameters file.',
+    metavar='RUN-ID',
+    )
+_argParser.add_argument(
+    '--resume',
+    help='Resume the checkpointed run with this ID, skipping the phases that are done.  Give the same IDs files and parameters as the failed run.',
+    metavar='RUN-ID',
+    )
+_argParser.add_argument(
+    '--checkpoint-dir',
+    help='Directory of the manifests of checkpointed runs.  Overrides the parameters file.  Default is the current directory.',
+    metavar='DIR',
+    )
+_argParser.add_argument(
+    '--metrics',
+    help='Output file containing the durations and row counts of the phases of the run in JSON format.  Overrides the parameters file.',
+    metavar='FILE',
+    )
+_argParser.add_argument(
+    '--drug-marginals',
+    help='Output file containing the counts for each drug in CSV format.  Overrides the parameters file.',
+    metavar='FILE',
+    )
+_argParser.add_argument(
+    '--cond-marginals',
+    help='Output file containing the counts for each condition in CSV format.  Overrides the parameters file.',
+    metavar='FILE',
+    )
+_argParser.add_argument(
+    '--debug',
+    help='Print stack traces.',
+    action='store_true',
+    default=False,
+    )
+
+_rescoreArgParser = argparse.ArgumentParser(
+    prog='temporalScore rescore',
+    description='''Recomputes the scores of an existing report from its
+    counts, for one or more pseudocounts and optionally other scores,
+    and outputs the counts and scores in CSV format.  Does not use the
+    database.
+    ''',
+    )
+_rescoreArgParser.add_argument(
+    'report',
+    help='Input report file in CSV format (as spooled or written by temporalScore, optionally gzip-compressed) or in NumPy format (named *.npy).',
+    metavar='REPORT-FILE',
+    nargs='?',
+    )
+_rescoreArgParser.add_argument(
+    '--sqlite-db',
+    help='SQLite DB file containing the results table to rescore instead of a report file.',
+    metavar='FILE',
+    )
+_rescoreArgParser.add_argument(
+    '--table',
+    help='Name of the results table to rescore in the SQLite DB.',
+    metavar='NAME',
+    )
+_rescoreArgParser.add_argument(
+    '--pseudocount',
+    help='Pseudocount to score with.  Repeat for several pseudocounts, which each get their own score columns.  Default is 1.',
+    type=float,
+    action='append',
+    )
+_rescoreArgParser.add_argument(
+    '--score',
+    help='Score to compute.  Repeat for several scores.  Default is temporal_score.',
+    choices=tuple(scoreFunctions),
+    action='append',
+    )
+_rescoreArgParser.add_argument(
+    '--header',
+    help='Write a header row naming the columns.',
+    action='store_true',
+    default=False,
+    )
+_rescoreArgParser.add_argument(
+    '-o', '--output',
+    help='Output file containing the counts and scores in CSV format (compressed if the name ends in ".gz").  Default is standard output.',
+    metavar='FILE',
+    )
+_rescoreArgParser.add_argument(
+    '--debug',
+    help='Print stack traces.',
+    action='store_true',
+    default=False,
+    )
+
+_serveArgParser = argparse.ArgumentParser(
+    prog='temporalScore serve',
+    description='''Runs a scoring service that keeps the engine warm
+    between requests and scores them over HTTP.  The engine must be
+    numpy, bitmap, or sqlite; oracle is not supported.  Request scores with
+    'GET /scores?drugs=1,2&conds=3,4' or with 'POST /scores' and a JSON
+    object like {"drugs": [1, 2], "conds": [3, 4]}.  Requests can also
+    give "format" ("json" or "csv") and the parameters
+    conditionWindowStart, conditionWindowEnd, drugOccurrenceOffset,
+    pseudocount, and sparse.
+    ''',
+    )
+_serveArgParser.add_argument(
+    '-p', '--parameters',
+    help='Input file containing Oracle DB and algorithm parameters in "config" format.',
+    metavar='PARAMS-FILE',
+    type=argparse.FileType('r'),
+    )
+_serveArgParser.add_argument(
+    '--engine',
+    help='Counting engine: \'sqlite\', \'numpy\', or \'bitmap\'.  Overrides the parameters file, which must otherwise set one of them.',
+    choices=('sqlite', 'numpy', 'bitmap'),
+    )
+_serveArgParser.add_argument(
+    '--drug-eras',
+    help='CSV extract of the drug era table for local engines.  Overrides the parameters file.',
+    metavar='FILE',
+    )
+_serveArgParser.add_argument(
+    '--cond-eras',
+    help='CSV extract of the condition era table for local engines.  Overrides the parameters file.',
+    metavar='FILE',
+    )
+_serveArgParser.add_argument(
+    '--store',
+    help='Directory of the first occurrences for the \'numpy\' engine (see \'temporalScore -h\').  Overrides the parameters file.',
+    metavar='DIR',
+    )
+_serveArgParser.add_argument(
+    '--sqlite-db',
+    help='SQLite DB file containing the era tables for the \'sqlite\' engine.  Overrides the parameters file.  Default is an in-memory DB.',
+    metavar='FILE',
+    )
+_serveArgParser.add_argument(
+    '--host',
+    help='Host name or address to listen on.  Default is \'localhost\'.',
+    default='localhost',
+    )
+_serveArgParser.add_argument(
+    '--port',
+    help='Port to listen on.  Default is 8765.',
+    type=int,
+    default=8765,
+    )
+_serveArgParser.add_argument(
     '--debug',
     help='Print stack traces.',
     action='store_true',
@@ -481,15 +6268,16 @@ def main(args=None):
     # Default args
     if args is None:
         args = sys.argv[1:]
+    # Dispatch to the rescore command
+    if args and args[0] == 'rescore':
+        return rescoreMain(args[1:])
+    # Dispatch to the serve command
+    if args and args[0] == 'serve':
+        return serveMain(args[1:])
     # Parse the arguments
     environment = _argParser.parse_args(args)
     # Set up logging
-    logging.basicConfig(
-        format='%(asctime)s %(name)s.%(funcName)s %(levelname)s %(message)s',
-        datefmt='%Y-%m-%dT%H:%M:%S',
-        level=logging.INFO,
-        stream=sys.stderr,
-        )
+    setUpLogging()
     logger = logging.getLogger(__name__)
     # Log basic information about this run
     logger.info('Run identifier (host/pid): %s/%s', socket.gethostname(), os.getpid())
@@ -528,34 +6316,264 @@ def main(args=None):
         parameters['dbPass'] = environment.db_pass
     if environment.db_schema is not None:
         parameters['dbSchemaName'] = environment.db_schema
+    if environment.engine is not None:
+        parameters['engine'] = environment.engine
+    if environment.drug_eras is not None:
+        parameters['drugEraFileName'] = environment.drug_eras
+    if environment.cond_eras is not None:
+        parameters['condEraFileName'] = environment.cond_eras
+    if environment.processes is not None:
+        parameters['processes'] = environment.processes
+    if environment.store is not None:
+        parameters['firstOccurrenceStore'] = environment.store
+    if environment.streaming is not None:
+        parameters['streaming'] = environment.streaming
+    if environment.stratify_by is not None:
+        parameters['stratifyBy'] = environment.stratify_by
+    if environment.persons is not None:
+        parameters['personFileName'] = environment.persons
+    if environment.top_k is not None:
+        parameters['topK'] = environment.top_k
+    if environment.min_score is not None:
+        parameters['minScore'] = environment.min_score
+    if environment.min_ct_d_c is not None:
+        parameters['minCtDC'] = environment.min_ct_d_c
+    if environment.sqlite_db is not None:
+        parameters['sqliteDbFileName'] = environment.sqlite_db
+    if environment.explain is not None:
+        parameters['explainQueryPlans'] = environment.explain
+    if environment.format is not None:
+        parameters['reportFormat'] = environment.format
+    if environment.sparse is not None:
+        parameters['sparse'] = environment.sparse
+    if environment.normalized is not None:
+        parameters['normalized'] = environment.normalized
+    if environment.summary is not None:
+        parameters['summaryFileName'] = environment.summary
+    if environment.incremental is not None:
+        parameters['incremental'] = environment.incremental
+    if environment.cache is not None:
+        parameters['firstOccurrenceCache'] = environment.cache
+    if environment.shards is not None:
+        parameters['shards'] = environment.shards
+    if environment.run_id is not None:
+        parameters['runId'] = environment.run_id
+    if environment.resume is not None:
+        parameters['runId'] = environment.resume
+        parameters['resume'] = True
+    if environment.checkpoint_dir is not None:
+        parameters['checkpointDirectory'] = environment.checkpoint_dir
+    if environment.metrics is not None:
+        parameters['metricsFileName'] = environment.metrics
+    if environment.drug_marginals is not None:
+        parameters['drugMarginalsFileName'] = environment.drug_marginals
+    if environment.cond_marginals is not None:
+        parameters['condMarginalsFileName'] = environment.cond_marginals
 
-    # Fill in missing parameter values
-    # Prompt for DB username
-    if parameters['dbUser'] is None:
-        parameters['dbUser'] = raw_input('Oracle username: ')
-    # Prompt for DB password
+    # Fill in missing parameter values (only Oracle needs a login)
     dbPass = parameters['dbPass']
-    if dbPass is None:
-        dbPass = getpass.getpass('Oracle password: ')
-        parameters['dbPass'] = '***redacted***'
-    # Set schema
-    if parameters['dbSchemaName'] is None:
-        parameters['dbSchemaName'] = parameters['dbUser']
+    if parameters['engine'] == 'oracle':
+        # Prompt for DB username
+        if parameters['dbUser'] is None:
+            parameters['dbUser'] = raw_input('Oracle username: ')
+        # Prompt for DB password
+        if dbPass is None:
+            dbPass = getpass.getpass('Oracle password: ')
+            parameters['dbPass'] = '***redacted***'
+        # Set schema
+        if parameters['dbSchemaName'] is None:
+            parameters['dbSchemaName'] = parameters['dbUser']
     # Log parameters (password excluded unless already public)
     logger.info('Parameters:\n%s', dictToPrettyString(parameters))
     # Store the password in the parameters
     parameters['dbPass'] = dbPass
 
-    # Compute the temporal score
-    reportOutput, oracleOutput = temporalScore(drugIds, condIds, parameters)
+    # Compute the temporal score and output the report
+    metrics = Metrics()
+    metrics.info.update((
+            ('host', socket.gethostname()),
+            ('pid', os.getpid()),
+            ('engine', parameters['engine']),
+            ('numDrugs', len(drugIds)),
+            ('numConds', len(condIds)),
+            ))
+    reportFormat = parameters.get('reportFormat') or 'spool'
+    if reportFormat not in ('spool', 'csv', 'csv.gz', 'npy'):
+        raise ValueError('Unknown report format: {}'.format(reportFormat))
+    configs = sweepConfigurations(parameters)
+    normalized = parseBoolean(parameters.get('normalized'))
+    if normalized:
+        if parameters.get('stratifyBy') or len(configs) > 1:
+            raise ValueError('Normalized reports only support one configuration.')
+        if reportFormat == 'npy':
+            raise ValueError('Normalized reports do not support the npy format.')
+        if not (parameters.get('drugMarginalsFileName')
+                and parameters.get('condMarginalsFileName')
+                and parameters.get('summaryFileName')):
+            raise ValueError('Normalized reports need the drug and condition marginals files and the summary file.')
+    if reportFormat == 'npy':
+        if parameters.get('stratifyBy') or (
+                len(configs) > 1 and not parameters.get('sweepReportFileName')):
+            raise ValueError('The npy format only supports reports of one configuration (or sweepReportFileName).')
+        if len(configs) == 1:
+            if reportFile is sys.stdout:
+                raise ValueError('The npy format needs an output file.')
+            # Reopen the report file for writing bytes
+            reportFile.close()
+            reportFile = open(reportFile.name, 'wb')
+    if parameters.get('stratifyBy'):
+        # Count within each stratum writing rows as they are produced
+        # (with the stratum in the first column)
+        if reportFormat == 'spool':
+            reportFormat = 'csv'
+        rows = iterStratifiedScores(drugIds, condIds, parameters, metrics)
+        logger.info('Writing report as it is produced')
+        writeCsvReport(rows, reportFile, reportFormat)
+    elif len(configs) > 1:
+        # Sweep over the configurations writing rows as they are
+        # produced (there is no single spooled report)
+        if parameters.get('sweepConfigsFileName'):
+            writeSweepConfigs(configs, parameters['sweepConfigsFileName'])
+        if reportFormat == 'spool':
+            reportFormat = 'csv'
+        rows = iterSweepScores(drugIds, condIds, parameters, metrics)
+        logger.info('Writing report as it is produced')
+        if parameters.get('sweepReportFileName'):
+            writeSweepReports(
+                rows, parameters['sweepReportFileName'], reportFormat)
+        else:
+            writeCsvReport(rows, reportFile, reportFormat)
+    elif normalized:
+        # Write the pair columns of rows as they are produced (the
+        # engine writes the marginals) and then the summary
+        if reportFormat == 'spool':
+            reportFormat = 'csv'
+        summary = collections.OrderedDict((
+                ('numDrugs', len(set(drugIds))),
+                ('numConds', len(set(condIds))),
+                ('ct_ppl', None),
+                ))
+        rows = normalizeReportRows(
+            iterTemporalScores(drugIds, condIds, parameters, metrics), summary)
+        logger.info('Writing normalized report as it is produced')
+        writeCsvReport(rows, reportFile, reportFormat)
+        # Every marginals row has ct_ppl, even if no pairs are reported
+        for fileName in (parameters['drugMarginalsFileName'],
+                         parameters['condMarginalsFileName']):
+            marginalsRows = readMarginalsRows(fileName)
+            if marginalsRows:
+                summary['ct_ppl'] = marginalsRows[0][-1]
+                break
+        summary.update((name, parameters.get(name)) for name in (
+                'engine', 'conditionWindowStart', 'conditionWindowEnd',
+                'drugOccurrenceOffset', 'pseudocount', 'sparse'))
+        logger.info('Writing run summary to: %s', parameters['summaryFileName'])
+        writeRunSummary(summary, parameters['summaryFileName'])
+    elif reportFormat == 'spool' and not any(
+            value is not None for value in selectionParameters(parameters)):
+        reportOutput, scriptOutput = temporalScore(
+            drugIds, condIds, parameters, metrics)
+        logger.info('Writing report')
+        with metrics.timed('report_copy'):
+            shutil.copyfileobj(reportOutput, reportFile)
+    else:
+        # Write rows straight to the destination as they are produced
+        rows = iterTemporalScores(drugIds, condIds, parameters, metrics)
+        logger.info('Writing report as it is produced')
+        if reportFormat == 'npy':
+            writeNpyReport(rows, reportFile)
+        else:
+            writeCsvReport(rows, reportFile, reportFormat)
 
-    # Output the report
-    logger.info('Writing report')
-    shutil.copyfileobj(reportOutput, reportFile)
+    # Report the metrics
+    metrics.log()
+    if parameters.get('metricsFileName'):
+        logger.info('Writing metrics to: %s', parameters['metricsFileName'])
+        metrics.write(parameters['metricsFileName'])
 
     # Done
     logger.info('Done.')
 
+def rescoreMain(args):
+    '''Command line API of the rescore command, which recomputes scores
+    from the counts in an existing report.
+
+    args: A sequence of strings, the command line arguments after
+    'rescore'.
+    '''
+    environment = _rescoreArgParser.parse_args(args)
+    setUpLogging()
+    logger = logging.getLogger(__name__)
+    logger.info('Rescore invoked with arguments: %s', args)
+    # Read the counts
+    if environment.table is not None:
+        if environment.sqlite_db is None:
+            raise ValueError('Reading a results table requires --sqlite-db.')
+        counts = readResultsTableCounts(environment.sqlite_db, environment.table)
+    elif environment.report is not None:
+        counts = readReportCounts(environment.report)
+    else:
+        raise ValueError('Give a report file or a results table to rescore.')
+    # Score
+    pseudocounts = environment.pseudocount or [1.0]
+    scoreNames = environment.score or ['temporal_score']
+    logger.info('Computing scores %s with pseudocounts %s',
+                scoreNames, pseudocounts)
+    names, scores = rescoreCounts(counts, pseudocounts, scoreNames)
+    # Write the report
+    logger.info('Writing report')
+    writeRescoredReport(environment.output or sys.stdout, counts, names,
+                        scores, environment.header)
+    logger.info('Done.')
+
+def serveMain(args):
+    '''Command line API of the serve command, which runs a scoring
+    service until interrupted.
+
+    args: A sequence of strings, the command line arguments after
+    'serve'.
+    '''
+    environment = _serveArgParser.parse_args(args)
+    setUpLogging()
+    logger = logging.getLogger(__name__)
+    logger.info('Serve invoked with arguments: %s', args)
+    parameters = collections.OrderedDict(defaultParameters)
+    if environment.parameters:
+        parameters.update(parseConfig(environment.parameters.name))
+    if environment.engine is not None:
+        parameters['engine'] = environment.engine
+    if environment.drug_eras is not None:
+        parameters['drugEraFileName'] = environment.drug_eras
+    if environment.cond_eras is not None:
+        parameters['condEraFileName'] = environment.cond_eras
+    if environment.store is not None:
+        parameters['firstOccurrenceStore'] = environment.store
+    if environment.sqlite_db is not None:
+        parameters['sqliteDbFileName'] = environment.sqlite_db
+    if parameters['engine'] == 'oracle':
+        _serveArgParser.error(
+            'the oracle engine is not supported; use --engine')
+    service = ScoringService(parameters)
+    server = makeScoringServer(service, environment.host, environment.port)
+    logger.info('Serving scores on http://%s:%s/scores',
+                environment.host, server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info('Stopping')
+    finally:
+        server.server_close()
+        service.close()
+    logger.info('Done.')
+
+def setUpLogging():
+    logging.basicConfig(
+        format='%(asctime)s %(name)s.%(funcName)s %(levelname)s %(message)s',
+        datefmt='%Y-%m-%dT%H:%M:%S',
+        level=logging.INFO,
+        stream=sys.stderr,
+        )
+
 def mainProgram():
     '''Calls 'main(sys.argv[1:])', handles its exceptions, and exits.
     Not intended for API use.
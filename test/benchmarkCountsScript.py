@@ -0,0 +1,250 @@
+# Copyright (c) 2014 Aubrey Barnard.  This is free software.  See
+# LICENSE.txt for details.
+#
+# Benchmark that compares the set-based counts step of the temporal
+# score SQL script with the previous correlated-subquery counts step on
+# generated data in Oracle.
+#
+# Usage: python benchmarkCountsScript.py <username> [<num-people> [<num-drugs> [<num-conds>]]]
+
+from __future__ import print_function
+
+import datetime
+import getpass
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append('..')
+import temporalScore
+import testTemporalScore as tts
+
+
+# The counts step of the SQL script before it was made set-based.  It
+# inserts all the pairs with zero counts and then runs ten correlated
+# subqueries per pair.
+correlatedCountsSql = '''-- Insert all drug-condition pairs into the temporal scores
+insert into ${countsScoresTableName}
+    (drug, cond,
+     ct_d_bef_c, ct_c_bef_d, ct_d_c,
+     ct_d_bef_anyc, ct_d_anyc, ct_anyd_bef_c, ct_anyd_c,
+     ct_d, ct_c, ct_ppl,
+     temporal_score)
+select drugs.id as drug, conds.id as cond, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0.0
+from drug_ids drugs,
+     cond_ids conds;
+
+-- Populate all the counts of people
+update ${countsScoresTableName} cst
+set
+  -- Drug before condition
+  ct_d_bef_c =
+    (select count(distinct person)
+     from first_drugs_conds fdc
+     where drug_date < cond_date
+       and cst.drug = fdc.drug
+       and cst.cond = fdc.cond),
+  -- Condition before drug
+  ct_c_bef_d =
+    (select count(distinct person)
+     from first_drugs_conds fdc
+     where drug_date >= cond_date
+       and cst.drug = fdc.drug
+       and cst.cond = fdc.cond),
+  -- Drug and condition
+  ct_d_c =
+    (select count(distinct person)
+     from first_drugs_conds fdc
+     where cst.drug = fdc.drug
+       and cst.cond = fdc.cond),
+  -- Drug before any condition
+  ct_d_bef_anyc =
+    (select count(distinct person)
+     from first_drugs_conds fdc
+     where drug_date < cond_date
+       and cst.drug = fdc.drug),
+  -- Drug and any condition
+  ct_d_anyc =
+    (select count(distinct person)
+     from first_drugs_conds fdc
+     where cst.drug = fdc.drug),
+  -- Any drug before condition
+  ct_anyd_bef_c =
+    (select count(distinct person)
+     from first_drugs_conds fdc
+     where drug_date < cond_date
+       and cst.cond = fdc.cond),
+  -- Any drug and condition
+  ct_anyd_c =
+    (select count(distinct person)
+     from first_drugs_conds fdc
+     where cst.cond = fdc.cond),
+  -- Drugs
+  ct_d =
+    (select count(distinct person)
+     from first_drugs fd
+     where cst.drug = fd.drug),
+  -- Conditions
+  ct_c =
+    (select count(distinct person)
+     from first_conds fc
+     where cst.cond = fc.cond),
+  -- Patients
+  ct_ppl =
+    (select count(distinct person)
+     from (select person from first_drugs
+           union
+           select person from first_conds));
+
+'''
+
+def correlatedSqlScriptTemplate():
+    # Put the old counts step in place of the current one
+    return (temporalScore.oracleSetupScriptTemplate
+            + '\n' + correlatedCountsSql
+            + temporalScore.oracleScoresScriptTemplate
+            + temporalScore.oracleCommitScript
+            + temporalScore.oracleReportScriptTemplate
+            + temporalScore.oracleCleanupScriptTemplate)
+
+_createTablesSql = '''
+set feedback off;
+create table bench_cond_era (
+    condition_era_id numeric(15) not null,
+    person_id numeric(12) not null,
+    condition_concept_id numeric(10) not null,
+    condition_era_start_date date,
+    condition_era_end_date date,
+    constraint bench_cond_era_pk primary key (condition_era_id)
+);
+create table bench_drug_era (
+    drug_era_id numeric(15) not null,
+    person_id numeric(12) not null,
+    drug_concept_id numeric(10) not null,
+    drug_era_start_date date,
+    drug_era_end_date date,
+    constraint bench_drug_era_pk primary key (drug_era_id)
+);
+exit;
+'''
+
+_dropTablesSql = '''
+set feedback off;
+drop table bench_cond_era;
+drop table bench_drug_era;
+drop table bench_counts_scores;
+exit;
+'''
+
+_controlFileTemplate = '''load data
+infile *
+into table bench_{table}_era
+fields terminated by ','
+({era}_era_id, person_id, {era}_concept_id, {era}_era_start_date date 'yyyy-mm-dd', {era}_era_end_date date 'yyyy-mm-dd')
+begindata
+'''
+
+def generateTimelines(numPeople, drugIds, condIds):
+    # Sample timelines from the test data model with random causes
+    initialDistribution = drugIds + condIds
+    causesToEffects = dict(
+        (random.choice(condIds), drugId) for drugId in drugIds)
+    causesToEffects.update(
+        (drugId, random.choice(condIds)) for drugId in drugIds)
+    for personIndex in xrange(numPeople):
+        events = tts.sampleEvents(initialDistribution, causesToEffects)
+        yield tts.sampleDatesForEvents(events)
+
+def loadEras(dbConn, dbPass, eventRecords, ids, table, era, directory):
+    # Write the records as a SQL*Loader control file with inline data
+    # and load them
+    fileName = os.path.join(directory, 'bench_{}_era.dat'.format(table))
+    records = tts.daysToDatesInEventRecordsWRecIds(
+        tts.filterSortEventRecords(eventRecords, ids),
+        datetime.date(2002, 2, 20))
+    with open(fileName, 'w') as dataFile:
+        dataFile.write(_controlFileTemplate.format(table=table, era=era))
+        for record in records:
+            dataFile.write(','.join(str(field) for field in record))
+            dataFile.write('\n')
+    command = ['sqlldr', dbConn, 'control=' + fileName,
+               'log=' + fileName + '.log', 'silent=(header,feedback)',
+               'errors=0', 'direct=true']
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    process.communicate(input=dbPass)
+    if process.returncode != 0:
+        raise temporalScore.OracleError(exitCode=process.returncode)
+
+def timeScript(name, drugIds, condIds, parameters):
+    start = time.time()
+    reportOutput, scriptOutput = temporalScore.temporalScore(
+        drugIds, condIds, parameters)
+    elapsed = time.time() - start
+    table = tts.readTemporalScoreOutputAsTable(
+        reportOutput, tts.convertTsResultRow)
+    print('{}: {:.2f} s for {} pairs'.format(name, elapsed, len(table)))
+    return table
+
+def main(args):
+    dbUser = args[0]
+    numPeople = int(args[1]) if len(args) > 1 else 10000
+    numDrugs = int(args[2]) if len(args) > 2 else 100
+    numConds = int(args[3]) if len(args) > 3 else 200
+    dbPass = getpass.getpass('Oracle password: ')
+    parameters = dict(temporalScore.defaultParameters)
+    parameters.update((
+            ('dbUser', dbUser),
+            ('dbPass', dbPass),
+            ('dbSchemaName', dbUser),
+            ('drugEraTableName', 'bench_drug_era'),
+            ('condEraTableName', 'bench_cond_era'),
+            ('countsScoresTableName', 'bench_counts_scores'),
+            ))
+    dbConn = dbUser + '@' + parameters['dbConnectionName']
+    drugIds = tuple(xrange(1000001, 1000001 + numDrugs))
+    condIds = tuple(xrange(2000001, 2000001 + numConds))
+
+    # Generate and load the data
+    print('Generating {} people, {} drugs, {} conditions'.format(
+            numPeople, numDrugs, numConds))
+    eventRecords = tuple(tts.timelinesToEventRecords(
+            generateTimelines(numPeople, drugIds, condIds)))
+    directory = tempfile.mkdtemp(prefix='benchmarkCountsScript.')
+    temporalScore.runOracleSqlScript(
+        parameters['dbConnectionName'], dbUser, dbPass, _createTablesSql)
+    try:
+        loadEras(dbConn, dbPass, eventRecords, condIds, 'cond', 'condition', directory)
+        loadEras(dbConn, dbPass, eventRecords, drugIds, 'drug', 'drug', directory)
+
+        # Run the current script and then the correlated script
+        setBasedTable = timeScript(
+            'Set-based counts', drugIds, condIds, parameters)
+        currentTemplate = temporalScore.sqlScriptTemplate
+        temporalScore.sqlScriptTemplate = correlatedSqlScriptTemplate()
+        try:
+            correlatedTable = timeScript(
+                'Correlated counts', drugIds, condIds, parameters)
+        finally:
+            temporalScore.sqlScriptTemplate = currentTemplate
+        print('Reports identical:', setBasedTable == correlatedTable)
+    finally:
+        temporalScore.runOracleSqlScript(
+            parameters['dbConnectionName'], dbUser, dbPass, _dropTablesSql)
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='%(asctime)s %(name)s.%(funcName)s %(levelname)s %(message)s',
+        datefmt='%Y-%m-%dT%H:%M:%S',
+        level=logging.WARNING,
+        stream=sys.stderr,
+        )
+    if len(sys.argv) < 2:
+        print('Usage: python benchmarkCountsScript.py <username> [<num-people> [<num-drugs> [<num-conds>]]]', file=sys.stderr)
+        sys.exit(2)
+    main(sys.argv[1:])
@@ -0,0 +1,209 @@
+# Copyright (c) 2014 Aubrey Barnard.  This is free software.  See
+# LICENSE.txt for details.
+#
+# Benchmark that times the local counting engines in several modes on
+# synthetic data of several sizes and reports their throughput and peak
+# memory.  The synthetic data has planted drug-condition causes (see
+# makeSyntheticModel in testTemporalScore.py).
+#
+# Usage: python benchmarkEngines.py [--persons N]... [--drugs N] [--conds N] [--case ENGINE[:NAME=VALUE,...]]... [--data-dir DIR] [--json FILE]
+#
+# For example, '--case numpy:processes=8,sparse=yes' runs the numpy
+# engine with 8 processes in sparse mode.  Each case runs in its own
+# process so that its peak memory is its own.
+
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+sys.path.append('..')
+import temporalScore
+import testTemporalScore as tts
+
+
+def defaultCases():
+    return [
+        'numpy',
+        'numpy:sparse=yes',
+        'numpy:processes={}'.format(max(2, multiprocessing.cpu_count())),
+        'bitmap',
+        'sqlite',
+        'sqlite:sparse=yes',
+        ]
+
+def parseCase(case):
+    # Parse 'engine:name=value,...' into the engine and its parameters
+    engine, _, settings = case.partition(':')
+    parameters = {'engine': engine}
+    for setting in settings.split(','):
+        if setting:
+            name, _, value = setting.partition('=')
+            parameters[name.strip()] = value.strip()
+    return parameters
+
+def generateData(directory, model, numPersons):
+    # Write the extracts unless they are already there (from a previous
+    # run with the same data directory)
+    fileNames = [os.path.join(directory, eraType + '_era.csv')
+                 for eraType in ('drug', 'condition')]
+    if all(os.path.exists(fileName) for fileName in fileNames):
+        print('Reusing data for {} people in {}'.format(numPersons, directory))
+        return fileNames
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    start = time.time()
+    fileNames = tts.writeSyntheticEraCsvs(directory, model, numPersons)
+    print('Generated {} people in {:.2f} s'.format(
+            numPersons, time.time() - start))
+    return fileNames
+
+def peakMemoryMb(who):
+    # Peak resident memory of this process or of its largest child
+    maxRss = resource.getrusage(who).ru_maxrss
+    # Linux reports KB, Mac OS X reports bytes
+    if sys.platform == 'darwin':
+        maxRss /= 1024.0
+    return maxRss / 1024.0
+
+def runCase(parameters, drugIds, condIds, results):
+    # Run in a child process and put the result (or the error) in the
+    # queue
+    metrics = temporalScore.Metrics()
+    start = time.time()
+    numRows = 0
+    try:
+        for row in temporalScore.iterTemporalScores(
+                drugIds, condIds, parameters, metrics):
+            numRows += 1
+    except Exception as e:
+        results.put(dict(error=str(e)))
+        raise
+    results.put(dict(
+            seconds=time.time() - start,
+            rows=numRows,
+            peakMb=peakMemoryMb(resource.RUSAGE_SELF),
+            peakChildMb=peakMemoryMb(resource.RUSAGE_CHILDREN),
+            phases=metrics.phases,
+            ))
+
+def timeCase(case, numPersons, fileNames, model, directory):
+    parameters = dict(temporalScore.defaultParameters)
+    parameters.update((
+            ('drugEraFileName', fileNames[0]),
+            ('condEraFileName', fileNames[1]),
+            ('sqliteDbFileName', os.path.join(directory, 'bench.db')),
+            ))
+    parameters.update(parseCase(case))
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=runCase,
+        args=(parameters, model.drugIds, model.condIds, results))
+    process.start()
+    # Wait for the result unless the child dies without putting one (for
+    # example, when it is killed for running out of memory).  Whatever a
+    # dead child put is readable by the next get.
+    result = None
+    while result is None:
+        alive = process.is_alive()
+        try:
+            result = results.get(timeout=1)
+        except queue.Empty:
+            if not alive:
+                result = dict(error='process exited with code {}'.format(
+                        process.exitcode))
+    process.join()
+    if 'error' in result:
+        raise RuntimeError('Case {} failed: {}'.format(case, result['error']))
+    # Start over with the SQLite DB each time
+    if os.path.exists(parameters['sqliteDbFileName']):
+        os.remove(parameters['sqliteDbFileName'])
+    result.update(
+        case=case,
+        persons=numPersons,
+        personsPerSecond=numPersons / result['seconds'],
+        pairsPerSecond=result['rows'] / result['seconds'],
+        )
+    print('{persons:>10} {case:<30} {seconds:>9.2f} {rows:>9} '
+          '{personsPerSecond:>12.0f} {pairsPerSecond:>12.0f} '
+          '{peakMb:>8.1f} {peakChildMb:>8.1f}'.format(**result))
+    return result
+
+def main(args):
+    argParser = argparse.ArgumentParser(
+        description='Benchmarks the local engines on synthetic data.')
+    argParser.add_argument('--persons', type=int, action='append',
+                           help='Number of people.  Repeat for several sizes.  Default is 10000 and 100000.')
+    argParser.add_argument('--drugs', type=int, default=100)
+    argParser.add_argument('--conds', type=int, default=1000)
+    argParser.add_argument('--planted', type=int, default=10,
+                           help='Number of planted drug-condition causes.')
+    argParser.add_argument('--effect-prob', type=float, default=0.3,
+                           help='Probability that a planted cause has its effect.')
+    argParser.add_argument('--seed', type=int, default=0)
+    argParser.add_argument('--case', action='append',
+                           help='Engine and parameters to run (ENGINE[:NAME=VALUE,...]).  Repeat for several cases.')
+    argParser.add_argument('--data-dir',
+                           help='Directory to keep (and reuse) the generated data in.  Default is a temporary directory.')
+    argParser.add_argument('--json',
+                           help='Output file containing the results (with the phases of each case) in JSON format.')
+    environment = argParser.parse_args(args)
+    sizes = environment.persons or [10000, 100000]
+    cases = environment.case or defaultCases()
+
+    # Make the model
+    random.seed(environment.seed)
+    model = tts.makeSyntheticModel(
+        environment.drugs, environment.conds, environment.planted,
+        environment.effect_prob)
+    print('Model: {} drugs, {} conditions, planted pairs: {}'.format(
+            len(model.drugIds), len(model.condIds), tts.plantedPairs(model)))
+    directory = environment.data_dir or tempfile.mkdtemp(
+        prefix='benchmarkEngines.')
+    results = []
+    try:
+        for numPersons in sizes:
+            random.seed(environment.seed + numPersons)
+            sizeDirectory = os.path.join(
+                directory, 'persons_{}'.format(numPersons))
+            fileNames = generateData(sizeDirectory, model, numPersons)
+            print('{:>10} {:<30} {:>9} {:>9} {:>12} {:>12} {:>8} {:>8}'.format(
+                    'persons', 'case', 'seconds', 'pairs', 'persons/s',
+                    'pairs/s', 'peak MB', 'child MB'))
+            for case in cases:
+                results.append(timeCase(
+                        case, numPersons, fileNames, model, sizeDirectory))
+    finally:
+        if not environment.data_dir:
+            shutil.rmtree(directory)
+    if environment.json:
+        with open(environment.json, 'w') as jsonFile:
+            json.dump(dict(
+                    drugs=environment.drugs,
+                    conds=environment.conds,
+                    planted=tts.plantedPairs(model),
+                    results=results,
+                    ), jsonFile, indent=2)
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='%(asctime)s %(name)s.%(funcName)s %(levelname)s %(message)s',
+        datefmt='%Y-%m-%dT%H:%M:%S',
+        level=logging.WARNING,
+        stream=sys.stderr,
+        )
+    main(sys.argv[1:])
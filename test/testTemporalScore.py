@@ -5,15 +5,30 @@
 
 from __future__ import print_function
 
+import bisect
+import collections
 import csv
 import datetime
 import getpass
 import itertools as itools
+import json
 import logging
+import multiprocessing
+import os
 import random
+import shutil
+import sqlite3
 import sys
+import tempfile
+import threading
+import time
 import unittest
 
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
 sys.path.append('..')
 import temporalScore
 
@@ -88,6 +103,125 @@ def daysToDatesInEventRecordsWRecIds(eventRecords, referenceDate):
         endDateString = endDate.strftime('%Y-%m-%d')
         yield (recId, personId, eventId, startDateString, endDateString)
 
+def writeEraCsv(fileName, eventRecords, eraType):
+    # Write records as a CSV extract of a CDM era table
+    with open(fileName, 'w') as csvFile:
+        writer = csv.writer(csvFile, lineterminator='\n')
+        writer.writerow((
+                eraType + '_era_id', 'person_id', eraType + '_concept_id',
+                eraType + '_era_start_date', eraType + '_era_end_date'))
+        writer.writerows(eventRecords)
+
+def writeTestEraCsvs(directory, timelines=None, referenceDate=None):
+    # Write the test data as CSV extracts and return their file names
+    if timelines is None:
+        timelines = globals()['timelines']
+    if referenceDate is None:
+        referenceDate = datetime.date(2002, 2, 20)
+    eventRecords = tuple(timelinesToEventRecords(timelines))
+    fileNames = []
+    for ids, eraType in ((drugIds, 'drug'), (condIds, 'condition')):
+        records = daysToDatesInEventRecordsWRecIds(
+            filterSortEventRecords(eventRecords, ids), referenceDate)
+        fileName = os.path.join(directory, eraType + '_era.csv')
+        writeEraCsv(fileName, records, eraType)
+        fileNames.append(fileName)
+    return fileNames
+
+def sortCsvByPerson(fileName):
+    # Sort the rows of a CSV extract by person (stably)
+    with open(fileName, 'r') as csvFile:
+        rows = list(csv.reader(csvFile))
+    personIndex = rows[0].index('person_id')
+    rows[1:] = sorted(rows[1:], key=lambda row: int(row[personIndex]))
+    with open(fileName, 'w') as csvFile:
+        csv.writer(csvFile).writerows(rows)
+
+# Synthetic data for benchmarks.  The model is like the one of the test
+# data but with many concepts of Zipf-like popularity, so the effects of
+# the planted causes are sampled right after them with some probability
+# instead of being added to the distribution (where one more copy among
+# thousands of concepts would make no difference).
+
+SyntheticModel = collections.namedtuple('SyntheticModel', (
+        'drugIds', 'condIds', 'concepts', 'cumulativeWeights',
+        'causesToEffects', 'effectProb'))
+
+def makeSyntheticModel(numDrugs, numConds, numPlanted, effectProb=0.3,
+                       firstDrugId=1000001, firstCondId=2000001):
+    # Each planted pair is a drug that causes a condition.  Half as many
+    # conditions are indications that cause drugs (confounders).
+    drugIds = tuple(range(firstDrugId, firstDrugId + numDrugs))
+    condIds = tuple(range(firstCondId, firstCondId + numConds))
+    concepts = list(drugIds + condIds)
+    random.shuffle(concepts)
+    cumulativeWeights = []
+    total = 0.0
+    for rank in range(1, len(concepts) + 1):
+        total += 1.0 / rank
+        cumulativeWeights.append(total)
+    causes = random.sample(drugIds, min(numPlanted, numDrugs))
+    causesToEffects = dict(
+        (drugId, random.choice(condIds)) for drugId in causes)
+    causesToEffects.update(
+        (random.choice(condIds), drugId)
+        for drugId in causes[:len(causes) // 2])
+    return SyntheticModel(drugIds, condIds, tuple(concepts),
+                          cumulativeWeights, causesToEffects, effectProb)
+
+def plantedPairs(model):
+    # Returns the planted (drug, condition) pairs of the model
+    drugIdSet = set(model.drugIds)
+    return sorted((cause, effect) for cause, effect
+                  in model.causesToEffects.items() if cause in drugIdSet)
+
+def sampleSyntheticEvents(model):
+    events = []
+    total = model.cumulativeWeights[-1]
+    numberEvents = int(round(random.gammavariate(3.0, 1.5)))
+    for i in range(numberEvents):
+        event = model.concepts[bisect.bisect_right(
+                model.cumulativeWeights, random.random() * total)]
+        events.append(event)
+        effect = model.causesToEffects.get(event)
+        if effect is not None and random.random() < model.effectProb:
+            events.append(effect)
+    return events
+
+def writeSyntheticEraCsvs(directory, model, numPersons, referenceDate=None):
+    '''Samples the timelines of the given number of people from the
+    synthetic model and writes them as CSV extracts of the drug and
+    condition era tables (one person at a time, so any number of people
+    fit in memory).  Returns the file names.
+    '''
+    if referenceDate is None:
+        referenceDate = datetime.date(2002, 2, 20)
+    drugIdSet = set(model.drugIds)
+    fileNames = [os.path.join(directory, eraType + '_era.csv')
+                 for eraType in ('drug', 'condition')]
+    with open(fileNames[0], 'w') as drugFile, \
+            open(fileNames[1], 'w') as condFile:
+        writers = []
+        for csvFile, eraType in ((drugFile, 'drug'), (condFile, 'condition')):
+            writer = csv.writer(csvFile, lineterminator='\n')
+            writer.writerow((
+                    eraType + '_era_id', 'person_id', eraType + '_concept_id',
+                    eraType + '_era_start_date', eraType + '_era_end_date'))
+            writers.append(writer)
+        recordId = 0
+        for personId in range(1, numPersons + 1):
+            timeline = sampleDatesForEvents(sampleSyntheticEvents(model))
+            for event, startDays, endDays in timeline:
+                recordId += 1
+                writer = writers[0] if event in drugIdSet else writers[1]
+                writer.writerow((
+                        recordId, personId, event,
+                        (referenceDate + datetime.timedelta(days=startDays)
+                         ).strftime('%Y-%m-%d'),
+                        (referenceDate + datetime.timedelta(days=endDays)
+                         ).strftime('%Y-%m-%d')))
+    return fileNames
+
 def printItemPerLine(iterable, start='[', end=']', delim=','):
     print(start)
     for item in iterable:
@@ -199,13 +333,8 @@ def convertTsResultRow(row):
     # Columns 1-12 are ints, column 13 is a float
     return tuple(int(i) for i in row[:12]) + (round(float(row[12]), 2),)
 
-class TemporalScoreTest(unittest.TestCase):
-
-    def setUp(self):
-        # Get missing parameters
-        fillInParameters(_defaultParameters)
-        # Make a local copy of parameters for this test
-        self.parameters = dict(_defaultParameters)
+# Tests common to all engines.  Subclasses set up 'self.parameters'.
+class TemporalScoreTests(object):
 
     def test_temporalScore(self):
         # Calculate and output the temporal scores
@@ -281,6 +410,1174 @@ class TemporalScoreTest(unittest.TestCase):
         self.assertEqual(tuple(expectedTable), actualTable)
 
 
+class TemporalScoreTest(TemporalScoreTests, unittest.TestCase):
+
+    def setUp(self):
+        # Get missing parameters
+        fillInParameters(_defaultParameters)
+        # Make a local copy of parameters for this test
+        self.parameters = dict(_defaultParameters)
+
+
+# Tests of building the Oracle script that do not need Oracle
+class OracleScriptTest(unittest.TestCase):
+
+    def test_oracleIdsInserts(self):
+        expected = (
+            'insert into drug_ids (id)\n'
+            'select column_value from table(number15_table(5, 7));\n'
+            'insert into drug_ids (id)\n'
+            'select column_value from table(number15_table(3));')
+        actual = temporalScore.oracleIdsInserts(
+            'drug_ids', (5, 7, 5, 3), chunkSize=2)
+        self.assertEqual(expected, actual)
+
+    def test_buildScript_incremental(self):
+        parameters = dict(temporalScore.defaultParameters)
+        parameters.update((('dbSchemaName', 'schema'), ('incremental', 'yes')))
+        backend = temporalScore.makeBackend(parameters)
+        script = backend.buildScript(
+            (5,), (7,), temporalScore.oracleSpoolReportTemplate)
+        self.assertIn('select column_value from table(number15_table(5))', script)
+        self.assertIn('insert into new_drug_ids (id)', script)
+        self.assertIn('insert into counts_scores_fdc', script)
+        self.assertIn('insert into counts_scores_state', script)
+        self.assertNotIn('${', script)
+
+    def test_buildSweepScript(self):
+        parameters = dict(temporalScore.defaultParameters)
+        parameters.update((
+                ('dbSchemaName', 'schema'),
+                ('conditionWindowEnd', '30, 60'),
+                ('drugOccurrenceOffset', '0, -7'),
+                ('drugMarginalsFileName', 'drugs.csv'),
+                ))
+        configs = temporalScore.sweepConfigurations(parameters)
+        backend = temporalScore.makeBackend(parameters)
+        script = backend.buildSweepScript((5,), (7,), configs)
+        self.assertIn('fc.cond_date <= (fd.drug_date + 60)', script)
+        self.assertIn('(drug_date + -7) as drug_date', script)
+        self.assertIn("select 'row' as marker, 4 as config, cs.*", script)
+        self.assertIn(' append\nselect 4 as config', script)
+        self.assertEqual(1, script.count('commit;'))
+        self.assertNotIn('${', script)
+
+    def test_buildScript_minCtDC(self):
+        parameters = dict(temporalScore.defaultParameters)
+        parameters.update((('dbSchemaName', 'schema'), ('minCtDC', '2')))
+        backend = temporalScore.makeBackend(parameters)
+        script = backend.buildScript(
+            (5,), (7,), temporalScore.oracleSpoolReportTemplate)
+        self.assertIn('where ct_d_anyc >= 2', script)
+        self.assertIn('where ct_anyd_c >= 2', script)
+        self.assertIn('group by drug, cond\n     having count(*) >= 2)', script)
+        self.assertIn('\njoin\n    (select drug, cond,', script)
+        self.assertNotIn('${', script)
+
+    def test_buildScript_normalized(self):
+        parameters = dict(temporalScore.defaultParameters)
+        parameters.update((('dbSchemaName', 'schema'), ('normalized', 'yes')))
+        backend = temporalScore.makeBackend(parameters)
+        script = backend.buildScript(
+            (5,), (7,), temporalScore.oracleStreamReportTemplate)
+        self.assertIn('create table counts_scores (\n'
+                      '    drug number(15) not null, -- Drug ID\n'
+                      '    cond number(15) not null, -- Condition ID\n'
+                      '    ct_d_bef_c', script)
+        self.assertIn('    (drug, cond, ct_d_bef_c, ct_c_bef_d, ct_d_c, '
+                      'temporal_score)', script)
+        self.assertNotIn('update counts_scores', script)
+        self.assertIn(' join counts_scores_drugs dm on dm.drug = p.drug', script)
+        self.assertNotIn('${', script)
+
+    def test_buildStratifiedScript(self):
+        parameters = dict(temporalScore.defaultParameters)
+        parameters.update((('dbSchemaName', 'schema'), ('stratifyBy', 'age'),
+                           ('stratumWidth', 5), ('minCtDC', 2)))
+        backend = temporalScore.makeBackend(parameters)
+        script = backend.buildStratifiedScript((5,), (7,))
+        self.assertIn('floor((extract(year from e.drug_era_start_date)'
+                      ' - cast(p.year_of_birth as integer)) / 5) * 5', script)
+        self.assertIn('join person p on p.person_id = e.person_id', script)
+        self.assertIn('stratum number(9) not null', script)
+        self.assertIn('group by stratum, drug, cond\n'
+                      '     having count(*) >= 2)', script)
+        self.assertIn('order by stratum, drug, cond;', script)
+        self.assertNotIn('${', script)
+        # Sharded and checkpointed runs are not stratified
+        for name, value in (('shards', 2), ('runId', 'run1')):
+            self.assertRaises(
+                ValueError, temporalScore.iterStratifiedScores,
+                (5,), (7,), parameters=dict(parameters, **{name: value}))
+
+    def test_buildScript_firstOccurrenceCache(self):
+        parameters = dict(temporalScore.defaultParameters)
+        parameters.update((
+                ('dbSchemaName', 'schema'), ('firstOccurrenceCache', 'yes')))
+        backend = temporalScore.makeBackend(parameters)
+        script = backend.buildScript(
+            (5,), (7,), temporalScore.oracleSpoolReportTemplate)
+        self.assertIn('create table first_occ_cache_data', script)
+        self.assertIn('select first_occ_cache_seq.nextval', script)
+        self.assertIn('variable drug_cache_id number', script)
+        self.assertIn('where cache_id = :cond_cache_id', script)
+        self.assertIn("ids_hash = '{}'".format(
+                temporalScore.idsHash((5,))), script)
+        self.assertNotIn('${', script)
+
+    def test_scoringService_unsupported(self):
+        parameters = dict(temporalScore.defaultParameters)
+        parameters['dbSchemaName'] = 'schema'
+        self.assertRaises(ValueError, temporalScore.ScoringService, parameters)
+
+    def test_buildShardsScripts(self):
+        parameters = dict(temporalScore.defaultParameters)
+        parameters.update((('dbSchemaName', 'schema'), ('shards', 2)))
+        backend = temporalScore.makeBackend(parameters)
+        setupScript, shardScripts, mergeScript, cleanupScript = (
+            backend.buildShardsScripts(
+                (5, 6, 7, 5), (9,), temporalScore.oracleSpoolReportTemplate))
+        self.assertEqual(len(shardScripts), 2)
+        self.assertIn('create table counts_scores_cond_persons', setupScript)
+        self.assertIn('create table counts_scores_s1 (', shardScripts[0])
+        self.assertIn('number15_table(5,7)', shardScripts[0].replace(' ', ''))
+        self.assertIn('number15_table(6)', shardScripts[1].replace(' ', ''))
+        self.assertIn('select * from counts_scores_s2', mergeScript)
+        self.assertIn('from counts_scores_cond_persons', mergeScript)
+        self.assertIn("'drop table counts_scores_s2_conds'", cleanupScript)
+        for script in [setupScript, mergeScript, cleanupScript] + shardScripts:
+            self.assertNotIn('${', script)
+
+    def test_buildCheckpointedScripts(self):
+        parameters = dict(temporalScore.defaultParameters)
+        parameters.update((('dbSchemaName', 'schema'), ('runId', 'run1')))
+        backend = temporalScore.makeBackend(parameters)
+        phaseScripts, reportScript = backend.buildCheckpointedScripts(
+            (5,), (7,), temporalScore.oracleSpoolReportTemplate)
+        self.assertEqual(
+            ['setup', 'first_drugs', 'first_conds', 'first_drugs_conds',
+             'marginals', 'pair_counts', 'scores'],
+            [name for name, script in phaseScripts])
+        scripts = dict(phaseScripts)
+        self.assertIn('create table counts_scores_ck_fdc (', scripts['setup'])
+        self.assertIn('insert into counts_scores_ck_drug_ids (id)',
+                      scripts['setup'])
+        self.assertIn('truncate table counts_scores_ck_fdc;',
+                      scripts['first_drugs_conds'])
+        self.assertIn('from counts_scores_ck_fd fd,',
+                      scripts['first_drugs_conds'])
+        self.assertIn('from counts_scores_ck_drug_ids drugs',
+                      scripts['marginals'])
+        for name, script in phaseScripts:
+            self.assertIn('commit;', script)
+            self.assertNotIn('global temporary', script)
+        self.assertIn("'drop table counts_scores_ck_fdc'", reportScript)
+        self.assertIn('spool ', reportScript)
+        for script in list(scripts.values()) + [reportScript]:
+            self.assertNotIn('${', script)
+
+    def test_runCheckpointedPhases(self):
+        # A run whose pair counts fail is resumed from the pair counts
+        directory = tempfile.mkdtemp(prefix='testTemporalScore.')
+        parameters = dict(temporalScore.defaultParameters)
+        parameters.update((
+                ('dbSchemaName', 'schema'), ('runId', 'run1'),
+                ('checkpointDirectory', directory), ('phaseRetries', 1),
+                ('phaseRetryDelay', 0)))
+        runPhases = []
+        def runOracleSqlScript(dbName, dbUser, dbPass, script):
+            name = script.split('metric,')[2].split(',')[0]
+            runPhases.append(name)
+            if name in failingPhases:
+                raise temporalScore.OracleError(exitCode=1)
+            return tempfile.TemporaryFile(mode='w+')
+        runScript = temporalScore.runOracleSqlScript
+        temporalScore.runOracleSqlScript = runOracleSqlScript
+        try:
+            failingPhases = ('pair_counts',)
+            backend = temporalScore.makeBackend(parameters)
+            self.assertRaises(
+                temporalScore.OracleError, backend.runCheckpointedPhases,
+                (5,), (7,), temporalScore.oracleSpoolReportTemplate)
+            self.assertEqual(
+                ['create_tables', 'first_drugs', 'first_conds',
+                 'first_drugs_conds', 'drug_marginals', 'pair_counts',
+                 'pair_counts'], runPhases)
+            # Resuming with other IDs fails
+            parameters['resume'] = True
+            backend = temporalScore.makeBackend(parameters)
+            self.assertRaises(
+                ValueError, backend.runCheckpointedPhases,
+                (5, 6), (7,), temporalScore.oracleSpoolReportTemplate)
+            # Resuming runs the rest
+            failingPhases = ()
+            del runPhases[:]
+            backend = temporalScore.makeBackend(parameters)
+            reportScript = backend.runCheckpointedPhases(
+                (5,), (7,), temporalScore.oracleSpoolReportTemplate)
+            self.assertEqual(['pair_counts', 'scores'], runPhases)
+            self.assertIn('metric,report,', reportScript)
+            backend.finishCheckpointedRun()
+            manifest = temporalScore.readRunManifest(
+                os.path.join(directory, 'run1.json'))
+            self.assertEqual(
+                ['setup', 'first_drugs', 'first_conds', 'first_drugs_conds',
+                 'marginals', 'pair_counts', 'scores'],
+                list(manifest['phases']))
+            self.assertIsNotNone(manifest['finished'])
+        finally:
+            temporalScore.runOracleSqlScript = runScript
+            shutil.rmtree(directory)
+
+    def test_OracleMetricsReader(self):
+        metrics = temporalScore.Metrics()
+        reader = temporalScore.OracleMetricsReader(metrics, 'shard1.')
+        for line in (
+                'metric,first_drugs,2014-03-01 10:00:00.000000',
+                '',
+                'PL/SQL procedure successfully completed.',
+                '1200 rows created.',
+                'metric,first_conds,2014-03-01 10:00:02.500000',
+                'no rows created.',
+                'metric,report,2014-03-01 10:00:03.000000',
+                'metric,end,2014-03-01 10:01:03.000000',
+                ):
+            reader.feed(line)
+        self.assertEqual(
+            [('shard1.first_drugs', 2.5, 1200),
+             ('shard1.first_conds', 0.5, 0),
+             ('shard1.report', 60.0, None)],
+            [(phase['name'], phase['seconds'], phase['rows'])
+             for phase in metrics.phases])
+
+    def test_idsHash(self):
+        self.assertEqual(temporalScore.idsHash((3, 1, 2)),
+                         temporalScore.idsHash(('2', 1, 3, 3)))
+        self.assertNotEqual(temporalScore.idsHash((1, 2)),
+                            temporalScore.idsHash((1, 2, 3)))
+
+
+# Tests for engines that count locally from CSV extracts of the test
+# data.  They do not need Oracle.
+class LocalTemporalScoreTests(TemporalScoreTests):
+
+    engine = None
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='testTemporalScore.')
+        drugEraFileName, condEraFileName = writeTestEraCsvs(self.directory)
+        self.parameters = dict(temporalScore.defaultParameters)
+        self.parameters.update((
+                ('engine', self.engine),
+                ('drugEraFileName', drugEraFileName),
+                ('condEraFileName', condEraFileName),
+                ))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_iterTemporalScores(self):
+        rows = tuple(temporalScore.iterTemporalScores(
+                drugIds, condIds, parameters=self.parameters))
+        self.assertEqual(countsTable, tuple(
+                row[:12] + (round(row.temporal_score, 2),) for row in rows))
+        self.assertEqual(797, rows[-1].drug)
+        self.assertIsInstance(rows[-1].temporal_score, float)
+
+    def test_runScoringJobs(self):
+        expectedTable = readTemporalScoreOutputAsTable(
+            temporalScore.temporalScore(
+                drugIds, condIds, self.parameters)[0], convertTsResultRow)
+        jobs = [temporalScore.ScoringJob(
+                index, drugIds, condIds, self.parameters)
+                for index in range(5)]
+        finished = list(temporalScore.runScoringJobs(jobs, concurrency=2))
+        self.assertEqual(sorted(range(5)),
+                         sorted(job.name for job in finished))
+        for job in finished:
+            self.assertIsNone(job.error)
+            self.assertEqual(expectedTable, readTemporalScoreOutputAsTable(
+                    job.reportOutput, convertTsResultRow))
+
+    def test_iterTemporalScores_selection(self):
+        allRows = list(temporalScore.iterTemporalScores(
+                drugIds, condIds, parameters=self.parameters))
+        for topK, minScore, minCtDC in ((3, None, None), (None, 1.0, None),
+                                        (None, None, 2), (2, 0.9, 1),
+                                        (0, None, None)):
+            self.parameters.update(topK=topK, minScore=minScore,
+                                   minCtDC=minCtDC)
+            expectedRows = [
+                row for row in allRows
+                if (minScore is None or row.temporal_score >= minScore)
+                and (minCtDC is None or row.ct_d_c >= minCtDC)]
+            # Top rows are in order by score
+            if topK is not None:
+                expectedRows = sorted(
+                    expectedRows, key=lambda row: -row.temporal_score)[:topK]
+            actualRows = list(temporalScore.iterTemporalScores(
+                    drugIds, condIds, parameters=self.parameters))
+            self.assertEqual(expectedRows, actualRows)
+        # Sweeps select the rows of each configuration
+        self.parameters.update(topK=2, minScore=None, minCtDC=None,
+                               conditionWindowEnd='30,36500')
+        rows = list(temporalScore.iterSweepScores(
+                drugIds, condIds, parameters=self.parameters))
+        self.assertEqual([1, 1, 2, 2], [row.config for row in rows])
+
+    def writePersonCsv(self):
+        # People 1-11 except 5, of two sexes and born every 3 years
+        personFileName = os.path.join(self.directory, 'person.csv')
+        with open(personFileName, 'w') as personFile:
+            personFile.write('person_id,gender_concept_id,year_of_birth\n')
+            for person in range(1, 12):
+                if person != 5:
+                    personFile.write('{},{},{}\n'.format(
+                            person, 8507 + 25 * (person % 2),
+                            1950 + 3 * person))
+        return personFileName
+
+    def test_iterStratifiedScores(self):
+        self.parameters.update(personFileName=self.writePersonCsv(),
+                               stratumWidth=1)
+        def year(row):
+            return int(row[3][:4])
+        def birthYear(row):
+            return 1950 + 3 * int(row[1])
+        for stratifyBy, stratumOfRow, expectedStrata in (
+                ('gender_concept_id',
+                 lambda row: (None if row[1] == '5'
+                              else str(8507 + 25 * (int(row[1]) % 2))),
+                 ['8507', '8532']),
+                ('period', year, [2002, 2003, 2004]),
+                ('age',
+                 lambda row: (None if row[1] == '5'
+                              else year(row) - birthYear(row)),
+                 None),
+                ):
+            self.parameters['stratifyBy'] = stratifyBy
+            rows = list(temporalScore.iterStratifiedScores(
+                    drugIds, condIds, parameters=self.parameters))
+            strata = sorted(set(row.stratum for row in rows))
+            if expectedStrata is not None:
+                self.assertEqual(expectedStrata, strata)
+            # Same as scoring the records of each stratum alone
+            for stratum in strata:
+                parameters = dict(self.parameters, stratifyBy=None)
+                for eraType in ('drug', 'cond'):
+                    fileName = self.parameters[eraType + 'EraFileName']
+                    parameters[eraType + 'EraFileName'] = fileName + '.stratum'
+                    with open(fileName) as csvFile, \
+                            open(fileName + '.stratum', 'w') as stratumFile:
+                        stratumFile.write(next(csvFile))
+                        for line in csvFile:
+                            if stratumOfRow(line.split(',')) == stratum:
+                                stratumFile.write(line)
+                expectedRows = list(temporalScore.iterTemporalScores(
+                        drugIds, condIds, parameters=parameters))
+                self.assertEqual(
+                    expectedRows,
+                    [temporalScore.ReportRow(*row[1:])
+                     for row in rows if row.stratum == stratum])
+
+    def test_main_csvFormat(self):
+        reportFileName = os.path.join(self.directory, 'report.csv')
+        temporalScore.main([
+                '--engine', self.engine,
+                '--drug-eras', self.parameters['drugEraFileName'],
+                '--cond-eras', self.parameters['condEraFileName'],
+                '--format', 'csv',
+                '-o', reportFileName,
+                'testDataDrugIds.csv',
+                'testDataCondIds.csv',
+                ])
+        with open(reportFileName) as reportFile:
+            actualTable = tuple(
+                row[:12] + (round(row.temporal_score, 2),)
+                for row in temporalScore.readReportRows(reportFile))
+        self.assertEqual(countsTable, actualTable)
+
+    def test_main_npyFormat(self):
+        reportFileName = os.path.join(self.directory, 'report.npy')
+        temporalScore.main([
+                '--engine', self.engine,
+                '--drug-eras', self.parameters['drugEraFileName'],
+                '--cond-eras', self.parameters['condEraFileName'],
+                '--format', 'npy',
+                '-o', reportFileName,
+                'testDataDrugIds.csv',
+                'testDataCondIds.csv',
+                ])
+        report = temporalScore.loadReportArray(reportFileName)
+        self.assertEqual(temporalScore.reportColumnNames, report.dtype.names)
+        actualTable = tuple(
+            tuple(values[:12]) + (round(values[12], 2),)
+            for values in (row.tolist() for row in report))
+        self.assertEqual(countsTable, actualTable)
+        self.assertEqual([list(row[:12]) for row in countsTable],
+                         temporalScore.readReportCounts(
+                reportFileName).tolist())
+
+    def test_main_normalized(self):
+        fileNames = dict((name, os.path.join(self.directory, name))
+                         for name in ('pairs.csv', 'drugs.csv', 'conds.csv',
+                                      'summary.json'))
+        temporalScore.main([
+                '--engine', self.engine,
+                '--drug-eras', self.parameters['drugEraFileName'],
+                '--cond-eras', self.parameters['condEraFileName'],
+                '--normalized',
+                '--drug-marginals', fileNames['drugs.csv'],
+                '--cond-marginals', fileNames['conds.csv'],
+                '--summary', fileNames['summary.json'],
+                '-o', fileNames['pairs.csv'],
+                'testDataDrugIds.csv',
+                'testDataCondIds.csv',
+                ])
+        with open(fileNames['pairs.csv']) as pairsFile:
+            self.assertEqual(6, len(next(csv.reader(pairsFile))))
+        actualTable = tuple(
+            tuple(row[:12]) + (round(row[12], 2),)
+            for row in temporalScore.readNormalizedReport(
+                fileNames['pairs.csv'], fileNames['drugs.csv'],
+                fileNames['conds.csv']))
+        self.assertEqual(countsTable, actualTable)
+        with open(fileNames['summary.json']) as summaryFile:
+            summary = json.load(summaryFile)
+        self.assertEqual(countsTable[0][11], summary['ct_ppl'])
+        self.assertEqual(len(countsTable), summary['numPairs'])
+        self.assertEqual(2, summary['numDrugs'])
+        # The summary has ct_ppl even if no pairs are reported
+        temporalScore.main([
+                '--engine', self.engine,
+                '--drug-eras', self.parameters['drugEraFileName'],
+                '--cond-eras', self.parameters['condEraFileName'],
+                '--normalized',
+                '--min-ct-d-c', '100',
+                '--drug-marginals', fileNames['drugs.csv'],
+                '--cond-marginals', fileNames['conds.csv'],
+                '--summary', fileNames['summary.json'],
+                '-o', fileNames['pairs.csv'],
+                'testDataDrugIds.csv',
+                'testDataCondIds.csv',
+                ])
+        with open(fileNames['summary.json']) as summaryFile:
+            summary = json.load(summaryFile)
+        self.assertEqual(countsTable[0][11], summary['ct_ppl'])
+        self.assertEqual(0, summary['numPairs'])
+
+    def test_iterTemporalScores_metrics(self):
+        metrics = temporalScore.Metrics()
+        rows = list(temporalScore.iterTemporalScores(
+                drugIds, condIds, parameters=self.parameters, metrics=metrics))
+        phases = dict((phase['name'], phase) for phase in metrics.phases)
+        self.assertEqual(len(rows), phases['report']['rows'])
+        for phase in metrics.phases:
+            self.assertGreaterEqual(phase['seconds'], 0)
+
+    def test_main_metrics(self):
+        metricsFileName = os.path.join(self.directory, 'metrics.json')
+        temporalScore.main([
+                '--engine', self.engine,
+                '--drug-eras', self.parameters['drugEraFileName'],
+                '--cond-eras', self.parameters['condEraFileName'],
+                '--metrics', metricsFileName,
+                '-o', os.path.join(self.directory, 'report.csv'),
+                'testDataDrugIds.csv',
+                'testDataCondIds.csv',
+                ])
+        with open(metricsFileName) as metricsFile:
+            metrics = json.load(metricsFile)
+        self.assertEqual(self.engine, metrics['engine'])
+        self.assertEqual(2, metrics['numDrugs'])
+        self.assertIn('report_copy',
+                      [phase['name'] for phase in metrics['phases']])
+
+    def test_scoringService(self):
+        service = temporalScore.ScoringService(self.parameters)
+        try:
+            self.assertEqual(
+                list(temporalScore.iterTemporalScores(
+                        drugIds, condIds, parameters=self.parameters)),
+                service.score(drugIds, condIds))
+            # Another request with other IDs and parameters
+            options = {'pseudocount': '0.5', 'conditionWindowEnd': '30',
+                       'sparse': 'yes'}
+            self.parameters.update(options)
+            self.assertEqual(
+                list(temporalScore.iterTemporalScores(
+                        drugIds[1:], condIds[:2], parameters=self.parameters)),
+                service.score(drugIds[1:], condIds[:2], options))
+            self.assertRaises(ValueError, service.score, drugIds, condIds,
+                              {'engine': 'oracle'})
+        finally:
+            service.close()
+
+    def test_iterSweepScores(self):
+        # Each configuration of a sweep is the same as its own run
+        self.parameters.update((
+                ('conditionWindowStart', '-100000, 0'),
+                ('conditionWindowEnd', '30, 100000'),
+                ('drugOccurrenceOffset', '0, 5'),
+                ('pseudocount', (1, 0.5)),
+                ('sparse', True),
+                ))
+        configs = temporalScore.sweepConfigurations(self.parameters)
+        self.assertEqual(16, len(configs))
+        self.assertRaises(ValueError, temporalScore.iterTemporalScores,
+                          drugIds, condIds, self.parameters)
+        sweepRows = tuple(temporalScore.iterSweepScores(
+                drugIds, condIds, self.parameters))
+        for index, config in enumerate(configs, start=1):
+            parameters = dict(self.parameters)
+            parameters.update(config._asdict())
+            expectedRows = tuple(temporalScore.iterTemporalScores(
+                    drugIds, condIds, parameters))
+            actualRows = tuple(temporalScore.ReportRow._make(row[1:])
+                               for row in sweepRows if row.config == index)
+            self.assertEqual(expectedRows, actualRows)
+        self.assertEqual(sorted(row[:3] for row in sweepRows),
+                         [row[:3] for row in sweepRows])
+
+    def test_temporalScore_sparse(self):
+        # Score with data-less IDs in sparse mode and rebuild the full
+        # report from the marginals
+        self.parameters.update((
+                ('sparse', 'true'),
+                ('drugMarginalsFileName',
+                 os.path.join(self.directory, 'drugs.csv')),
+                ('condMarginalsFileName',
+                 os.path.join(self.directory, 'conds.csv')),
+                ))
+        extraDrugIds = drugIds + (701,)
+        extraCondIds = condIds + (499,)
+        reportOutput, scriptOutput = temporalScore.temporalScore(
+            extraDrugIds, extraCondIds, parameters=self.parameters)
+        pairRows = readTemporalScoreOutputAsTable(
+            reportOutput,
+            lambda row: tuple(int(i) for i in row[:12]) + (float(row[12]),))
+        self.assertEqual(countsTable, tuple(
+                convertTsResultRow(row) for row in pairRows))
+        marginalsRows = []
+        for fileName in ('drugs.csv', 'conds.csv'):
+            with open(os.path.join(self.directory, fileName)) as file_:
+                marginalsRows.append(readTemporalScoreOutputAsTable(
+                        file_, lambda row: tuple(int(i) for i in row)))
+        self.assertEqual((701, 0, 0, 0, 11), marginalsRows[0][0])
+        self.assertEqual((499, 0, 0, 0, 11), marginalsRows[1][-1])
+        denseTable = tuple(convertTsResultRow(row) for row in
+                           temporalScore.densifyReportRows(
+                pairRows, marginalsRows[0], marginalsRows[1], 1))
+        self.parameters['sparse'] = False
+        reportOutput, scriptOutput = temporalScore.temporalScore(
+            extraDrugIds, extraCondIds, parameters=self.parameters)
+        self.assertEqual(readTemporalScoreOutputAsTable(
+                reportOutput, convertTsResultRow), denseTable)
+
+
+class NumpyTemporalScoreTest(LocalTemporalScoreTests, unittest.TestCase):
+
+    engine = 'numpy'
+
+    def test_firstOccurrences(self):
+        import numpy
+        persons = numpy.array((2, 1, 1, 2, 1))
+        concepts = numpy.array((7, 5, 5, 7, 9))
+        days = numpy.array((30, 20, 10, 40, 50))
+        ids = numpy.array((5, 7))
+        actual = temporalScore.firstOccurrences(persons, concepts, days, ids)
+        self.assertEqual(((1, 2), (0, 1), (10, 30)),
+                         tuple(tuple(array.tolist()) for array in actual))
+
+    def test_partitionEras(self):
+        import numpy
+        eras = (numpy.array((4, 1, 2, 4, 3)),
+                numpy.array((7, 5, 5, 9, 7)),
+                numpy.array((30, 20, 10, 40, 50)))
+        partitions = temporalScore.partitionEras(eras, 3)
+        self.assertEqual(
+            [((3,), (7,), (50,)), ((4, 1, 4), (7, 5, 9), (30, 20, 40)),
+             ((2,), (5,), (10,))],
+            [tuple(tuple(array.tolist()) for array in partition)
+             for partition in partitions])
+
+    def test_sweepCounts(self):
+        import numpy
+        # Same counts as joining, also when expanding the pairs in small
+        # chunks and when pruning pairs
+        drugEras, condEras = temporalScore.backends['numpy'](
+            self.parameters).readEras()
+        firstDrugs = temporalScore.firstOccurrences(
+            *(tuple(drugEras) + (numpy.array(drugIds),)))
+        firstConds = temporalScore.firstOccurrences(
+            *(tuple(condEras) + (numpy.array(condIds),)))
+        settings = [(-100000, 100000, 0), (-100000, 100000, 30),
+                    (0, 365, 0), (-30, 30, 10), (5, 5, 0)]
+        sweepChunkSize = temporalScore.sweepChunkSize
+        temporalScore.sweepChunkSize = 3
+        try:
+            for minPairCount in (0, 2):
+                expected = temporalScore.firstOccurrencesCounts(
+                    firstDrugs, firstConds, len(drugIds), len(condIds),
+                    settings, minPairCount)
+                actual = temporalScore.sweepCounts(
+                    firstDrugs, firstConds, len(drugIds), len(condIds),
+                    settings, minPairCount)
+                for expectedCounts, actualCounts in zip(expected, actual):
+                    for expectedField, actualField in zip(
+                            expectedCounts, actualCounts):
+                        self.assertEqual(
+                            numpy.asarray(expectedField).tolist(),
+                            numpy.asarray(actualField).tolist())
+        finally:
+            temporalScore.sweepChunkSize = sweepChunkSize
+
+    def test_runScoringJobs_timeout(self):
+        # A job whose sub-process outlasts its timeout is killed and the
+        # other jobs still finish.  The other job only scores once the
+        # sleeping job has timed out, so both are running then.
+        sleepingCancelled = threading.Event()
+        class SleepingJob(temporalScore.ScoringJob):
+            def score(self):
+                process = temporalScore.startSubprocess(['sleep', '30'])
+                process.wait()
+                return temporalScore.ScoringJob.score(self)
+            def cancel(self, timedOut=False):
+                temporalScore.ScoringJob.cancel(self, timedOut)
+                sleepingCancelled.set()
+        class WaitingJob(temporalScore.ScoringJob):
+            def score(self):
+                sleepingCancelled.wait(10)
+                return temporalScore.ScoringJob.score(self)
+        sleepingJob = SleepingJob(
+            'sleeping', drugIds, condIds, self.parameters, timeout=0.2)
+        scoringJob = WaitingJob('scoring', drugIds, condIds, self.parameters)
+        finished = list(temporalScore.runScoringJobs(
+                [sleepingJob, scoringJob]))
+        self.assertEqual(['scoring', 'sleeping'],
+                         sorted(job.name for job in finished))
+        self.assertTrue(sleepingCancelled.is_set())
+        self.assertIsNone(scoringJob.error)
+        self.assertTrue(sleepingJob.timedOut)
+        self.assertIsInstance(sleepingJob.error,
+                              temporalScore.ScoringJobCancelled)
+        self.assertLess(sleepingJob.seconds, 10)
+        self.assertTrue(all(process.poll() is not None
+                            for process in sleepingJob.processes))
+
+    def test_getUncancelled(self):
+        # Waiting for a process of a job stops when the job is cancelled
+        job = temporalScore.ScoringJob('waiting', drugIds, condIds)
+        pool = multiprocessing.Pool(1)
+        try:
+            result = pool.apply_async(time.sleep, (30,))
+            timer = threading.Timer(0.2, job.cancel)
+            timer.start()
+            with temporalScore.runningScoringJob(job):
+                self.assertRaises(temporalScore.ScoringJobCancelled,
+                                  temporalScore.getUncancelled, result.get)
+            self.assertFalse(result.ready())
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def test_temporalScore_processes(self):
+        expectedRows = list(temporalScore.iterTemporalScores(
+                drugIds, condIds, parameters=self.parameters))
+        self.parameters['processes'] = 3
+        actualRows = list(temporalScore.iterTemporalScores(
+                drugIds, condIds, parameters=self.parameters))
+        self.assertEqual(expectedRows, actualRows)
+        # Sweeps too
+        self.parameters['conditionWindowEnd'] = '30,36500'
+        self.parameters['drugOccurrenceOffset'] = '0,10'
+        actualRows = list(temporalScore.iterSweepScores(
+                drugIds, condIds, parameters=self.parameters))
+        self.parameters['processes'] = 1
+        expectedRows = list(temporalScore.iterSweepScores(
+                drugIds, condIds, parameters=self.parameters))
+        self.assertEqual(expectedRows, actualRows)
+
+    def test_firstOccurrenceStore(self):
+        expectedRows = list(temporalScore.iterTemporalScores(
+                drugIds, condIds, parameters=self.parameters))
+        storeDirectory = os.path.join(self.directory, 'store')
+        self.parameters['firstOccurrenceStore'] = storeDirectory
+        # Built on the first run and reused on the second, in one
+        # process and in several
+        for processes in (1, 3):
+            self.parameters['processes'] = processes
+            actualRows = list(temporalScore.iterTemporalScores(
+                    drugIds, condIds, parameters=self.parameters))
+            self.assertEqual(expectedRows, actualRows)
+        drugStore = temporalScore.openFirstOccurrenceStore(
+            storeDirectory, 'drug')
+        self.assertEqual(len(drugStore.persons), drugStore.offsets[-1])
+        self.assertEqual(drugStore.personIds.tolist(),
+                         sorted(set(drugStore.persons.tolist())))
+        # Stale if the extract changes
+        source = temporalScore.eraSourceSignature(
+            self.parameters['drugEraFileName'])
+        source['size'] += 1
+        self.assertIsNone(temporalScore.openFirstOccurrenceStore(
+                storeDirectory, 'drug', source))
+        # Warm services use the stores too
+        service = temporalScore.ScoringService(self.parameters)
+        try:
+            self.assertEqual(expectedRows, service.score(drugIds, condIds))
+        finally:
+            service.close()
+
+    def test_partitionsPruning(self):
+        import numpy
+        # Masks from the marginals of all the people prune as counting
+        # all the people at once does
+        drugEras, condEras = temporalScore.backends['numpy'](
+            self.parameters).readEras()
+        firstDrugs = temporalScore.firstOccurrences(
+            *(tuple(drugEras) + (numpy.array(drugIds),)))
+        firstConds = temporalScore.firstOccurrences(
+            *(tuple(condEras) + (numpy.array(condIds),)))
+        settings = [(-100000, 100000, 0), (0, 365, 0)]
+        marginals = temporalScore.marginalsCounts(
+            firstDrugs, firstConds, len(drugIds), len(condIds), settings)
+        self.assertEqual([0, 0], [counts.ct_d_c.sum() for counts in marginals])
+        countsFunction = temporalScore.backends[self.engine].countsFunction
+        expected = countsFunction(
+            firstDrugs, firstConds, len(drugIds), len(condIds), settings,
+            minPairCount=3)
+        actual = countsFunction(
+            firstDrugs, firstConds, len(drugIds), len(condIds), settings,
+            pairMasks=temporalScore.pairMasks(marginals, 3))
+        for expectedCounts, actualCounts in zip(expected, actual):
+            for expectedField, actualField in zip(expectedCounts, actualCounts):
+                self.assertEqual(numpy.asarray(expectedField).tolist(),
+                                 numpy.asarray(actualField).tolist())
+        # Runs in several processes
+        self.parameters['minCtDC'] = 3
+        expectedRows = list(temporalScore.iterTemporalScores(
+                drugIds, condIds, parameters=self.parameters))
+        self.assertEqual(1, len(expectedRows))
+        self.parameters['processes'] = 3
+        metrics = temporalScore.Metrics()
+        actualRows = list(temporalScore.iterTemporalScores(
+                drugIds, condIds, parameters=self.parameters,
+                metrics=metrics))
+        self.assertEqual(expectedRows, actualRows)
+        self.assertIn('count_marginals',
+                      [phase['name'] for phase in metrics.phases])
+
+    def test_storePartitionsRows(self):
+        import numpy
+        def store(persons):
+            persons = numpy.array(persons)
+            isFirst = numpy.ones(len(persons), dtype=bool)
+            isFirst[1:] = persons[1:] != persons[:-1]
+            return temporalScore.FirstOccurrenceStore(
+                None, persons, None, None, persons[isFirst],
+                numpy.append(numpy.flatnonzero(isFirst), len(persons)))
+        drugStore = store((1, 1, 2, 4, 4, 4, 5, 7))
+        condStore = store((2, 3, 3, 6, 7, 8))
+        partitions = temporalScore.storePartitionsRows(
+            drugStore, condStore, 3)
+        self.assertEqual(
+            [((1, 1), ()), ((2,), (2, 3, 3)), ((4, 4, 4, 5, 7), (6, 7, 8))],
+            [(tuple(drugStore.persons[drugRows].tolist()),
+              tuple(condStore.persons[condRows].tolist()))
+             for drugRows, condRows in partitions])
+        # Empty stores
+        emptyStore = store(numpy.array((), dtype=int))
+        for drugStore, condStore, expected in (
+                (emptyStore, condStore, [((), (2, 3, 3, 6, 7, 8))]),
+                (drugStore, emptyStore, [((1, 1), ()), ((2,), ()),
+                                         ((4, 4, 4, 5, 7), ())]),
+                (emptyStore, emptyStore, [((), ())]),
+                ):
+            partitions = temporalScore.storePartitionsRows(
+                drugStore, condStore, 3)
+            self.assertEqual(
+                expected,
+                [(tuple(drugStore.persons[drugRows].tolist()),
+                  tuple(condStore.persons[condRows].tolist()))
+                 for drugRows, condRows in partitions])
+
+    def test_temporalScore_streaming(self):
+        expectedRows = list(temporalScore.iterTemporalScores(
+                drugIds, condIds, parameters=self.parameters))
+        # The extracts are sorted by date, so not streamable
+        self.parameters['streaming'] = True
+        self.assertRaises(ValueError, list, temporalScore.iterTemporalScores(
+                drugIds, condIds, parameters=self.parameters))
+        for eraType in ('drug', 'cond'):
+            sortCsvByPerson(self.parameters[eraType + 'EraFileName'])
+        # Chunks of a few people, in one process and in several
+        self.parameters['streamChunkSize'] = 5
+        for processes in (1, 2):
+            self.parameters['processes'] = processes
+            actualRows = list(temporalScore.iterTemporalScores(
+                    drugIds, condIds, parameters=self.parameters))
+            self.assertEqual(expectedRows, actualRows)
+
+    def test_iterStratifiedScores_options(self):
+        self.parameters.update(personFileName=self.writePersonCsv(),
+                               stratifyBy='gender_concept_id')
+        expectedRows = list(temporalScore.iterStratifiedScores(
+                drugIds, condIds, parameters=self.parameters))
+        # The strata are counted in parallel
+        self.parameters['processes'] = 2
+        self.assertEqual(expectedRows, list(temporalScore.iterStratifiedScores(
+                    drugIds, condIds, parameters=self.parameters)))
+        # Options that do not apply are rejected up front
+        for name, value in (('firstOccurrenceStore', self.directory),
+                            ('streaming', 'yes'), ('incremental', 'yes')):
+            self.assertRaises(
+                ValueError, temporalScore.iterStratifiedScores,
+                drugIds, condIds, parameters=dict(self.parameters,
+                                                  **{name: value}))
+
+    def test_scoringServer(self):
+        service = temporalScore.ScoringService(self.parameters)
+        server = temporalScore.makeScoringServer(service, port=0)
+        url = 'http://localhost:{}/scores'.format(server.server_address[1])
+        def request(*args):
+            thread = threading.Thread(target=server.handle_request)
+            thread.start()
+            try:
+                response = urlopen(*args)
+                return response.read().decode('utf-8')
+            finally:
+                thread.join()
+        try:
+            csvReport = request(url + '?drugs=773,797&conds=421,443,479&format=csv')
+            actualTable = tuple(
+                row[:12] + (round(row.temporal_score, 2),)
+                for row in temporalScore.readReportRows(
+                    csvReport.splitlines()))
+            self.assertEqual(countsTable, actualTable)
+            jsonReport = json.loads(request(url, json.dumps(
+                        {'drugs': [797], 'conds': [421, 479]}).encode('utf-8')))
+            self.assertEqual(
+                [row._asdict() for row in service.score((797,), (421, 479))],
+                jsonReport['rows'])
+        finally:
+            server.server_close()
+            service.close()
+
+    def test_temporalScore_window(self):
+        # Only conditions starting within 30 days after the drug count
+        self.parameters['conditionWindowStart'] = '0'
+        self.parameters['conditionWindowEnd'] = '30'
+        reportOutput, scriptOutput = temporalScore.temporalScore(
+            drugIds, condIds, parameters=self.parameters)
+        actualTable = readTemporalScoreOutputAsTable(
+            reportOutput, convertTsResultRow)
+        # Patient 2 has 421 28 days after 773 (in the window), patient
+        # 7 has 421 26 days before 773, and patient 11 has 421 107 days
+        # after 773 (both outside the window)
+        actualRow = actualTable[0]
+        self.assertEqual((773, 421), actualRow[:2])
+        self.assertEqual((1, 0, 1), actualRow[2:5])
+
+
+class BitmapTemporalScoreTest(NumpyTemporalScoreTest):
+
+    engine = 'bitmap'
+
+    def test_personBitmaps(self):
+        import numpy
+        bitmaps = temporalScore.personBitmaps(
+            numpy.array((3, 5, 9, 30)), numpy.array((1, 0, 1, 1)), 2,
+            numpy.array((3, 5, 7, 9, 11, 13, 17, 19, 23, 30)))
+        self.assertEqual([[2], [521]], bitmaps.tolist())
+        self.assertEqual([1, 3], temporalScore.popcounts(bitmaps).tolist())
+
+    def test_bitmapCounts(self):
+        import numpy
+        # Same counts as joining for unbounded and finite windows
+        drugEras, condEras = temporalScore.backends['numpy'](
+            self.parameters).readEras()
+        firstDrugs = temporalScore.firstOccurrences(
+            *(tuple(drugEras) + (numpy.array(drugIds),)))
+        firstConds = temporalScore.firstOccurrences(
+            *(tuple(condEras) + (numpy.array(condIds),)))
+        settings = [(-100000, 100000, 0), (-100000, 100000, 30),
+                    (0, 365, 0), (-30, 30, 10)]
+        expected = temporalScore.firstOccurrencesCounts(
+            firstDrugs, firstConds, len(drugIds), len(condIds), settings)
+        actual = temporalScore.bitmapCounts(
+            firstDrugs, firstConds, len(drugIds), len(condIds), settings)
+        for expectedCounts, actualCounts in zip(expected, actual):
+            for expectedField, actualField in zip(expectedCounts, actualCounts):
+                self.assertEqual(numpy.asarray(expectedField).tolist(),
+                                 numpy.asarray(actualField).tolist())
+
+
+class SqliteTemporalScoreTest(LocalTemporalScoreTests, unittest.TestCase):
+
+    engine = 'sqlite'
+
+    def test_cancel_interruptsStatement(self):
+        # Cancelling a job interrupts the statement running on its
+        # connection
+        class CountingJob(temporalScore.ScoringJob):
+            def score(self):
+                backend = temporalScore.makeBackend(self.parameters)
+                backend.connect().execute(
+                    'with recursive n(i) as (select 1 union all '
+                    'select i + 1 from n where i < 1000000000) '
+                    'select count(*) from n').fetchone()
+        job = CountingJob('counting', drugIds, condIds, self.parameters)
+        timer = threading.Timer(0.2, job.cancel)
+        timer.start()
+        job.run()
+        self.assertIsInstance(job.error, temporalScore.ScoringJobCancelled)
+        self.assertLess(job.seconds, 10)
+
+    def test_iterTemporalScores_normalized(self):
+        # The results table only has the pair columns and the report has
+        # the rest from the marginals tables
+        self.parameters['sqliteDbFileName'] = os.path.join(
+            self.directory, 'eras.sqlite')
+        self.parameters['normalized'] = True
+        rows = tuple(temporalScore.iterTemporalScores(
+                drugIds, condIds, parameters=self.parameters))
+        self.assertEqual(countsTable, tuple(
+                row[:12] + (round(row.temporal_score, 2),) for row in rows))
+        connection = sqlite3.connect(self.parameters['sqliteDbFileName'])
+        try:
+            columns = [description[0] for description in connection.execute(
+                    'select * from counts_scores').description]
+        finally:
+            connection.close()
+        self.assertEqual(list(temporalScore.pairColumnNames), columns)
+
+    def test_temporalScore_dbFile(self):
+        # Load the extracts into a DB file and then score from the DB
+        # alone
+        self.parameters['sqliteDbFileName'] = os.path.join(
+            self.directory, 'eras.sqlite')
+        temporalScore.temporalScore(drugIds, condIds, self.parameters)
+        self.parameters['drugEraFileName'] = None
+        self.parameters['condEraFileName'] = None
+        self.parameters['explainQueryPlans'] = 'true'
+        reportOutput, scriptOutput = temporalScore.temporalScore(
+            drugIds, condIds, self.parameters)
+        actualTable = readTemporalScoreOutputAsTable(
+            reportOutput, convertTsResultRow)
+        self.assertEqual(countsTable, actualTable)
+
+    def test_temporalScore_incremental(self):
+        # Score a drug and a condition, add the rest, and compare with a
+        # full run, in dense and in sparse mode
+        self.parameters['sqliteDbFileName'] = os.path.join(
+            self.directory, 'eras.sqlite')
+        for sparse in (False, True):
+            self.parameters['sparse'] = sparse
+            self.parameters['incremental'] = False
+            self.parameters['countsScoresTableName'] = 'counts_scores'
+            reportOutput, scriptOutput = temporalScore.temporalScore(
+                drugIds, condIds, self.parameters)
+            expectedTable = readTemporalScoreOutputAsTable(
+                reportOutput, convertTsResultRow)
+            self.parameters['incremental'] = True
+            self.parameters['countsScoresTableName'] = (
+                'incremental_{}'.format(int(sparse)))
+            temporalScore.temporalScore(
+                drugIds[:1], condIds[1:2], self.parameters)
+            temporalScore.temporalScore(
+                drugIds[:1], condIds, self.parameters)
+            reportOutput, scriptOutput = temporalScore.temporalScore(
+                drugIds, condIds, self.parameters)
+            actualTable = readTemporalScoreOutputAsTable(
+                reportOutput, convertTsResultRow)
+            self.assertEqual(expectedTable, actualTable)
+
+    def test_temporalScore_incremental_changedSettings(self):
+        # Changing the window between incremental runs rebuilds the
+        # state instead of reusing the first occurrences of the old
+        # window
+        self.parameters['sqliteDbFileName'] = os.path.join(
+            self.directory, 'eras.sqlite')
+        self.parameters['incremental'] = True
+        temporalScore.temporalScore(drugIds, condIds, self.parameters)
+        self.parameters['conditionWindowStart'] = 0
+        self.parameters['conditionWindowEnd'] = 30
+        reportOutput, scriptOutput = temporalScore.temporalScore(
+            drugIds, condIds, self.parameters)
+        actualTable = readTemporalScoreOutputAsTable(
+            reportOutput, convertTsResultRow)
+        self.parameters['incremental'] = False
+        self.parameters['countsScoresTableName'] = 'full_counts_scores'
+        reportOutput, scriptOutput = temporalScore.temporalScore(
+            drugIds, condIds, self.parameters)
+        expectedTable = readTemporalScoreOutputAsTable(
+            reportOutput, convertTsResultRow)
+        self.assertEqual(expectedTable, actualTable)
+        self.assertNotEqual(countsTable, actualTable)
+
+    def test_temporalScore_minCtDC(self):
+        # Only the pairs that reach minCtDC are in the results table
+        dbFileName = os.path.join(self.directory, 'eras.sqlite')
+        self.parameters['sqliteDbFileName'] = dbFileName
+        for minCtDC in (2, 3):
+            self.parameters['minCtDC'] = minCtDC
+            rows = list(temporalScore.iterTemporalScores(
+                    drugIds, condIds, parameters=self.parameters))
+            connection = sqlite3.connect(dbFileName)
+            try:
+                tableRows = connection.execute(
+                    'select * from counts_scores order by drug, cond'
+                    ).fetchall()
+            finally:
+                connection.close()
+            self.assertEqual(
+                [row[:5] for row in countsTable if row[4] >= minCtDC],
+                [row[:5] for row in tableRows])
+            self.assertEqual(rows, [temporalScore.ReportRow._make(row)
+                                    for row in tableRows])
+
+    def test_temporalScore_firstOccurrenceCache(self):
+        dbFileName = os.path.join(self.directory, 'eras.sqlite')
+        self.parameters['sqliteDbFileName'] = dbFileName
+        self.parameters['firstOccurrenceCache'] = True
+        self.parameters['firstOccurrenceCacheSize'] = 2
+        def cacheIds():
+            connection = sqlite3.connect(dbFileName)
+            try:
+                return [row[0] for row in connection.execute(
+                        'select cache_id from first_occ_cache '
+                        'order by cache_id')]
+            finally:
+                connection.close()
+        # Fill the cache and then reuse it
+        for run in range(2):
+            reportOutput, scriptOutput = temporalScore.temporalScore(
+                drugIds, condIds, self.parameters)
+            actualTable = readTemporalScoreOutputAsTable(
+                reportOutput, convertTsResultRow)
+            self.assertEqual(countsTable, actualTable)
+            self.assertEqual([1, 2], cacheIds())
+        # A new set of drugs evicts the least recently used entry
+        temporalScore.temporalScore(drugIds[:1], condIds, self.parameters)
+        self.assertEqual([2, 3], cacheIds())
+        # Changing an era table invalidates its entries
+        self.parameters['drugEraFileName'] = None
+        self.parameters['condEraFileName'] = None
+        connection = sqlite3.connect(dbFileName)
+        connection.execute(
+            'delete from drug_era where drug_concept_id = ?', (drugIds[0],))
+        connection.commit()
+        connection.close()
+        reportOutput, scriptOutput = temporalScore.temporalScore(
+            drugIds, condIds, self.parameters)
+        actualTable = readTemporalScoreOutputAsTable(
+            reportOutput, convertTsResultRow)
+        self.assertEqual([2, 4], cacheIds())
+        # Changing the rows of other concepts does not
+        connection = sqlite3.connect(dbFileName)
+        connection.execute(
+            "insert into drug_era values (1, 999999, '2010-01-01')")
+        connection.commit()
+        connection.close()
+        temporalScore.temporalScore(drugIds, condIds, self.parameters)
+        self.assertEqual([2, 4], cacheIds())
+        self.parameters['firstOccurrenceCache'] = False
+        reportOutput, scriptOutput = temporalScore.temporalScore(
+            drugIds, condIds, self.parameters)
+        expectedTable = readTemporalScoreOutputAsTable(
+            reportOutput, convertTsResultRow)
+        self.assertEqual(expectedTable, actualTable)
+        self.assertNotEqual(countsTable, actualTable)
+
+
+class RescoreTest(unittest.TestCase):
+
+    def setUp(self):
+        # Score the test data with the SQLite engine into a DB file and a
+        # report file
+        self.directory = tempfile.mkdtemp(prefix='testTemporalScore.')
+        drugEraFileName, condEraFileName = writeTestEraCsvs(self.directory)
+        self.dbFileName = os.path.join(self.directory, 'eras.sqlite')
+        self.reportFileName = os.path.join(self.directory, 'report.csv')
+        parameters = dict(temporalScore.defaultParameters)
+        parameters.update((
+                ('engine', 'sqlite'),
+                ('drugEraFileName', drugEraFileName),
+                ('condEraFileName', condEraFileName),
+                ('sqliteDbFileName', self.dbFileName),
+                ))
+        with open(self.reportFileName, 'w') as reportFile:
+            temporalScore.writeReportRows(temporalScore.iterTemporalScores(
+                    drugIds, condIds, parameters), reportFile)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_rescore_samePseudocount(self):
+        outputFileName = os.path.join(self.directory, 'rescored.csv')
+        temporalScore.main(['rescore', '-o', outputFileName,
+                            self.reportFileName])
+        with open(outputFileName) as outputFile:
+            actualTable = readTemporalScoreOutputAsTable(
+                outputFile, convertTsResultRow)
+        self.assertEqual(countsTable, actualTable)
+
+    def test_rescoreCounts(self):
+        counts = temporalScore.readReportCounts(self.reportFileName)
+        self.assertEqual(countsTable[0][:12], tuple(counts[0].tolist()))
+        names, scores = temporalScore.rescoreCounts(
+            counts, (0.5, 2), ('temporal_score', 'odds_ratio'))
+        self.assertEqual(['temporal_score_0.5', 'odds_ratio_0.5',
+                          'temporal_score_2', 'odds_ratio_2'], names)
+        self.assertEqual((len(countsTable), 4), scores.shape)
+        for row, rowScores in zip(countsTable, scores.tolist()):
+            self.assertAlmostEqual(temporalScore.computeTemporalScores(
+                    row[2], row[4], row[5], row[6], row[7], row[8], 2),
+                                   rowScores[2])
+        # 773-421: 3 with both, 3 with the drug only, 4 with the
+        # condition only, and 1 with neither
+        self.assertAlmostEqual((3.5 * 1.5) / (3.5 * 4.5), scores[0, 1])
+
+    def test_rescore_resultsTable(self):
+        tableCounts = temporalScore.readResultsTableCounts(
+            self.dbFileName, 'counts_scores')
+        reportCounts = temporalScore.readReportCounts(self.reportFileName)
+        self.assertEqual(reportCounts.tolist(), tableCounts.tolist())
+
+
+class SyntheticDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='testTemporalScore.')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_writeSyntheticEraCsvs_plantedPairs(self):
+        random.seed(1)
+        model = makeSyntheticModel(10, 20, 3, effectProb=0.8)
+        drugEraFileName, condEraFileName = writeSyntheticEraCsvs(
+            self.directory, model, 2000)
+        parameters = dict(temporalScore.defaultParameters)
+        parameters.update((
+                ('engine', 'sqlite'),
+                ('drugEraFileName', drugEraFileName),
+                ('condEraFileName', condEraFileName),
+                ))
+        rows = list(temporalScore.iterTemporalScores(
+                model.drugIds, model.condIds, parameters=parameters))
+        self.assertEqual(200, len(rows))
+        # The effect of each planted drug is the condition that is after
+        # it most often beyond what independence would give
+        def excess(row):
+            return row.ct_d_bef_c - float(row.ct_d) * row.ct_c / row.ct_ppl
+        planted = plantedPairs(model)
+        self.assertEqual(3, len(planted))
+        for drugId, condId in planted:
+            drugRows = [row for row in rows if row.drug == drugId]
+            self.assertEqual(condId, max(drugRows, key=excess).cond)
+
+
 ########################################
 # Main
 